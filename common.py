@@ -2,41 +2,240 @@
 Common functions used for generating Sparx Enterprise Architect model documents.
 """
 
+import fnmatch
+import hashlib
+import json
 import os
+import pickle
 import shutil
+import time
 
+try:
+    import fcntl
+except ImportError:
+    # Not available on Windows, where images are hard linked or copied.
+    fcntl = None
+
+try:
+    from PIL import Image
+except ImportError:
+    # Pillow is only needed to optimise the diagram images.
+    Image = None
+
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
-from jinja2 import FileSystemLoader, Environment
+from jinja2 import FileSystemLoader, FileSystemBytecodeCache, Environment, select_autoescape
+from lxml import etree as ET
+from markupsafe import Markup
 from pprint import pprint
 
 
 ns = { 'xmi': 'http://schema.omg.org/spec/XMI/2.1', 'uml': 'http://schema.omg.org/spec/UML/2.1' }
 
 
-def get_package_hierachy(packaged_element):
+class PackagePaths:
+    """
+    Memoized package paths of the nodes of an XMI tree.
 
-    package_hierarchy = []
+    The package path of a node is the tuple of the names of the uml:Package it is in, from the root
+    down, and the node itself if it is a uml:Package. It is built from the memoized path of the
+    parent node, so in a top-down pass every path is computed in O(1) and the elements of a package
+    share the same tuple.
+    """
 
-    # Traverse and print the hierarchy of parents
-    current_element = packaged_element
-    while current_element is not None:
-        xmi_type = get_namespaced_attribute(current_element, "xmi:type", ns)
-        if xmi_type == 'uml:Package':
-            # print("{} {}".format(current_element.tag, current_element.get('name')))
-            package_hierarchy.insert(0, current_element.get('name'))
-        current_element = current_element.getparent()
+    def __init__(self):
+        self.paths = {}
 
-    print(package_hierarchy, packaged_element.get('name'))
+    def path_of(self, node):
+        path = self.paths.get(node)
+        if path is None:
+            parent = node.getparent()
+            path = self.path_of(parent) if parent is not None else ()
+            if node.get(XMI_TYPE) == 'uml:Package':
+                path = path + (node.get('name'),)
+            self.paths[node] = path
+        return path
 
-    return package_hierarchy
 
+RULES_FILE = "model_rules.json"
 
-def check_for_skip(package_hierarchy):
-    if package_hierarchy[0:2] == ['D2Payload', 'LocationReferencing'] or \
-       package_hierarchy[0:3] == ['D2Payload', 'Common', 'Classes']:
-        return True
-    else:
-        False
+# The DATEX II packages that are not documented, used when there is no rules file.
+DEFAULT_RULES = {
+    'skip': [
+        {'path': 'D2Payload/LocationReferencing'},
+        {'path': 'D2Payload/Common/Classes'},
+    ],
+    'include': [],
+}
+
+
+class RuleNode:
+    """
+    Node of the package path trie of a PackageRules, one per path segment pattern.
+    """
+
+    __slots__ = ('children', 'globstar', 'action', 'specificity', 'has_include')
+
+    def __init__(self, globstar=False):
+        self.children = {}
+        self.globstar = globstar    # True for a "**" segment, which keeps matching further segments.
+        self.action = None          # 'skip' or 'include' if a rule ends at this node.
+        self.specificity = 0        # Number of segments other than "**" in the rule ending here.
+        self.has_include = False    # True if an include rule ends at or below this node.
+
+
+class PackageRules:
+    """
+    Skip and include rules for the packages and elements of a model.
+
+    A path rule is a package path glob such as "D2Payload/Common/*" where each segment is matched
+    with fnmatch and "**" matches any number of segments. It applies to the package it matches and
+    everything below it, and the most specific rule wins, so an include rule can bring back part of
+    a skipped package. A rule is more specific when it has more segments other than "**", and an
+    include wins over a skip that is as specific. A stereotype rule matches the stereotype of the
+    element itself.
+
+    The path rules are compiled into a trie of segment patterns and the trie states of each package
+    path are memoized from the states of its parent path, so a top-down traversal decides each
+    package in O(1) and can prune a skipped package without visiting anything below it.
+    """
+
+    def __init__(self, rules=None):
+        rules = DEFAULT_RULES if rules is None else rules
+
+        self.fingerprint = hashlib.sha256(json.dumps(rules, sort_keys=True).encode('utf-8')).hexdigest()
+        self.trie = RuleNode()
+        self.stereotypes = {'skip': [], 'include': []}
+        self.pruned = set()
+
+        for action in ['skip', 'include']:
+            for rule in rules.get(action, []):
+                if isinstance(rule, str):
+                    rule = {'path': rule}
+                if 'path' in rule:
+                    self.add_path(rule['path'], action)
+                if 'stereotype' in rule:
+                    self.stereotypes[action].append(rule['stereotype'])
+
+        self.states = {(): (self.closure([self.trie]), None, -1)}
+
+    def add_path(self, pattern, action):
+        node = self.trie
+        nodes = [node]
+        segments = pattern.strip('/').split('/')
+        for segment in segments:
+            node = node.children.setdefault(segment, RuleNode(globstar=segment == '**'))
+            nodes.append(node)
+        specificity = sum(1 for segment in segments if segment != '**')
+        if node.action is None or (specificity, action == 'include') > (node.specificity, node.action == 'include'):
+            node.action = action
+            node.specificity = specificity
+        if action == 'include':
+            for node in nodes:
+                node.has_include = True
+
+    def closure(self, nodes):
+        # Add the "**" children of the nodes, which also match no segments at all.
+        nodes = list(nodes)
+        for node in nodes:
+            child = node.children.get('**')
+            if child is not None and child not in nodes:
+                nodes.append(child)
+        return tuple(nodes)
+
+    def state(self, package_path):
+        """
+        Return the trie nodes matching a package path, and the action and specificity of the most
+        specific rule that applies to it.
+        """
+        state = self.states.get(package_path)
+        if state is None:
+            nodes, action, specificity = self.state(package_path[:-1])
+            segment = package_path[-1] or ''
+
+            matched = []
+            for node in nodes:
+                if node.globstar:
+                    matched.append(node)
+                for pattern, child in node.children.items():
+                    if not child.globstar and fnmatch.fnmatchcase(segment, pattern):
+                        matched.append(child)
+            matched = self.closure(matched)
+
+            # A "**" node that already matched the parent path only replaces the inherited action
+            # if its rule is at least as specific as the rule that set it.
+            rules = [(node.specificity, node.action == 'include') for node in matched
+                     if node.action is not None and (node not in nodes or node.specificity >= specificity)]
+            if rules:
+                specificity, include = max(rules)
+                action = 'include' if include else 'skip'
+
+            state = self.states[package_path] = (matched, action, specificity)
+        return state
+
+    def prunes(self, package_path):
+        """
+        Return True if a package and everything below it is skipped, so it need not be visited.
+        """
+        nodes, action, _ = self.state(tuple(package_path))
+        if action == 'skip' and not any(node.has_include for node in nodes) and not self.stereotypes['include']:
+            self.pruned.add(tuple(package_path))
+            return True
+        return False
+
+    def skips(self, package_path, stereotype=None):
+        """
+        Return True if an element is skipped, from its package path and stereotype.
+        """
+        if stereotype is not None:
+            if any(fnmatch.fnmatchcase(stereotype, pattern) for pattern in self.stereotypes['include']):
+                return False
+            if any(fnmatch.fnmatchcase(stereotype, pattern) for pattern in self.stereotypes['skip']):
+                return True
+        return self.state(tuple(package_path))[1] == 'skip'
+
+
+def load_rules(rules_file=RULES_FILE):
+    """
+    Load the PackageRules from a JSON rules file, or the default rules if the file does not exist.
+    With no rules file at all, None, nothing is skipped.
+    """
+    if rules_file is None:
+        return PackageRules({})
+    if os.path.isfile(rules_file):
+        with open(rules_file, encoding='utf-8') as file:
+            return PackageRules(json.load(file))
+    return PackageRules()
+
+
+_rules = None
+
+
+def get_rules():
+    """
+    Return the process wide PackageRules, loading them from the rules file if needed.
+    """
+    global _rules
+    if _rules is None:
+        _rules = load_rules()
+    return _rules
+
+
+def configure_rules(rules_file=RULES_FILE):
+    """
+    Replace the process wide PackageRules with the rules of a rules file.
+    """
+    global _rules
+    _rules = load_rules(rules_file)
+    return _rules
+
+
+def check_for_skip(package_path, stereotype=None):
+    """
+    Return True if an element is skipped by the rules, from its precomputed package path and its
+    stereotype.
+    """
+    return get_rules().skips(package_path, stereotype)
 
 
 def get_namespaced_attribute(element, prefix_attr_name, ns_map):
@@ -53,21 +252,647 @@ def get_namespaced_attribute(element, prefix_attr_name, ns_map):
     return element.attrib.get(prefix_attr_name)
 
 
+# The formats the pages can be rendered in, with the directory of their templates and the extension
+# of the page files.
+PAGE_FORMATS = {
+    'markdown': ("templates", ".md"),
+    'confluence': (os.path.join("templates", "confluence"), ".xhtml"),
+}
+
+
+def cdata(value):
+    """
+    Jinja2 filter for text inside a CDATA section, which may not contain the ]]> end marker.
+    """
+    return Markup(str(value).replace("]]>", "]]]]><![CDATA[>"))
+
+
+class TemplateRenderer:
+    """
+    Renders the Jinja2 templates from one Environment, compiling each template only once.
+
+    If a bytecode cache directory is given the compiled templates are also saved to disk so later
+    runs skip compiling them altogether.
+
+    With more than one job the pages are queued instead of rendered straight away, and
+    render_queued() then renders and writes them across a pool of worker processes.
+
+    The generators always name the markdown template and page file, e.g. class.md.j2 and index.md.
+    With another page extension these are swapped for the template and page file of that format,
+    e.g. class.xhtml.j2 and index.xhtml, and the XHTML templates are autoescaped.
+    """
+
+    def __init__(self, template_dir="templates", bytecode_cache_dir=None, manifest=None, jobs=1, extension=".md"):
+        self.template_dir = template_dir
+        self.extension = extension
+        self.bytecode_cache_dir = bytecode_cache_dir
+
+        bytecode_cache = None
+        if bytecode_cache_dir:
+            os.makedirs(bytecode_cache_dir, exist_ok=True)
+            bytecode_cache = FileSystemBytecodeCache(bytecode_cache_dir)
+
+        self.env = Environment(loader=FileSystemLoader(template_dir),
+                               trim_blocks=True,
+                               lstrip_blocks=True,
+                               autoescape=select_autoescape(['xhtml.j2'], default_for_string=False),
+                               bytecode_cache=bytecode_cache)
+        self.env.filters['cdata'] = cdata
+        self.templates = {}
+        self.template_hashes = {}
+        self.manifest = manifest
+        self.jobs = jobs or os.cpu_count()
+        self.queue = {}
+        self.load_time = 0.0
+        self.render_time = 0.0
+        self.pages = 0
+
+    def get_template(self, name):
+        """
+        Return a compiled template, loading it on first use.
+        """
+        template = self.templates.get(name)
+        if template is None:
+            start = time.perf_counter()
+            template = self.templates[name] = self.env.get_template(name)
+            self.load_time += time.perf_counter() - start
+        return template
+
+    def page_format(self, template, output_file):
+        """
+        Return the template and output file of a page in the format of the renderer.
+        """
+        if self.extension == ".md":
+            return template, output_file
+        return (template.replace(".md.j2", self.extension + ".j2"),
+                os.path.splitext(output_file)[0] + self.extension)
+
+    def input_hash(self, template, data):
+        """
+        Return a hash of everything a page is rendered from, the template source and the page data.
+        """
+        template_hash = self.template_hashes.get(template)
+        if template_hash is None:
+            source, _, _ = self.env.loader.get_source(self.env, template)
+            template_hash = self.template_hashes[template] = hashlib.sha256(source.encode('utf-8')).hexdigest()
+
+        page_data = json.dumps(data, sort_keys=True, default=str)
+
+        return hashlib.sha256((template_hash + page_data).encode('utf-8')).hexdigest()
+
+    def render(self, template, data):
+        """
+        Render the template with the data and return the content.
+        """
+        template = self.get_template(template)
+
+        start = time.perf_counter()
+        rendered_content = template.render(data)
+        self.render_time += time.perf_counter() - start
+        self.pages += 1
+
+        return rendered_content
+
+    def queue_page(self, template, data, output_file):
+        """
+        Queue a page to be rendered by render_queued(). A page queued twice is rendered once, from
+        the data it was last queued with, the same as the last write winning in a serial run.
+        """
+        self.queue.pop(output_file, None)
+        self.queue[output_file] = (template, data)
+
+    def render_queued(self):
+        """
+        Render and write the queued pages across a pool of worker processes.
+
+        Each worker has its own renderer with the same templates, and the pages are reported in the
+        order they were queued so the output and log match a serial run.
+        """
+        if not self.queue:
+            return
+
+        pages = [(template, data, output_file) for output_file, (template, data) in self.queue.items()]
+        self.queue = {}
+
+        start = time.perf_counter()
+
+        with ProcessPoolExecutor(max_workers=self.jobs,
+                                 initializer=configure_renderer,
+                                 initargs=(self.template_dir, self.bytecode_cache_dir)) as executor:
+            chunksize = max(1, len(pages) // (self.jobs * 4))
+            for output_file in executor.map(_render_page, pages, chunksize=chunksize):
+                print(f"File '{output_file}' has been created with the rendered content.")
+
+        self.render_time += time.perf_counter() - start
+        self.pages += len(pages)
+
+    def report(self):
+        """
+        Print the template load and render timings.
+        """
+        if self.jobs > 1:
+            print(f"\nRendered with {self.jobs} worker processes")
+        print(f"\nLoaded {len(self.templates)} templates in {self.load_time:.3f}s")
+        if self.pages:
+            print(f"Rendered {self.pages} pages in {self.render_time:.3f}s "
+                  f"({self.render_time / self.pages * 1000:.3f}ms per page)")
+
+
+_renderer = None
+
+
+def get_renderer():
+    """
+    Return the process wide TemplateRenderer, creating it with the default settings if needed.
+    """
+    global _renderer
+    if _renderer is None:
+        _renderer = TemplateRenderer()
+    return _renderer
+
+
+def configure_renderer(template_dir="templates", bytecode_cache_dir=None, manifest=None, jobs=1, extension=".md"):
+    """
+    Replace the process wide TemplateRenderer, e.g. to enable the bytecode cache or a PageManifest.
+    """
+    global _renderer
+    _renderer = TemplateRenderer(template_dir, bytecode_cache_dir, manifest, jobs, extension)
+    return _renderer
+
+
 def render_template(template, data, output_file):
     """
     Render the Jinja2 template and generate and output file.
+
+    If the renderer has a PageManifest and the page inputs have not changed since the last run the
+    page is neither rendered nor written. If the renderer has more than one job the page is queued
+    and written later by render_queued(). The page is rendered in the format of the renderer.
     """
-    env = Environment(loader=FileSystemLoader("templates"), trim_blocks=True, lstrip_blocks=True)
-    template = env.get_template(template)
+    renderer = get_renderer()
+    template, output_file = renderer.page_format(template, output_file)
+
+    if renderer.manifest is not None:
+        if not renderer.manifest.update(output_file, renderer.input_hash(template, data)):
+            return
+
+    if renderer.jobs > 1:
+        renderer.queue_page(template, data, output_file)
+        return
+
+    _render_page((template, data, output_file))
+
+    print(f"File '{output_file}' has been created with the rendered content.")
+
+
+def _render_page(page):
+    """
+    Render a page with the process wide renderer and write it. Also run in the worker processes.
+    """
+    template, data, output_file = page
 
     # Render the template with the data
-    rendered_content = template.render(data)
+    rendered_content = get_renderer().render(template, data)
 
     # Write the rendered content to a file
     with open(output_file, "wb") as file:
         file.write(rendered_content.encode('utf-8'))
 
-    print(f"File '{output_file}' has been created with the rendered content.")
+    return output_file
+
+
+class PageManifest:
+    """
+    Record of the pages generated in an output directory and the hash of their render inputs.
+
+    The manifest is saved in the output directory so the next run can skip pages whose inputs have
+    not changed and remove pages for elements that are no longer in the model.
+    """
+
+    FILE_NAME = ".manifest.json"
+
+    def __init__(self, output_dir, force=False):
+        self.output_dir = output_dir
+        self.force = force
+        self.path = os.path.join(output_dir, self.FILE_NAME)
+        self.previous = {}
+        self.pages = {}
+        self.added = []
+        self.changed = []
+        self.unchanged = []
+        self.removed = []
+
+        if os.path.isfile(self.path):
+            with open(self.path, encoding='utf-8') as file:
+                self.previous = json.load(file).get('pages', {})
+
+    def update(self, output_file, input_hash):
+        """
+        Record the input hash of a page and return True if the page needs to be written.
+        """
+        page = os.path.relpath(output_file, self.output_dir).replace(os.sep, '/')
+
+        # A page written more than once in a run is always written, the last one wins.
+        if page in self.pages:
+            self.pages[page] = input_hash
+            return True
+
+        self.pages[page] = input_hash
+        previous_hash = self.previous.get(page)
+
+        if previous_hash == input_hash and not self.force and os.path.isfile(output_file):
+            self.unchanged.append(page)
+            return False
+
+        if previous_hash is None:
+            self.added.append(page)
+        else:
+            self.changed.append(page)
+
+        return True
+
+    def save(self):
+        """
+        Remove the pages from the previous run that were not generated this time and save the
+        manifest.
+        """
+        for page in sorted(set(self.previous) - set(self.pages)):
+            output_file = os.path.join(self.output_dir, *page.split('/'))
+            if os.path.isfile(output_file):
+                os.remove(output_file)
+                print(f"File '{output_file}' has been removed.")
+            self.removed.append(page)
+
+            # Tidy up any directories left empty, e.g. for a removed class.
+            directory = os.path.dirname(output_file)
+            while directory != self.output_dir and os.path.isdir(directory) and not os.listdir(directory):
+                os.rmdir(directory)
+                directory = os.path.dirname(directory)
+
+        os.makedirs(self.output_dir, exist_ok=True)
+        with open(self.path, 'w', encoding='utf-8') as file:
+            json.dump({'version': 1, 'pages': self.pages}, file, indent=1, sort_keys=True)
+
+    def report(self):
+        """
+        Print a summary of the added, changed, unchanged and removed pages.
+        """
+        print(f"\nPages added: {len(self.added)}, changed: {len(self.changed)}, "
+              f"unchanged: {len(self.unchanged)}, removed: {len(self.removed)}")
+
+
+# ioctl request to clone a file on Linux filesystems that support reflinks, e.g. Btrfs and XFS.
+FICLONE = 0x40049409
+
+
+def file_hash(path):
+    """
+    Return the SHA-256 of a file.
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class ImageSync:
+    """
+    Sync of the images referenced by the generated pages into an output directory.
+
+    Only the images referenced by a page are synced. An image whose content hash matches the one
+    already in the output directory is skipped, and a new or changed image is reflinked or hard
+    linked to the source where the filesystem supports it and copied otherwise. The hash and stat
+    of each synced image are saved in the output directory, so an image whose source and copy are
+    both untouched since the last run is skipped without hashing it again. Images synced by an
+    earlier run that are no longer referenced are removed.
+    """
+
+    FILE_NAME = ".images.json"
+
+    def __init__(self, output_dir):
+        self.output_dir = output_dir
+        self.path = os.path.join(output_dir, self.FILE_NAME)
+        self.previous = {}
+        self.images = {}
+        self.synced = {}
+        self.copied = []
+        self.linked = []
+        self.skipped = []
+        self.removed = []
+        self.bytes_copied = 0
+        self.bytes_linked = 0
+        self.bytes_skipped = 0
+
+        if os.path.isfile(self.path):
+            with open(self.path, encoding='utf-8') as file:
+                self.previous = json.load(file).get('images', {})
+
+    def reference(self, source_file, output_file):
+        """
+        Record that a page references an image, to be synced from the source file.
+        """
+        image = os.path.relpath(output_file, self.output_dir).replace(os.sep, '/')
+        self.images[image] = source_file
+
+    def stat(self, path):
+        stat = os.stat(path)
+        return [stat.st_size, stat.st_mtime_ns]
+
+    def transfer(self, source_file, output_file):
+        # Never write into the existing file, which may be a hard link to an older source.
+        if os.path.lexists(output_file):
+            os.remove(output_file)
+
+        if fcntl is not None:
+            try:
+                with open(source_file, 'rb') as source, open(output_file, 'wb') as output:
+                    fcntl.ioctl(output.fileno(), FICLONE, source.fileno())
+                return 'linked'
+            except OSError:
+                os.remove(output_file)
+
+        try:
+            os.link(source_file, output_file)
+            return 'linked'
+        except OSError:
+            shutil.copyfile(source_file, output_file)
+            return 'copied'
+
+    def sync(self):
+        """
+        Sync the referenced images, remove the images that are no longer referenced and save the
+        hashes.
+        """
+        for image, source_file in sorted(self.images.items()):
+            output_file = os.path.join(self.output_dir, *image.split('/'))
+            source_stat = self.stat(source_file)
+            previous = self.previous.get(image)
+
+            if (previous and previous['source'] == source_stat and os.path.isfile(output_file)
+                    and previous['output'] == self.stat(output_file)):
+                self.synced[image] = previous
+                self.skipped.append(image)
+                self.bytes_skipped += source_stat[0]
+                continue
+
+            source_hash = file_hash(source_file)
+
+            if os.path.isfile(output_file) and file_hash(output_file) == source_hash:
+                self.skipped.append(image)
+                self.bytes_skipped += source_stat[0]
+            else:
+                os.makedirs(os.path.dirname(output_file), exist_ok=True)
+                if self.transfer(source_file, output_file) == 'linked':
+                    self.linked.append(image)
+                    self.bytes_linked += source_stat[0]
+                else:
+                    self.copied.append(image)
+                    self.bytes_copied += source_stat[0]
+                print(f"File '{output_file}' has been synced.")
+
+            self.synced[image] = {
+                'hash': source_hash,
+                'source': source_stat,
+                'output': self.stat(output_file),
+            }
+
+        for image in sorted(set(self.previous) - set(self.images)):
+            output_file = os.path.join(self.output_dir, *image.split('/'))
+            if os.path.isfile(output_file):
+                os.remove(output_file)
+                print(f"File '{output_file}' has been removed.")
+            self.removed.append(image)
+
+        os.makedirs(self.output_dir, exist_ok=True)
+        with open(self.path, 'w', encoding='utf-8') as file:
+            json.dump({'version': 1, 'images': self.synced}, file, indent=1, sort_keys=True)
+
+    def report(self):
+        """
+        Print a summary of the images and bytes copied, linked and skipped.
+        """
+        print(f"\nImages copied: {len(self.copied)} ({self.bytes_copied} bytes), "
+              f"linked: {len(self.linked)} ({self.bytes_linked} bytes), "
+              f"skipped: {len(self.skipped)} ({self.bytes_skipped} bytes), "
+              f"removed: {len(self.removed)}")
+
+
+# Change this whenever the image processing changes so old optimised images are not reused.
+OPTIMISER_VERSION = "1"
+
+IMAGE_EXTENSIONS = {'png': '.png', 'webp': '.webp'}
+
+
+class ImageOptimiser:
+    """
+    Optional stage that recompresses the diagram images before they are synced.
+
+    Each image is recompressed losslessly as PNG or converted to lossless WebP, scaled down to fit
+    max_size if set, and given a thumbnail that fits thumbnail_size if set. The results are cached
+    in cache_dir under a key of the source image hash and the settings, so each image is only
+    processed once for a given set of settings. The images that are not cached yet are processed
+    across a pool of worker processes when jobs is more than one.
+    """
+
+    def __init__(self, cache_dir=".image_cache", format='png', max_size=None, thumbnail_size=None, jobs=1):
+        if Image is None:
+            raise RuntimeError("Optimising the images needs Pillow, install it with 'pip install Pillow'.")
+
+        self.cache_dir = cache_dir
+        self.settings = {
+            'version': OPTIMISER_VERSION,
+            'format': format,
+            'max_size': max_size,
+            'thumbnail_size': thumbnail_size,
+        }
+        self.jobs = jobs if jobs > 0 else os.cpu_count()
+        self.extension = IMAGE_EXTENSIONS[format]
+        self.queue = {}
+        self.processed = []
+        self.cached = []
+        self.bytes_source = 0
+        self.bytes_optimised = 0
+
+    def key(self, source_file):
+        digest = hashlib.sha256(file_hash(source_file).encode('utf-8'))
+        digest.update(json.dumps(self.settings, sort_keys=True).encode('utf-8'))
+        return digest.hexdigest()[:32]
+
+    def add(self, source_file):
+        """
+        Queue an image and return the paths of its optimised image and thumbnail in the cache, the
+        thumbnail being None if there are no thumbnails.
+        """
+        key = self.key(source_file)
+        image_file = os.path.join(self.cache_dir, key + self.extension)
+        thumbnail_file = None
+        if self.settings['thumbnail_size']:
+            thumbnail_file = os.path.join(self.cache_dir, key + "-thumb" + self.extension)
+
+        self.queue[key] = (source_file, image_file, thumbnail_file, self.settings)
+
+        return image_file, thumbnail_file
+
+    def run(self):
+        """
+        Process the queued images that are not in the cache yet.
+        """
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+        jobs = []
+        for key, job in sorted(self.queue.items()):
+            source_file, image_file, thumbnail_file, _ = job
+            if os.path.isfile(image_file) and (thumbnail_file is None or os.path.isfile(thumbnail_file)):
+                self.cached.append(source_file)
+            else:
+                jobs.append(job)
+
+        if self.jobs > 1 and len(jobs) > 1:
+            with ProcessPoolExecutor(max_workers=self.jobs) as executor:
+                results = list(executor.map(_optimise_image, jobs))
+        else:
+            results = [_optimise_image(job) for job in jobs]
+
+        for job, (source_bytes, optimised_bytes) in zip(jobs, results):
+            self.processed.append(job[0])
+            self.bytes_source += source_bytes
+            self.bytes_optimised += optimised_bytes
+            print(f"File '{job[1]}' has been optimised.")
+
+    def report(self):
+        """
+        Print a summary of the images processed and taken from the cache.
+        """
+        print(f"\nImages optimised: {len(self.processed)} ({self.bytes_source} bytes to {self.bytes_optimised} bytes), "
+              f"cached: {len(self.cached)}")
+
+
+def _save_image(image, output_file, format):
+    # Save to a temporary file first so an interrupted run never leaves a partial image in the cache.
+    if format == 'webp':
+        image.save(output_file + ".tmp", format='WEBP', lossless=True, method=6)
+    else:
+        image.save(output_file + ".tmp", format='PNG', optimize=True)
+    os.replace(output_file + ".tmp", output_file)
+
+
+def _optimise_image(job):
+    """
+    Optimise an image and make its thumbnail, in a worker process, and return the size in bytes of
+    the source and of the optimised image.
+    """
+    source_file, image_file, thumbnail_file, settings = job
+
+    with Image.open(source_file) as image:
+        image.load()
+
+    if settings['max_size']:
+        image.thumbnail((settings['max_size'], settings['max_size']), Image.LANCZOS)
+    _save_image(image, image_file, settings['format'])
+
+    if thumbnail_file is not None:
+        image.thumbnail((settings['thumbnail_size'], settings['thumbnail_size']), Image.LANCZOS)
+        _save_image(image, thumbnail_file, settings['format'])
+
+    return os.path.getsize(source_file), os.path.getsize(image_file)
+
+
+class ModelIndex:
+    """
+    Lookup tables for an XMI document built in a single walk of the tree.
+
+    The packagedElement, ownedAttribute and ownedLiteral nodes are keyed by xmi:id and the
+    Enterprise Architect Extension element and attribute nodes are keyed by xmi:idref, so the
+    generators resolve an id in O(1) instead of searching the whole document each time.
+
+    With PackageRules the packages are walked top down and a package pruned by the rules is not
+    descended into, so nothing below it is indexed, nor are the Extension nodes that refer to it.
+    """
+
+    def __init__(self, root, ns=ns, rules=None):
+        self.packaged_elements = {}
+        self.owned_attributes = {}
+        self.owned_literals = {}
+        self.elements = {}
+        self.attributes = {}
+        self.types = {}
+
+        xmi_id = f"{{{ns['xmi']}}}id"
+        xmi_idref = f"{{{ns['xmi']}}}idref"
+        xmi_type = f"{{{ns['xmi']}}}type"
+
+        by_id = {
+            'packagedElement': self.packaged_elements,
+            'ownedAttribute': self.owned_attributes,
+            'ownedLiteral': self.owned_literals,
+        }
+        by_idref = {
+            'element': self.elements,
+            'attribute': self.attributes,
+        }
+
+        if rules is not None:
+            self.index_packages(root, rules, xmi_id, xmi_type)
+            nodes = root.iter(*by_idref)
+        else:
+            nodes = root.iter(*by_id, *by_idref)
+
+        for node in nodes:
+            if node.tag in by_id:
+                key = node.get(xmi_id)
+                if key is not None:
+                    # Keep the first match to behave the same as root.find().
+                    by_id[node.tag].setdefault(key, node)
+                if node.tag == 'packagedElement':
+                    self.types.setdefault(node.get(xmi_type), []).append(node)
+            else:
+                key = node.get(xmi_idref)
+                if key is not None and (rules is None or not rules.pruned or key in self.packaged_elements
+                                        or key in self.owned_attributes or key in self.owned_literals):
+                    by_idref[node.tag].setdefault(key, node)
+
+    def index_packages(self, root, rules, xmi_id, xmi_type):
+        # Walk the packagedElement top down in document order, skipping the pruned packages.
+        package_paths = PackagePaths()
+        stack = list(reversed(top_packaged_elements(root)))
+
+        while stack:
+            node = stack.pop()
+            if is_pruned(node, package_paths, rules):
+                continue
+
+            self.packaged_elements.setdefault(node.get(xmi_id), node)
+            self.types.setdefault(node.get(xmi_type), []).append(node)
+
+            children = []
+            for child in node:
+                if child.tag == 'ownedAttribute':
+                    self.owned_attributes.setdefault(child.get(xmi_id), child)
+                elif child.tag == 'ownedLiteral':
+                    self.owned_literals.setdefault(child.get(xmi_id), child)
+                elif child.tag == 'packagedElement':
+                    children.append(child)
+            stack.extend(reversed(children))
+
+    def packaged_elements_of_type(self, xmi_type):
+        """
+        Return all the packagedElement of an xmi:type in document order.
+        """
+        return self.types.get(xmi_type, [])
+
+
+def top_packaged_elements(root):
+    """
+    Return the packagedElement that are not inside another packagedElement, in document order.
+    """
+    return root.xpath('//packagedElement[not(parent::packagedElement)]')
+
+
+def is_pruned(node, package_paths, rules):
+    """
+    Return True if a node is a uml:Package pruned by the rules.
+    """
+    return node.get(XMI_TYPE) == 'uml:Package' and rules.prunes(package_paths.path_of(node))
 
 
 def generate_id_to_name_map(root, ns):
@@ -89,6 +914,485 @@ def generate_id_to_name_map(root, ns):
     return name_map
 
 
+XMI_ID = f"{{{ns['xmi']}}}id"
+XMI_IDREF = f"{{{ns['xmi']}}}idref"
+XMI_TYPE = f"{{{ns['xmi']}}}type"
+
+
+class LoadedModel:
+    """
+    The parts of an XMI model file used by the generators, extracted once and shared by all of them.
+
+    Every packagedElement is held as a plain dictionary keyed by xmi:id along with the Enterprise
+    Architect Extension element and attribute data keyed by xmi:idref. The tree and index are only
+    kept when the model was loaded with load_model() rather than streamed with stream_model().
+
+    Once domain.build_domain() has been run the classes, enumerations, data types and packages are
+    held as domain objects in domain, keyed by xmi:id, and the Extension records are released.
+    """
+
+    def __init__(self, model_file, tree=None, index=None):
+        self.model_file = model_file
+        self.tree = tree
+        self.root = tree.getroot() if tree is not None else None
+        self.index = index
+        self.elements = {}
+        self.types = {}
+        self.owned_attributes = {}
+        self.owned_literals = {}
+        self.extensions = {}
+        self.attributes = {}
+        self.diagrams = []
+        self.id_to_name_map = {}
+        self.domain = {}
+        self.timings = {}
+
+    def add_element(self, record, parent=None):
+        """
+        Add a packagedElement record, in document order, and link it to its parent record.
+        """
+        self.elements.setdefault(record['id'], record)
+        self.types.setdefault(record['type'], []).append(record)
+
+        if record['type'] in ['uml:Enumeration', 'uml:Package', 'uml:DataType', 'uml:Class']:
+            self.id_to_name_map[record['id']] = record['name']
+
+        if parent is not None:
+            parent['owned_elements'].append(record['id'])
+
+    def add_owned_attribute(self, record, attrib):
+        owned_attribute = {
+            'id': attrib.get(XMI_ID),
+            'type': attrib.get(XMI_TYPE),
+            'name': attrib.get('name'),
+            'association': attrib.get('association'),
+        }
+        record['attributes'].append(owned_attribute)
+        self.owned_attributes.setdefault(owned_attribute['id'], owned_attribute)
+
+    def add_owned_literal(self, record, attrib):
+        owned_literal = {
+            'id': attrib.get(XMI_ID),
+            'type': attrib.get(XMI_TYPE),
+            'name': attrib.get('name'),
+        }
+        record['literals'].append(owned_literal)
+        self.owned_literals.setdefault(owned_literal['id'], owned_literal)
+
+    def elements_of_type(self, xmi_type):
+        """
+        Return the records of all the packagedElement of an xmi:type in document order.
+        """
+        return self.types.get(xmi_type, [])
+
+    def domain_of_type(self, xmi_type):
+        """
+        Return the domain objects of an xmi:type in document order.
+        """
+        return [element for element in self.domain.values() if element.type == xmi_type]
+
+    def __getstate__(self):
+        # The lxml tree and index are not kept in a snapshot.
+        state = self.__dict__.copy()
+        state.update(tree=None, root=None, index=None, timings={})
+        return state
+
+
+def new_element_record(attrib, package_hierarchy):
+    """
+    Return the record of a packagedElement from its XML attributes.
+    """
+    return {
+        'id': attrib.get(XMI_ID),
+        'type': attrib.get(XMI_TYPE),
+        'name': attrib.get('name'),
+        'attrib': dict(attrib),
+        'package_hierarchy': package_hierarchy,
+        'owned_elements': [],
+        'attributes': [],
+        'literals': [],
+        'operations': [],
+        'generalizations': [],
+    }
+
+
+def new_extension_record():
+    """
+    Return an empty record for an Extension element.
+    """
+    return {
+        'properties': None,
+        'definition': None,
+        'links': None,
+    }
+
+
+def new_attribute_record(attrib):
+    """
+    Return the record of an Extension attribute from its XML attributes.
+    """
+    return {
+        'name': attrib.get('name'),
+        'scope': attrib.get('scope'),
+        'properties': None,
+        'bounds': None,
+        'definition': None,
+        'documentation': None,
+    }
+
+
+def get_definition(element):
+    """
+    Return the value of the definition tag of an Extension element or attribute.
+    """
+    tag = element.find('./tags/tag[@name="definition"]')
+    return tag.get('value') if tag is not None else None
+
+
+def extract_model(model, index, rules=None):
+    """
+    Fill a LoadedModel with the records of every packagedElement, Extension element and attribute
+    and diagram found through the ModelIndex, leaving out the packages pruned by the rules.
+    """
+    package_paths = PackagePaths()
+
+    def add(packaged_element, parent):
+        record = new_element_record(packaged_element.attrib, package_paths.path_of(packaged_element))
+        model.add_element(record, parent)
+
+        for child in packaged_element:
+            if child.tag == 'ownedAttribute':
+                model.add_owned_attribute(record, child.attrib)
+            elif child.tag == 'ownedLiteral':
+                model.add_owned_literal(record, child.attrib)
+            elif child.tag == 'ownedOperation':
+                record['operations'].append(child.get('name'))
+            elif child.tag == 'generalization':
+                record['generalizations'].append({'id': child.get(XMI_ID), 'general': child.get('general')})
+
+        for child in packaged_element.iterchildren('packagedElement'):
+            if rules is None or not is_pruned(child, package_paths, rules):
+                add(child, record)
+
+    for packaged_element in top_packaged_elements(model.root):
+        if rules is None or not is_pruned(packaged_element, package_paths, rules):
+            add(packaged_element, None)
+
+    for idref, element in index.elements.items():
+        extension = new_extension_record()
+
+        properties = element.find('properties')
+        if properties is not None:
+            extension['properties'] = dict(properties.attrib)
+
+        extension['definition'] = get_definition(element)
+
+        links = element.find('links')
+        if links is not None:
+            extension['links'] = [{'type': link.tag, 'start': link.get('start'), 'end': link.get('end')}
+                                  for link in links if isinstance(link.tag, str)]
+
+        model.extensions[idref] = extension
+
+    for idref, attribute in index.attributes.items():
+        attr = new_attribute_record(attribute.attrib)
+
+        properties = attribute.find('properties')
+        if properties is not None:
+            attr['properties'] = dict(properties.attrib)
+
+        bounds = attribute.find('bounds')
+        if bounds is not None:
+            attr['bounds'] = {'lower': bounds.get('lower'), 'upper': bounds.get('upper')}
+
+        documentation = attribute.find('documentation')
+        if documentation is not None:
+            attr['documentation'] = documentation.get('value')
+
+        attr['definition'] = get_definition(attribute)
+
+        model.attributes[idref] = attr
+
+    for diagram in model.root.iter('diagram'):
+        properties = diagram.find('properties')
+        model.diagrams.append({
+            'id': diagram.get(XMI_ID),
+            'name': properties.get('name') if properties is not None else None,
+        })
+
+    return model
+
+
+def load_model(model_file, ns=ns, rules=None):
+    """
+    Parse the XMI model file, build the ModelIndex and extract the model records, reporting the time
+    taken by each phase. The packages pruned by the rules, by default the rules from get_rules(),
+    are left out.
+    """
+    rules = rules or get_rules()
+
+    start = time.perf_counter()
+    tree = ET.parse(model_file)
+    parse_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    index = ModelIndex(tree.getroot(), ns, rules)
+    index_time = time.perf_counter() - start
+
+    model = LoadedModel(model_file, tree, index)
+    model.timings['parse'] = parse_time
+    model.timings['index'] = index_time
+
+    start = time.perf_counter()
+    extract_model(model, index, rules)
+    model.timings['extract'] = time.perf_counter() - start
+
+    report_load(model)
+
+    return model
+
+
+def stream_model(model_file, rules=None):
+    """
+    Stream the XMI model file with iterparse, keeping only the records used by the generators.
+
+    Each element is cleared and removed from the partial tree once it has been read, so peak memory
+    depends on the size of the extracted records and not on the size of the XMI document. Nothing
+    is recorded for the packages pruned by the rules, by default the rules from get_rules(), or for
+    the Extension nodes that refer to them.
+    """
+    rules = rules or get_rules()
+    model = LoadedModel(model_file)
+
+    start = time.perf_counter()
+
+    path = []               # Tags of the open elements.
+    packages = []           # Records of the open packagedElement.
+    hierarchy = []          # Names of the open uml:Package.
+    package_path = ()       # Package path of the open packagedElement, shared by all its children.
+    extension = None        # Record of the open Extension element.
+    attribute = None        # Record of the open Extension attribute.
+    diagram = None          # Record of the open diagram.
+    links = None            # Links of the open Extension element.
+    found = set()           # (record id, field) already set from the first matching child.
+    pruned = 0              # Depth inside a pruned package, 0 when not in one.
+
+    def is_kept(idref):
+        # The Extension section comes after the packagedElement, so the pruned ids are known.
+        return (not rules.pruned or idref in model.elements
+                or idref in model.owned_attributes or idref in model.owned_literals)
+
+    def release(node):
+        # Release the element and any siblings already processed.
+        node.clear()
+        while node.getprevious() is not None:
+            del node.getparent()[0]
+
+    def first(record, field, value):
+        # Only the first matching child is used, the same as element.find().
+        if (id(record), field) not in found:
+            record[field] = value
+            found.add((id(record), field))
+
+    for event, node in ET.iterparse(model_file, events=('start', 'end')):
+        tag = node.tag
+
+        if event == 'start':
+            if pruned:
+                pruned += 1
+                continue
+            if (tag == 'packagedElement' and node.get(XMI_TYPE) == 'uml:Package'
+                    and rules.prunes(tuple(hierarchy) + (node.get('name'),))):
+                pruned = 1
+                continue
+
+            parent = path[-1] if path else None
+            owner = path[-2] if len(path) > 1 else None
+            path.append(tag)
+
+            if tag == 'packagedElement':
+                if node.get(XMI_TYPE) == 'uml:Package':
+                    hierarchy.append(node.get('name'))
+                    package_path = tuple(hierarchy)
+                record = new_element_record(node.attrib, package_path)
+                model.add_element(record, packages[-1] if packages else None)
+                packages.append(record)
+
+            elif parent == 'packagedElement' and packages:
+                if tag == 'ownedAttribute':
+                    model.add_owned_attribute(packages[-1], node.attrib)
+                elif tag == 'ownedLiteral':
+                    model.add_owned_literal(packages[-1], node.attrib)
+                elif tag == 'ownedOperation':
+                    packages[-1]['operations'].append(node.get('name'))
+                elif tag == 'generalization':
+                    packages[-1]['generalizations'].append({'id': node.get(XMI_ID),
+                                                            'general': node.get('general')})
+
+            elif tag == 'element' and node.get(XMI_IDREF) is not None:
+                extension = None
+                if node.get(XMI_IDREF) not in model.extensions and is_kept(node.get(XMI_IDREF)):
+                    extension = new_extension_record()
+                    model.extensions[node.get(XMI_IDREF)] = extension
+
+            elif tag == 'attribute' and node.get(XMI_IDREF) is not None:
+                attribute = None
+                if node.get(XMI_IDREF) not in model.attributes and is_kept(node.get(XMI_IDREF)):
+                    attribute = new_attribute_record(node.attrib)
+                    model.attributes[node.get(XMI_IDREF)] = attribute
+
+            elif tag == 'diagram':
+                diagram = {'id': node.get(XMI_ID), 'name': None}
+                model.diagrams.append(diagram)
+
+            elif parent == 'element' and extension is not None:
+                if tag == 'properties' and extension['properties'] is None:
+                    extension['properties'] = dict(node.attrib)
+                elif tag == 'links' and extension['links'] is None:
+                    extension['links'] = links = []
+
+            elif parent == 'links' and owner == 'element' and links is not None:
+                links.append({'type': tag, 'start': node.get('start'), 'end': node.get('end')})
+
+            elif parent == 'attribute' and attribute is not None:
+                if tag == 'properties' and attribute['properties'] is None:
+                    attribute['properties'] = dict(node.attrib)
+                elif tag == 'bounds' and attribute['bounds'] is None:
+                    attribute['bounds'] = {'lower': node.get('lower'), 'upper': node.get('upper')}
+                elif tag == 'documentation':
+                    first(attribute, 'documentation', node.get('value'))
+
+            elif parent == 'diagram' and tag == 'properties' and diagram is not None:
+                first(diagram, 'name', node.get('name'))
+
+            elif tag == 'tag' and parent == 'tags' and node.get('name') == 'definition':
+                if owner == 'element' and extension is not None:
+                    first(extension, 'definition', node.get('value'))
+                elif owner == 'attribute' and attribute is not None:
+                    first(attribute, 'definition', node.get('value'))
+
+        elif pruned:
+            pruned -= 1
+            release(node)
+
+        else:
+            path.pop()
+
+            if tag == 'packagedElement':
+                if packages.pop()['type'] == 'uml:Package':
+                    hierarchy.pop()
+                    package_path = tuple(hierarchy)
+            elif tag == 'element' and node.get(XMI_IDREF) is not None:
+                extension = None
+            elif tag == 'attribute' and node.get(XMI_IDREF) is not None:
+                attribute = None
+            elif tag == 'diagram':
+                diagram = None
+            elif tag == 'links':
+                links = None
+
+            release(node)
+
+    model.timings['stream'] = time.perf_counter() - start
+
+    report_load(model)
+
+    return model
+
+
+# Change this whenever the records or the domain classes change so old snapshots are not loaded.
+EXTRACTOR_VERSION = "3"
+
+
+class ModelSnapshotCache:
+    """
+    On-disk cache of extracted models, so a run with an unchanged XMI file loads a pickled snapshot
+    instead of parsing and extracting the model again.
+
+    A snapshot is keyed on the SHA-256 of the XMI file, EXTRACTOR_VERSION and the fingerprint of the
+    PackageRules, as the packages pruned by the rules are not in the snapshot. The snapshots of older
+    versions of the same XMI file are removed when a new one is saved.
+    """
+
+    def __init__(self, cache_dir=".model_cache"):
+        self.cache_dir = cache_dir
+
+    def key(self, model_file):
+        digest = hashlib.sha256(EXTRACTOR_VERSION.encode('utf-8'))
+        digest.update(get_rules().fingerprint.encode('utf-8'))
+        with open(model_file, 'rb') as file:
+            for chunk in iter(lambda: file.read(1024 * 1024), b''):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    def prefix(self, model_file):
+        return os.path.splitext(os.path.basename(model_file))[0] + "-"
+
+    def path(self, model_file, key):
+        return os.path.join(self.cache_dir, self.prefix(model_file) + key[:32] + ".pickle")
+
+    def load(self, model_file):
+        """
+        Return the snapshot of the model file, or None if there is no snapshot of its current content.
+        """
+        start = time.perf_counter()
+
+        key = self.key(model_file)
+        path = self.path(model_file, key)
+        if not os.path.isfile(path):
+            return None
+
+        try:
+            with open(path, 'rb') as file:
+                model = pickle.load(file)
+        except Exception as e:
+            print(f"Ignoring model snapshot '{path}': {e}")
+            return None
+
+        model.model_file = model_file
+        model.timings['snapshot'] = time.perf_counter() - start
+
+        report_load(model)
+        print(f"\nLoaded model snapshot '{path}'")
+
+        return model
+
+    def save(self, model):
+        """
+        Save a snapshot of the model and remove the snapshots of older versions of the model file.
+        """
+        key = self.key(model.model_file)
+        path = self.path(model.model_file, key)
+        prefix = self.prefix(model.model_file)
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+        for name in os.listdir(self.cache_dir):
+            if name.startswith(prefix) and name.endswith(".pickle"):
+                os.remove(os.path.join(self.cache_dir, name))
+
+        # Write to a temporary file first so an interrupted run never leaves a partial snapshot.
+        with open(path + ".tmp", 'wb') as file:
+            pickle.dump(model, file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(path + ".tmp", path)
+
+        print(f"\nSaved model snapshot '{path}'")
+
+
+def report_load(model):
+    """
+    Print the time taken by each phase of loading the model and the packages pruned by the rules.
+    """
+    print(f"\nLoaded model '{model.model_file}'\n")
+    for phase, seconds in model.timings.items():
+        print(f"{phase:20} {seconds:8.3f}s")
+
+    pruned = get_rules().pruned
+    if pruned:
+        print(f"\nPruned {len(pruned)} packages:")
+        for package_path in sorted(pruned):
+            print(f"    {'/'.join(package_path)}")
+
+
 def backup_and_clean_output(output_dir):
     """
     If the output directory exists then create a backup appending a date and timestamp to the end. 
@@ -0,0 +1,318 @@
+"""
+Compact domain model of the Sparx Enterprise Architect elements documented by the generators.
+
+The classes use __slots__ so each element costs a fixed handful of references instead of a per
+instance dictionary, and the ids, names and types are interned so the same string is shared by
+every element and lookup table that refers to it. The Enterprise Architect properties of an
+element are kept as a dictionary so any property is found in O(1).
+
+The objects are built either from the records of a LoadedModel with build_domain(), or straight
+from the XMI nodes with the *_from_xml() functions.
+"""
+
+import sys
+import time
+
+from common import XMI_ID, XMI_TYPE, get_definition
+
+
+DOMAIN_TYPES = ['uml:Class', 'uml:Enumeration', 'uml:DataType', 'uml:Package']
+
+
+def intern(value):
+    """
+    Intern a string, passing None through.
+    """
+    return sys.intern(value) if value is not None else None
+
+
+def intern_properties(properties):
+    """
+    Return a dictionary of Enterprise Architect properties with interned names.
+    """
+    if not properties:
+        return {}
+    return {sys.intern(name): value for name, value in properties.items()}
+
+
+class ModelElement:
+    """
+    Base of every element, with its Enterprise Architect properties, definition and documentation.
+    """
+
+    __slots__ = ('id', 'name', 'type', 'properties', 'definition', 'documentation')
+
+    def __init__(self, id, name, type, properties=None, definition=None, documentation=None):
+        self.id = intern(id)
+        self.name = intern(name)
+        self.type = intern(type)
+        self.properties = intern_properties(properties)
+        self.definition = definition
+        self.documentation = documentation
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}({self.id!r}, {self.name!r})"
+
+
+class ModelFeature(ModelElement):
+    """
+    Base of the attributes and literals owned by a class or enumeration.
+    """
+
+    __slots__ = ('scope', 'lower', 'upper')
+
+    def __init__(self, id, name, type, scope=None, lower=None, upper=None, **kwargs):
+        super().__init__(id, name, type, **kwargs)
+        self.scope = intern(scope)
+        self.lower = intern(lower)
+        self.upper = intern(upper)
+
+    @property
+    def bounds(self):
+        return f"{self.lower}..{self.upper}"
+
+
+class ModelAttribute(ModelFeature):
+    """
+    An ownedAttribute of a class. Associations are also ownedAttribute and have the association id.
+    """
+
+    __slots__ = ('association',)
+
+    def __init__(self, id, name, type, association=None, **kwargs):
+        super().__init__(id, name, type, **kwargs)
+        self.association = intern(association)
+
+    @property
+    def data_type(self):
+        return self.properties.get('type')
+
+
+class ModelLiteral(ModelFeature):
+    """
+    An ownedLiteral of an enumeration.
+    """
+
+    __slots__ = ()
+
+
+class ModelClassifier(ModelElement):
+    """
+    Base of the packaged elements, with the package path and the Enterprise Architect links.
+
+    The links are (type, start, end) tuples, or None if the element has no links element.
+    """
+
+    __slots__ = ('package_path', 'links', 'generalizations')
+
+    def __init__(self, id, name, type, package_path=(), links=None, generalizations=(), **kwargs):
+        super().__init__(id, name, type, **kwargs)
+        self.package_path = tuple(intern(name) for name in package_path)
+        self.links = links
+        self.generalizations = [intern(general) for general in generalizations]
+
+    def links_of_type(self, link_type):
+        return [link for link in self.links or [] if link[0] == link_type]
+
+
+class ModelClass(ModelClassifier):
+    """
+    A uml:Class with its attributes and operation names.
+    """
+
+    __slots__ = ('attributes', 'operations')
+
+    def __init__(self, id, name, type, attributes=(), operations=(), **kwargs):
+        super().__init__(id, name, type, **kwargs)
+        self.attributes = list(attributes)
+        self.operations = [intern(operation) for operation in operations]
+
+
+class ModelEnumeration(ModelClassifier):
+    """
+    A uml:Enumeration with its literals.
+    """
+
+    __slots__ = ('literals',)
+
+    def __init__(self, id, name, type, literals=(), **kwargs):
+        super().__init__(id, name, type, **kwargs)
+        self.literals = list(literals)
+
+
+class ModelDataType(ModelClassifier):
+    """
+    A uml:DataType.
+    """
+
+    __slots__ = ()
+
+
+class ModelPackage(ModelClassifier):
+    """
+    A uml:Package with the ids of the packagedElement it owns.
+    """
+
+    __slots__ = ('owned_elements',)
+
+    def __init__(self, id, name, type, owned_elements=(), **kwargs):
+        super().__init__(id, name, type, **kwargs)
+        self.owned_elements = [intern(owned) for owned in owned_elements]
+
+
+DOMAIN_CLASSES = {
+    'uml:Class': ModelClass,
+    'uml:Enumeration': ModelEnumeration,
+    'uml:DataType': ModelDataType,
+    'uml:Package': ModelPackage,
+}
+
+
+###################################################################################################
+##  Build the domain model from the records of a LoadedModel.                                    ##
+###################################################################################################
+
+def feature_from_record(cls, owned, attribute, **kwargs):
+    """
+    Return a ModelAttribute or ModelLiteral from its ownedAttribute or ownedLiteral record and its
+    Extension attribute record.
+    """
+    attribute = attribute or {}
+    bounds = attribute.get('bounds') or {}
+
+    return cls(owned['id'],
+               attribute.get('name'),
+               owned['type'],
+               scope=attribute.get('scope'),
+               lower=bounds.get('lower'),
+               upper=bounds.get('upper'),
+               properties=attribute.get('properties'),
+               definition=attribute.get('definition'),
+               documentation=attribute.get('documentation'),
+               **kwargs)
+
+
+def element_from_record(record, extension, model):
+    """
+    Return the domain object of a packagedElement record and its Extension element record.
+    """
+    extension = extension or {}
+    links = extension.get('links')
+
+    kwargs = {
+        'package_path': record['package_hierarchy'],
+        'links': [(link['type'], link['start'], link['end']) for link in links] if links is not None else None,
+        'generalizations': [generalization['general'] for generalization in record['generalizations']],
+        'properties': extension.get('properties'),
+        'definition': extension.get('definition'),
+    }
+
+    if record['type'] == 'uml:Class':
+        kwargs['attributes'] = [feature_from_record(ModelAttribute, owned, model.attributes.get(owned['id']),
+                                                    association=owned['association'])
+                                for owned in record['attributes']]
+        kwargs['operations'] = record['operations']
+    elif record['type'] == 'uml:Enumeration':
+        kwargs['literals'] = [feature_from_record(ModelLiteral, owned, model.attributes.get(owned['id']))
+                              for owned in record['literals']]
+    elif record['type'] == 'uml:Package':
+        kwargs['owned_elements'] = record['owned_elements']
+
+    return DOMAIN_CLASSES[record['type']](record['id'], record['name'], record['type'], **kwargs)
+
+
+def build_domain(model):
+    """
+    Build the domain objects of every class, enumeration, data type and package of a LoadedModel,
+    keyed by xmi:id and in document order for each type.
+
+    The Extension element and attribute records and the ownedAttribute and ownedLiteral records are
+    folded into the domain objects and released afterwards, as they are the bulk of a large model.
+    """
+    start = time.perf_counter()
+
+    for xmi_type in DOMAIN_TYPES:
+        for record in model.elements_of_type(xmi_type):
+            if record['id'] not in model.domain:
+                model.domain[record['id']] = element_from_record(record, model.extensions.get(record['id']), model)
+            record['attributes'] = []
+            record['literals'] = []
+
+    model.extensions = {}
+    model.attributes = {}
+    model.owned_attributes = {}
+    model.owned_literals = {}
+
+    model.timings['domain'] = time.perf_counter() - start
+
+    return model
+
+
+###################################################################################################
+##  Build the domain objects straight from the XMI nodes.                                        ##
+###################################################################################################
+
+def get_properties(node):
+    properties = node.find('properties')
+    return dict(properties.attrib) if properties is not None else None
+
+
+def feature_from_xml(cls, owned, attribute, **kwargs):
+    """
+    Return a ModelAttribute or ModelLiteral from its ownedAttribute or ownedLiteral node and its
+    Extension attribute node.
+    """
+    bounds = attribute.find('bounds')
+    documentation = attribute.find('documentation')
+
+    return cls(owned.get(XMI_ID),
+               attribute.get('name'),
+               owned.get(XMI_TYPE),
+               scope=attribute.get('scope'),
+               lower=bounds.get('lower') if bounds is not None else None,
+               upper=bounds.get('upper') if bounds is not None else None,
+               properties=get_properties(attribute),
+               definition=get_definition(attribute),
+               documentation=documentation.get('value') if documentation is not None else None,
+               **kwargs)
+
+
+def attribute_from_xml(owned_attribute, attribute):
+    return feature_from_xml(ModelAttribute, owned_attribute, attribute,
+                            association=owned_attribute.get('association'))
+
+
+def literal_from_xml(owned_literal, literal):
+    return feature_from_xml(ModelLiteral, owned_literal, literal)
+
+
+def element_from_xml(packaged_element, element, package_path=(), attributes=(), literals=()):
+    """
+    Return the domain object of a packagedElement node and its Extension element node, with the
+    attributes or literals already built from their nodes.
+    """
+    xmi_type = packaged_element.get(XMI_TYPE)
+
+    links = None
+    if element is not None and element.find('links') is not None:
+        links = [(link.tag, link.get('start'), link.get('end'))
+                 for link in element.find('links') if isinstance(link.tag, str)]
+
+    kwargs = {
+        'package_path': package_path,
+        'links': links,
+        'generalizations': [generalization.get('general')
+                            for generalization in packaged_element.findall('generalization')],
+        'properties': get_properties(element) if element is not None else None,
+        'definition': get_definition(element) if element is not None else None,
+    }
+
+    if xmi_type == 'uml:Class':
+        kwargs['attributes'] = attributes
+        kwargs['operations'] = [operation.get('name') for operation in packaged_element.findall('ownedOperation')]
+    elif xmi_type == 'uml:Enumeration':
+        kwargs['literals'] = literals
+    elif xmi_type == 'uml:Package':
+        kwargs['owned_elements'] = [owned.get(XMI_ID) for owned in packaged_element.findall('packagedElement')]
+
+    return DOMAIN_CLASSES[xmi_type](packaged_element.get(XMI_ID), packaged_element.get('name'), xmi_type, **kwargs)
@@ -0,0 +1,147 @@
+"""
+Mermaid class diagrams of the model, embedded in the class pages of process_model.py and the
+package pages of process_model_hierarchy.py as a lightweight alternative to the diagram images
+exported by Sparx Enterprise Architect.
+
+The diagrams are built from a LinkIndex, an adjacency index of the Association and Generalization
+links between the classifiers that is built once from the domain objects, so generating the
+diagram of a page never scans the model.
+"""
+
+import re
+
+
+CLASSIFIER_TYPES = ['uml:Class', 'uml:Enumeration', 'uml:DataType']
+
+LINK_TYPES = ['Association', 'Generalization']
+
+STEREOTYPES = {'uml:Enumeration': 'enumeration', 'uml:DataType': 'datatype'}
+
+VISIBILITY = {'Public': '+', 'Private': '-', 'Protected': '#', 'Package': '~'}
+
+
+class LinkIndex:
+    """
+    Adjacency index of the links between the classifiers of a model, keyed by xmi:id.
+
+    The edges are (type, start, end) tuples, where a Generalization goes from the specific element
+    to the general one. They come from the Association and Generalization links of the Extension
+    elements and from the generalization elements, and each edge is only kept once even though
+    Enterprise Architect lists a link on both of its ends.
+    """
+
+    def __init__(self, elements):
+        self.elements = {element.id: element for element in elements if element.type in CLASSIFIER_TYPES}
+        self.edges = {element_id: [] for element_id in self.elements}
+        self.seen = set()
+
+        for element in self.elements.values():
+            for link_type, start, end in element.links or []:
+                if link_type in LINK_TYPES:
+                    self.add(link_type, start, end)
+            for general in element.generalizations:
+                self.add('Generalization', element.id, general)
+
+    def add(self, link_type, start, end):
+        edge = (link_type, start, end)
+        # Links to elements that are not documented, e.g. in a skipped package, are left out.
+        if edge in self.seen or start not in self.elements or end not in self.elements:
+            return
+        self.seen.add(edge)
+        self.edges[start].append(edge)
+        if end != start:
+            self.edges[end].append(edge)
+
+    def neighbours(self, element_id):
+        """
+        Return the ids of the elements linked to an element, in the order of its edges.
+        """
+        neighbours = {}
+        for _, start, end in self.edges.get(element_id, []):
+            neighbours.setdefault(end if start == element_id else start, None)
+        neighbours.pop(element_id, None)
+        return list(neighbours)
+
+
+def node_name(name):
+    """
+    Return a Mermaid class name for an element name, which may only have word characters.
+    """
+    return re.sub(r'\W', '_', name or '') or '_'
+
+
+def class_diagram(index, element_ids, members=()):
+    """
+    Return the Mermaid classDiagram of the elements and the links between them, with the
+    attributes of the elements whose ids are in members.
+    """
+    element_ids = [element_id for element_id in element_ids if element_id in index.elements]
+    lines = ["classDiagram"]
+
+    # Give each element a unique class name, as different elements can have the same name.
+    nodes = {}
+    used = set()
+    for element_id in element_ids:
+        base = node = node_name(index.elements[element_id].name)
+        count = 1
+        while node in used:
+            count += 1
+            node = f"{base}_{count}"
+        used.add(node)
+        nodes[element_id] = node
+
+    for element_id in element_ids:
+        element = index.elements[element_id]
+        node = nodes[element_id]
+        label = f'["{element.name}"]' if node != element.name else ""
+
+        body = []
+        if element.type in STEREOTYPES:
+            body.append(f"<<{STEREOTYPES[element.type]}>>")
+        if element_id in members and element.type == 'uml:Class':
+            for attribute in element.attributes:
+                if not attribute.association:
+                    visibility = VISIBILITY.get(attribute.scope, "")
+                    data_type = f" : {node_name(attribute.data_type)}" if attribute.data_type else ""
+                    body.append(f"{visibility}{node_name(attribute.name)}{data_type}")
+
+        if body:
+            lines.append(f"    class {node}{label} {{")
+            lines.extend(f"        {line}" for line in body)
+            lines.append("    }")
+        else:
+            lines.append(f"    class {node}{label}")
+
+    drawn = set()
+    for element_id in element_ids:
+        for edge in index.edges[element_id]:
+            link_type, start, end = edge
+            if edge in drawn or start not in nodes or end not in nodes:
+                continue
+            drawn.add(edge)
+            if link_type == 'Generalization':
+                lines.append(f"    {nodes[end]} <|-- {nodes[start]}")
+            else:
+                lines.append(f"    {nodes[start]} --> {nodes[end]}")
+
+    return "\n".join(lines)
+
+
+def element_diagram(index, element_id):
+    """
+    Return the Mermaid classDiagram of an element, with its attributes, and the elements linked to it.
+    """
+    if element_id not in index.elements:
+        return None
+    return class_diagram(index, [element_id] + index.neighbours(element_id), members=[element_id])
+
+
+def package_diagram(index, package):
+    """
+    Return the Mermaid classDiagram of the classifiers owned by a package and the links between
+    them, or None if it owns none.
+    """
+    element_ids = [owned for owned in package.owned_elements if owned in index.elements]
+    if not element_ids:
+        return None
+    return class_diagram(index, element_ids)
@@ -0,0 +1,376 @@
+"""
+SQLite store of an extracted model, for querying the model without parsing the XMI file again.
+
+The store has a table each for the packages, elements, attributes, literals, connectors, tags and
+diagrams of the model, keyed by xmi:id and indexed on parent/child and type, so questions such as
+"all attributes of type X" are a single indexed query. The generators can also be run from the
+store with process_model.py --store, which loads the model back with load_model_store(). The store
+records the fingerprint of the skip and include rules it was built with, and is only loaded with
+the same rules.
+
+Build a store and query it with e.g.
+
+    python model_store.py --db model.db
+    python model_store.py --db model.db --sql "SELECT name, element_id FROM attributes WHERE data_type = 'String'"
+"""
+
+import argparse
+import json
+import os
+import sqlite3
+import time
+
+from common import LoadedModel, RULES_FILE, configure_rules, get_rules, load_model, stream_model, report_load
+from domain import DOMAIN_CLASSES, ModelAttribute, ModelLiteral, build_domain
+
+
+SCHEMA = """
+CREATE TABLE packages (
+    id TEXT PRIMARY KEY,
+    name TEXT,
+    parent_id TEXT,
+    path TEXT
+);
+CREATE TABLE elements (
+    id TEXT PRIMARY KEY,
+    position INTEGER,
+    type TEXT,
+    name TEXT,
+    parent_id TEXT,
+    package_id TEXT,
+    package_path TEXT,
+    definition TEXT,
+    properties TEXT,
+    attrib TEXT,
+    has_links INTEGER
+);
+CREATE TABLE attributes (
+    id TEXT PRIMARY KEY,
+    element_id TEXT,
+    position INTEGER,
+    name TEXT,
+    type TEXT,
+    data_type TEXT,
+    scope TEXT,
+    lower TEXT,
+    upper TEXT,
+    association TEXT,
+    definition TEXT,
+    documentation TEXT,
+    properties TEXT
+);
+CREATE TABLE literals (
+    id TEXT PRIMARY KEY,
+    element_id TEXT,
+    position INTEGER,
+    name TEXT,
+    type TEXT,
+    scope TEXT,
+    lower TEXT,
+    upper TEXT,
+    definition TEXT,
+    documentation TEXT,
+    properties TEXT
+);
+CREATE TABLE operations (
+    element_id TEXT,
+    position INTEGER,
+    name TEXT
+);
+CREATE TABLE generalizations (
+    element_id TEXT,
+    position INTEGER,
+    id TEXT,
+    general_id TEXT
+);
+CREATE TABLE connectors (
+    element_id TEXT,
+    position INTEGER,
+    type TEXT,
+    start_id TEXT,
+    end_id TEXT
+);
+CREATE TABLE tags (
+    element_id TEXT,
+    name TEXT,
+    value TEXT
+);
+CREATE TABLE diagrams (
+    id TEXT,
+    position INTEGER,
+    name TEXT
+);
+CREATE TABLE metadata (
+    name TEXT PRIMARY KEY,
+    value TEXT
+);
+
+CREATE INDEX packages_parent ON packages (parent_id);
+CREATE INDEX elements_parent ON elements (parent_id);
+CREATE INDEX elements_package ON elements (package_id);
+CREATE INDEX elements_type ON elements (type);
+CREATE INDEX elements_name ON elements (name);
+CREATE INDEX attributes_element ON attributes (element_id);
+CREATE INDEX attributes_data_type ON attributes (data_type);
+CREATE INDEX literals_element ON literals (element_id);
+CREATE INDEX operations_element ON operations (element_id);
+CREATE INDEX generalizations_element ON generalizations (element_id);
+CREATE INDEX generalizations_general ON generalizations (general_id);
+CREATE INDEX connectors_element ON connectors (element_id);
+CREATE INDEX connectors_type ON connectors (type);
+CREATE INDEX connectors_start ON connectors (start_id);
+CREATE INDEX connectors_end ON connectors (end_id);
+CREATE INDEX tags_element ON tags (element_id);
+CREATE INDEX tags_name ON tags (name);
+"""
+
+
+def to_json(value):
+    return json.dumps(value) if value is not None else None
+
+
+def from_json(value):
+    return json.loads(value) if value is not None else None
+
+
+def save_model_store(model, db_path):
+    """
+    Write a LoadedModel, with its domain objects built, to a new SQLite store.
+    """
+    start = time.perf_counter()
+
+    if os.path.exists(db_path):
+        os.remove(db_path)
+
+    connection = sqlite3.connect(db_path)
+    connection.executescript(SCHEMA)
+
+    packages = []
+    elements = []
+    attributes = []
+    literals = []
+    operations = []
+    generalizations = []
+    connectors = []
+    tags = []
+
+    ###############################################################################
+    ##  Find the parent of every element from the owned elements of its parent.  ##
+    ###############################################################################
+
+    parents = {}
+    for record in model.elements.values():
+        for owned_id in record['owned_elements']:
+            parents.setdefault(owned_id, record['id'])
+
+    def package_of(element_id):
+        parent_id = parents.get(element_id)
+        while parent_id is not None and model.elements[parent_id]['type'] != 'uml:Package':
+            parent_id = parents.get(parent_id)
+        return parent_id
+
+    for position, record in enumerate(model.elements.values()):
+        element = model.domain.get(record['id'])
+
+        if record['type'] == 'uml:Package':
+            packages.append((record['id'], record['name'], package_of(record['id']),
+                             "/".join(record['package_hierarchy'])))
+
+        elements.append((record['id'], position, record['type'], record['name'],
+                         parents.get(record['id']), package_of(record['id']),
+                         to_json(record['package_hierarchy']),
+                         element.definition if element is not None else None,
+                         to_json(element.properties) if element is not None else None,
+                         to_json(record['attrib']),
+                         int(element is not None and element.links is not None)))
+
+        for index, generalization in enumerate(record['generalizations']):
+            generalizations.append((record['id'], index, generalization['id'], generalization['general']))
+
+        if element is None:
+            continue
+
+        if element.definition is not None:
+            tags.append((element.id, 'definition', element.definition))
+
+        for index, (link_type, start_id, end_id) in enumerate(element.links or []):
+            connectors.append((element.id, index, link_type, start_id, end_id))
+
+        for index, attribute in enumerate(getattr(element, 'attributes', [])):
+            attributes.append((attribute.id, element.id, index, attribute.name, attribute.type,
+                               attribute.data_type, attribute.scope, attribute.lower, attribute.upper,
+                               attribute.association, attribute.definition, attribute.documentation,
+                               to_json(attribute.properties)))
+            if attribute.definition is not None:
+                tags.append((attribute.id, 'definition', attribute.definition))
+
+        for index, literal in enumerate(getattr(element, 'literals', [])):
+            literals.append((literal.id, element.id, index, literal.name, literal.type, literal.scope,
+                             literal.lower, literal.upper, literal.definition, literal.documentation,
+                             to_json(literal.properties)))
+            if literal.definition is not None:
+                tags.append((literal.id, 'definition', literal.definition))
+
+        for index, operation in enumerate(getattr(element, 'operations', [])):
+            operations.append((element.id, index, operation))
+
+    with connection:
+        connection.executemany("INSERT OR IGNORE INTO packages VALUES (?, ?, ?, ?)", packages)
+        connection.executemany("INSERT OR IGNORE INTO elements VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", elements)
+        connection.executemany("INSERT OR IGNORE INTO attributes VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", attributes)
+        connection.executemany("INSERT OR IGNORE INTO literals VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", literals)
+        connection.executemany("INSERT INTO operations VALUES (?, ?, ?)", operations)
+        connection.executemany("INSERT INTO generalizations VALUES (?, ?, ?, ?)", generalizations)
+        connection.executemany("INSERT INTO connectors VALUES (?, ?, ?, ?, ?)", connectors)
+        connection.executemany("INSERT INTO tags VALUES (?, ?, ?)", tags)
+        connection.executemany("INSERT INTO diagrams VALUES (?, ?, ?)",
+                               [(diagram['id'], position, diagram['name'])
+                                for position, diagram in enumerate(model.diagrams)])
+        connection.execute("INSERT INTO metadata VALUES ('model_file', ?)", (model.model_file,))
+        connection.execute("INSERT INTO metadata VALUES ('rules', ?)", (get_rules().fingerprint,))
+
+    connection.close()
+
+    print(f"\nSaved model store '{db_path}' in {time.perf_counter() - start:.3f}s: "
+          f"{len(elements)} elements, {len(attributes)} attributes, {len(literals)} literals, "
+          f"{len(connectors)} connectors")
+
+
+def load_model_store(db_path):
+    """
+    Load a LoadedModel, with its records and domain objects, back from a SQLite store.
+
+    The store is opened read-only, so a missing store is an error rather than a new empty one, and a
+    ValueError is raised if it was built with other skip and include rules than the current ones.
+    """
+    start = time.perf_counter()
+
+    connection = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+
+    model = LoadedModel(db_path)
+
+    def rows(sql):
+        return connection.execute(sql).fetchall()
+
+    fingerprint = rows("SELECT value FROM metadata WHERE name = 'rules'")
+    if fingerprint != [(get_rules().fingerprint,)]:
+        connection.close()
+        raise ValueError(f"model store '{db_path}' was built with other skip and include rules, "
+                         f"build it again with model_store.py and the same --rules")
+
+    def grouped(sql):
+        # Rows grouped by their first column, in position order.
+        groups = {}
+        for row in rows(sql):
+            groups.setdefault(row[0], []).append(row[1:])
+        return groups
+
+    attributes = grouped("SELECT element_id, id, name, type, scope, lower, upper, association, definition, "
+                         "documentation, properties FROM attributes ORDER BY element_id, position")
+    literals = grouped("SELECT element_id, id, name, type, scope, lower, upper, definition, documentation, "
+                       "properties FROM literals ORDER BY element_id, position")
+    operations = grouped("SELECT element_id, name FROM operations ORDER BY element_id, position")
+    generalizations = grouped("SELECT element_id, id, general_id FROM generalizations ORDER BY element_id, position")
+    connectors = grouped("SELECT element_id, type, start_id, end_id FROM connectors ORDER BY element_id, position")
+
+    ###############################################################################
+    ##  Rebuild the element records, in document order, and the domain objects.  ##
+    ###############################################################################
+
+    records = {}
+    for (element_id, xmi_type, name, parent_id, package_path, definition, properties, attrib,
+         has_links) in rows("SELECT id, type, name, parent_id, package_path, definition, properties, "
+                            "attrib, has_links FROM elements ORDER BY position"):
+
+        record = {
+            'id': element_id,
+            'type': xmi_type,
+            'name': name,
+            'attrib': from_json(attrib),
+            'package_hierarchy': tuple(from_json(package_path)),
+            'owned_elements': [],
+            'attributes': [],
+            'literals': [],
+            'operations': [name for name, in operations.get(element_id, [])],
+            'generalizations': [{'id': id, 'general': general}
+                                for id, general in generalizations.get(element_id, [])],
+        }
+        records[element_id] = record
+        model.add_element(record, records.get(parent_id))
+
+        cls = DOMAIN_CLASSES.get(xmi_type)
+        if cls is None:
+            continue
+
+        kwargs = {
+            'package_path': record['package_hierarchy'],
+            'links': [tuple(link) for link in connectors.get(element_id, [])] if has_links else None,
+            'generalizations': [generalization['general'] for generalization in record['generalizations']],
+            'properties': from_json(properties),
+            'definition': definition,
+        }
+
+        if xmi_type == 'uml:Class':
+            kwargs['attributes'] = [ModelAttribute(id, name, type, scope=scope, lower=lower, upper=upper,
+                                                   association=association, definition=definition,
+                                                   documentation=documentation,
+                                                   properties=from_json(properties))
+                                    for (id, name, type, scope, lower, upper, association, definition,
+                                         documentation, properties) in attributes.get(element_id, [])]
+            kwargs['operations'] = record['operations']
+        elif xmi_type == 'uml:Enumeration':
+            kwargs['literals'] = [ModelLiteral(id, name, type, scope=scope, lower=lower, upper=upper,
+                                               definition=definition, documentation=documentation,
+                                               properties=from_json(properties))
+                                  for (id, name, type, scope, lower, upper, definition, documentation,
+                                       properties) in literals.get(element_id, [])]
+
+        model.domain[element_id] = cls(element_id, name, xmi_type, **kwargs)
+
+    for element in model.domain.values():
+        if element.type == 'uml:Package':
+            element.owned_elements = list(records[element.id]['owned_elements'])
+
+    model.diagrams = [{'id': id, 'name': name} for id, name in rows("SELECT id, name FROM diagrams ORDER BY position")]
+
+    connection.close()
+
+    model.timings['store'] = time.perf_counter() - start
+
+    report_load(model)
+
+    return model
+
+
+def main():
+    """
+    Build the SQLite store of a model file, or run a query against an existing store.
+    """
+    parser = argparse.ArgumentParser(description="Build or query the SQLite store of an XMI model.")
+    parser.add_argument("--xmi", default=os.path.join("model", "TransportSafetyModel.xmi"),
+                        help="XMI model file to build the store from")
+    parser.add_argument("--db", default="model.db", help="SQLite store to build or query")
+    parser.add_argument("--stream", action="store_true", help="stream the XMI with iterparse")
+    parser.add_argument("--sql", help="run a query against the store instead of building it")
+    parser.add_argument("--rules", default=RULES_FILE, help="JSON file of the package skip and include rules")
+    args = parser.parse_args()
+
+    if args.sql:
+        if not os.path.isfile(args.db):
+            parser.error(f"model store '{args.db}' does not exist")
+        connection = sqlite3.connect(args.db)
+        cursor = connection.execute(args.sql)
+        print("\t".join(column[0] for column in cursor.description))
+        for row in cursor:
+            print("\t".join("" if value is None else str(value) for value in row))
+        connection.close()
+        return
+
+    configure_rules(args.rules)
+    model = stream_model(args.xmi) if args.stream else load_model(args.xmi)
+    build_domain(model)
+    save_model_store(model, args.db)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,13 @@
+import argparse
 import os
-import shutil
-#import xml.etree.ElementTree as ET
-from lxml import etree as ET
+import time
 
 
-from common import check_for_skip, get_package_hierachy, get_namespaced_attribute, render_template, generate_id_to_name_map
+from common import check_for_skip, configure_rules, render_template, load_model, stream_model, configure_renderer, PageManifest
+from common import ImageOptimiser, ImageSync, ModelSnapshotCache, PAGE_FORMATS, RULES_FILE
+from domain import build_domain
+from mermaid import LinkIndex, element_diagram
+from model_store import load_model_store
 
 from pprint import pprint
 
@@ -12,16 +15,16 @@ from pprint import pprint
 ns = { 'xmi': 'http://schema.omg.org/spec/XMI/2.1', 'uml': 'http://schema.omg.org/spec/UML/2.1' }
 
 
-def process_properties(uml_element, id_to_name_map=None):
+def process_properties(attributes, id_to_name_map=None):
     """
-    Process all properties of an element.
+    Process all properties of an element from its dictionary of XML attributes.
 
     This will remove any with an "}" in the name which catches the xml:id and xml:type.
     """
     properties = []
     property = {}
 
-    for prop_name, prop_value in uml_element.attrib.items():
+    for prop_name, prop_value in attributes.items():
 
         if '}' not in prop_name:
 
@@ -40,13 +43,10 @@ def process_properties(uml_element, id_to_name_map=None):
     return properties
 
 
-def generate_enumeration_pages(model_file, prefix, output_path):
+def generate_enumeration_pages(model, prefix, output_path):
     """
     Generate enumeration documentation. One page per enumeration.
     """
-    tree = ET.parse(model_file)
-    root = tree.getroot()
-
     print("\nProcessing Enumerations\n")
 
     index_data = {
@@ -58,20 +58,19 @@ def generate_enumeration_pages(model_file, prefix, output_path):
     }
 
     # Find all Enumerations
-    for packaged_element in root.findall('.//packagedElement[@xmi:type="uml:Enumeration"]', ns):
+    for enumeration in model.domain_of_type('uml:Enumeration'):
 
         data = {}
 
-        enum_id = get_namespaced_attribute(packaged_element, "xmi:id", ns)
-        xmi_type = get_namespaced_attribute(packaged_element, "xmi:type", ns)
-        enum_name = packaged_element.get('name')
+        enum_id = enumeration.id
+        xmi_type = enumeration.type
+        enum_name = enumeration.name
 
         ###############################################################################
         ##  Check the package hierarchy and skip if DATEX II related.                ##
         ###############################################################################
 
-        package_hierarchy = get_package_hierachy(packaged_element)
-        if check_for_skip(package_hierarchy): continue
+        if check_for_skip(enumeration.package_path, enumeration.properties.get('stereotype')): continue
 
         ###############################################################################
         ##  Save the enumeration name to the index page list.                        ##
@@ -82,15 +81,8 @@ def generate_enumeration_pages(model_file, prefix, output_path):
             'type': xmi_type
         })
 
-        ###############################################################################
-        ##  Find the element.                                                        ##
-        ###############################################################################
-
-        element = root.find(f'.//element[@xmi:idref="{enum_id}"]', ns)
-        properties = element.find('properties')
-
-        # enum_desc = properties.get('documentation')
-        enum_desc = element.find('./tags/tag[@name="definition"]').get('value')
+        # enum_desc = enumeration.properties.get('documentation')
+        enum_desc = enumeration.definition
 
         ###############################################################################
         ##  Add the main details of the enumeration.                                 ##
@@ -108,9 +100,7 @@ def generate_enumeration_pages(model_file, prefix, output_path):
         ##  Add the properties of the enumeration.                                   ##
         ###############################################################################
 
-        data['properties'] = process_properties(properties)
-
-        # data['properties'] = process_properties(packaged_element)
+        data['properties'] = process_properties(enumeration.properties)
 
         ###############################################################################
         ##  Loop through the ownedLiterals.                                          ##
@@ -119,37 +109,16 @@ def generate_enumeration_pages(model_file, prefix, output_path):
         data['literals'] = []
         literal = {}
 
-        for owned_literal in packaged_element.findall('./ownedLiteral', ns):
-
-            lit_id = get_namespaced_attribute(owned_literal, 'xmi:id', ns)
-            lit_name = owned_literal.get('name')
-            lit_type = owned_literal.get('type')
-
-            ###########################################################################
-            ##  Get the literal attributes.                                          ##
-            ###########################################################################
-
-            lit_data = generate_literal_page(lit_id,
-                                             root,
-                                             ns,
-                                             prefix,
-                                             os.path.join(output_path, enum_name))
-
-            ###########################################################################
-            ##  End of get the literal attributes.                                   ##
-            ###########################################################################
+        for owned_literal in enumeration.literals:
 
             ###########################################################################
             ##  Add the literal attributes to the enumeration page.                  ##
             ###########################################################################
 
-            #lit_visibility = owned_literal.get('visibility')
-            #lit_description = owned_literal.get('description')
-
             literal = {
-                'visibility': return_property(lit_data['properties'], 'scope'),
-                'name': lit_name,
-                'description': lit_data['details']['description']
+                'visibility': owned_literal.scope,
+                'name': owned_literal.name,
+                'description': owned_literal.definition
             }
 
             data['literals'].append(literal)
@@ -166,121 +135,75 @@ def generate_enumeration_pages(model_file, prefix, output_path):
     generate_index_page(output_path, index_data)
 
 
-def generate_literal_page(lit_id, root, ns, prefix, output_path):
+def generate_literal_page(literal, prefix, output_path):
     """
     Generate literal documentaiton. One page per literal.
 
     This only get the literal attributes currently. No page is generated.
     """
 
-    owned_literal = root.find(f'.//ownedLiteral[@xmi:id="{lit_id}"]', ns)
-    literal = root.find(f'.//attribute[@xmi:idref="{lit_id}"]', ns)
-    documentation = literal.find('documentation')
-    properties = literal.find('properties')
-    bounds = literal.find('bounds')
-
     lit_data = {}
 
-    lit_name = literal.get('name')
-    xmi_type = get_namespaced_attribute(owned_literal, "xmi:type", ns)
-    # lit_desc = documentation.get('value')
-    lit_desc = literal.find('./tags/tag[@name="definition"]').get('value')
+    # lit_desc = literal.documentation
+    lit_desc = literal.definition
 
     lit_data['details'] = {
-        'id': lit_id,
-        'name': lit_name,
+        'id': literal.id,
+        'name': literal.name,
         'model_prefix': prefix,
-        'type': xmi_type,
+        'type': literal.type,
         'description': lit_desc
     }
 
-    lit_data['properties'] = process_properties(properties)
+    lit_data['properties'] = process_properties(literal.properties)
 
-    lit_data['properties'].append({ 'name': 'bounds', 'value': bounds.get('lower') + ".." + bounds.get('upper') })
-    lit_data['properties'].append({ 'name': 'idref', 'value': lit_id })
-    lit_data['properties'].append({ 'name': 'scope', 'value': literal.get('scope') })
+    lit_data['properties'].append({ 'name': 'bounds', 'value': literal.bounds })
+    lit_data['properties'].append({ 'name': 'idref', 'value': literal.id })
+    lit_data['properties'].append({ 'name': 'scope', 'value': literal.scope })
 
     return lit_data
 
 
-def generate_attribute_page(attr_id, root, ns, prefix, output_path):
+def generate_attribute_page(attribute, prefix, output_path):
     """
     Generate attribute documentation. One page per attribute.
     """
 
-    owned_attribute = root.find(f'.//ownedAttribute[@xmi:id="{attr_id}"]', ns)
-    attribute = root.find(f'.//attribute[@xmi:idref="{attr_id}"]', ns)
-    documentation = attribute.find('documentation')
-    properties = attribute.find('properties')
-    bounds = attribute.find('bounds')
-
     attr_data = {}
 
-    attr_name = attribute.get('name')
-    xmi_type = get_namespaced_attribute(owned_attribute, "xmi:type", ns)
-    #attr_desc = documentation.get('value')
-    attr_desc = attribute.find('./tags/tag[@name="definition"]').get('value')
+    #attr_desc = attribute.documentation
+    attr_desc = attribute.definition
 
-
-    # print(">>>> Processing attribute ID {} {}".format(attr_id, attr_name))
-
-    # attr_desc = root.find(f'.//attribute[@xmi:idref="{attr_id}"]/documentation', ns).attrib.get('value')
+    # print(">>>> Processing attribute ID {} {}".format(attribute.id, attribute.name))
 
     attr_data['details'] = {
-        'id': attr_id,
-        'name': attr_name,
+        'id': attribute.id,
+        'name': attribute.name,
         'model_prefix': prefix,
-        'type': xmi_type,
+        'type': attribute.type,
         'description': attr_desc
     }
 
-    attr_data['properties'] = process_properties(properties)
+    attr_data['properties'] = process_properties(attribute.properties)
 
-    attr_data['properties'].append({ 'name': 'bounds', 'value': bounds.get('lower') + ".." + bounds.get('upper') })
-    attr_data['properties'].append({ 'name': 'idref', 'value': attr_id })
-    attr_data['properties'].append({ 'name': 'scope', 'value': attribute.get('scope') })
+    attr_data['properties'].append({ 'name': 'bounds', 'value': attribute.bounds })
+    attr_data['properties'].append({ 'name': 'idref', 'value': attribute.id })
+    attr_data['properties'].append({ 'name': 'scope', 'value': attribute.scope })
 
     # pprint(attr_data)
     os.makedirs(output_path, exist_ok=True)
-    output_file = os.path.join(output_path, attr_name + ".md")
+    output_file = os.path.join(output_path, attribute.name + ".md")
     render_template("attribute.md.j2", attr_data, output_file)
 
-    # print("*****")
-
-    attr = root.find(f'.//attribute[@xmi:idref="{attr_id}"]', ns)
-
-    # for element in attr:
-    #     print(element)
-    #     for at in element.attrib.items():
-    #         print(at)
-
-    # print("*****")
-
     return attr_data
 
 
-def return_property(properties, property_name):
-    """
-    Helper function to return a property value from our constructed page data.
-    """
-
-    value = None
-
-    for prop in properties:
-        if prop.get("name") == property_name:
-            value = prop.get("value")
-            break
-
-    return value
-
-def generate_class_pages(model_file, prefix, output_path):
+def generate_class_pages(model, prefix, output_path, links=None):
     """
-    Generate class documentation. One page per class.
+    Generate class documentation. One page per class, with a Mermaid class diagram if there is a
+    LinkIndex.
     """
-    tree = ET.parse(model_file)
-    root = tree.getroot()
-
-    id_to_name_map = generate_id_to_name_map(root, ns)
+    id_to_name_map = model.id_to_name_map
 
     print("\nProcessing Classes\n")
 
@@ -293,20 +216,19 @@ def generate_class_pages(model_file, prefix, output_path):
     }
 
     # Find all Classes
-    for packaged_element in root.findall('.//packagedElement[@xmi:type="uml:Class"]', ns):
+    for model_class in model.domain_of_type('uml:Class'):
 
         data = {}
 
-        class_id = get_namespaced_attribute(packaged_element, "xmi:id", ns)
-        xmi_type = get_namespaced_attribute(packaged_element, "xmi:type", ns)
-        class_name = packaged_element.get('name')
+        class_id = model_class.id
+        xmi_type = model_class.type
+        class_name = model_class.name
 
         ###############################################################################
         ##  Check the package hierarchy and skip if DATEX II related.                ##
         ###############################################################################
 
-        package_hierarchy = get_package_hierachy(packaged_element)
-        if check_for_skip(package_hierarchy): continue
+        if check_for_skip(model_class.package_path, model_class.properties.get('stereotype')): continue
 
         # if class_name.startswith('WeatherRelated : '):
         #     print("WeatherRelated...skipping ")
@@ -321,16 +243,8 @@ def generate_class_pages(model_file, prefix, output_path):
             'type': xmi_type
         })
 
-        ###############################################################################
-        ##  Find the element and extract properties.                                 ##
-        ###############################################################################
-
-        element = root.find(f'.//element[@xmi:idref="{class_id}"]', ns)
-        properties = element.find('properties')
-        links = element.find('links')
-
-        # class_desc = properties.get('documentation')
-        class_desc = element.find('./tags/tag[@name="definition"]').get('value')
+        # class_desc = model_class.properties.get('documentation')
+        class_desc = model_class.definition
 
         print(">> Processing class: ", class_name)
 
@@ -350,9 +264,7 @@ def generate_class_pages(model_file, prefix, output_path):
         ##  Add the class properties.                                                ##
         ###############################################################################
 
-        # data['properties'] = process_properties(packaged_element)
-
-        data['properties'] = process_properties(properties)
+        data['properties'] = process_properties(model_class.properties)
 
         ###############################################################################
         ##  Add the class operations.                                                ##
@@ -360,22 +272,20 @@ def generate_class_pages(model_file, prefix, output_path):
 
         data['operations'] = []
 
-        for op in packaged_element.findall('./ownedOperation', ns):
-            data['operations'].append({'name': op.get('name')})
+        for op in model_class.operations:
+            data['operations'].append({'name': op})
 
         ###############################################################################
         ##  Add the class relationships.                                             ##
         ###############################################################################
 
-        # print(links)
-
-        if links is not None:
+        if model_class.links is not None:
             data['relationships'] = []
 
-            for association in links.findall('./Association', ns):
+            for _, start, end in model_class.links_of_type('Association'):
                 relationship = {
-                    'start': id_to_name_map.get(association.get('start')),
-                    'end': id_to_name_map.get(association.get('end'))
+                    'start': id_to_name_map.get(start),
+                    'end': id_to_name_map.get(end)
                 }
                 data['relationships'].append(relationship)
 
@@ -388,25 +298,20 @@ def generate_class_pages(model_file, prefix, output_path):
         data['attributes'] = []
         attribute = {}
 
-        for owned_attibute in packaged_element.findall('./ownedAttribute', ns):
+        for owned_attibute in model_class.attributes:
 
-            print("ownedAttribute Name: ", owned_attibute.get('name'))
+            print("ownedAttribute Name: ", owned_attibute.name)
 
             # Sparx Enterprise Architect puts associations as ownedAttribute of type uml:Property as well
-            if not owned_attibute.get('association'):
-
-                attr_id = get_namespaced_attribute(owned_attibute, 'xmi:id', ns)
-                attr_name = owned_attibute.get('name')
+            if not owned_attibute.association:
 
                 #######################################################################
                 ##  Generate of the attribute page.                                  ##
                 #######################################################################
 
-                attr_data = generate_attribute_page(attr_id,
-                                                    root,
-                                                    ns,
-                                                    prefix,
-                                                    os.path.join(output_path, class_name))
+                generate_attribute_page(owned_attibute,
+                                        prefix,
+                                        os.path.join(output_path, class_name))
 
                 #######################################################################
                 ##  End of attribute page generation.                                ##
@@ -417,14 +322,21 @@ def generate_class_pages(model_file, prefix, output_path):
                 #######################################################################
 
                 attribute = {
-                    'visibility': return_property(attr_data['properties'], 'scope'),
-                    'name': attr_name,
-                    'type': return_property(attr_data['properties'], 'type'),
-                    'description': attr_data['details']['description'],
+                    'visibility': owned_attibute.scope,
+                    'name': owned_attibute.name,
+                    'type': owned_attibute.data_type,
+                    'description': owned_attibute.definition,
                 }
 
                 data['attributes'].append(attribute)
 
+        ###############################################################################
+        ##  Add the class diagram.                                                   ##
+        ###############################################################################
+
+        if links is not None:
+            data['diagram'] = element_diagram(links, class_id)
+
         ###############################################################################
         ##  Back to handling the Class.                                              ##
         ###############################################################################
@@ -440,15 +352,11 @@ def generate_class_pages(model_file, prefix, output_path):
     generate_index_page(output_path, index_data)
 
 
-def generate_datatype_pages(model_file, prefix, output_path):
+def generate_datatype_pages(model, prefix, output_path):
     """
     Generate data type documentation. One page per data type.
     """
-
-    tree = ET.parse(model_file)
-    root = tree.getroot()
-
-    id_to_name_map = generate_id_to_name_map(root, ns)
+    id_to_name_map = model.id_to_name_map
 
     print("\nProcessing DataTypes\n")
 
@@ -461,20 +369,19 @@ def generate_datatype_pages(model_file, prefix, output_path):
     }
 
     # Find all DataTypes
-    for packaged_element in root.findall('.//packagedElement[@xmi:type="uml:DataType"]', ns):
+    for datatype in model.domain_of_type('uml:DataType'):
 
         data = {}
 
-        datatype_id = get_namespaced_attribute(packaged_element, "xmi:id", ns)
-        xmi_type = get_namespaced_attribute(packaged_element, "xmi:type", ns)
-        datatype_name = packaged_element.get('name')
+        datatype_id = datatype.id
+        xmi_type = datatype.type
+        datatype_name = datatype.name
 
         ###############################################################################
         ##  Check the package hierarchy and skip if DATEX II related.                ##
         ###############################################################################
 
-        package_hierarchy = get_package_hierachy(packaged_element)
-        if check_for_skip(package_hierarchy): continue
+        if check_for_skip(datatype.package_path, datatype.properties.get('stereotype')): continue
 
         ###############################################################################
         ##  Save the datatype name to the index page list.                           ##
@@ -485,16 +392,8 @@ def generate_datatype_pages(model_file, prefix, output_path):
             'type': xmi_type
         })
 
-        ###############################################################################
-        ##  Find the element and extract properties.                                 ##
-        ###############################################################################
-
-        element = root.find(f'.//element[@xmi:idref="{datatype_id}"]', ns)
-        properties = element.find('properties')
-        links = element.find('links')
-
-        # datatype_desc = properties.get('documentation')
-        datatype_desc = element.find('./tags/tag[@name="definition"]').get('value')
+        # datatype_desc = datatype.properties.get('documentation')
+        datatype_desc = datatype.definition
 
         ###############################################################################
         ##  Add the main details of the datatype.                                    ##
@@ -512,9 +411,7 @@ def generate_datatype_pages(model_file, prefix, output_path):
         ##  Add the properties of the datatype.                                      ##
         ###############################################################################
 
-        # data['properties'] = process_properties(packaged_element)
-
-        data['properties'] = process_properties(properties)
+        data['properties'] = process_properties(datatype.properties)
 
         ###############################################################################
         ##  Add the generalized elements of the datatype.                            ##
@@ -522,8 +419,8 @@ def generate_datatype_pages(model_file, prefix, output_path):
 
         data['generalized_elements'] = []
 
-        for gen in packaged_element.findall('./generalization', ns):
-            data['generalized_elements'].append(id_to_name_map.get(gen.get('general'), None))
+        for general in datatype.generalizations:
+            data['generalized_elements'].append(id_to_name_map.get(general, None))
 
         ###############################################################################
         ##  Add the specialized elements of the datatype.                            ##
@@ -535,13 +432,13 @@ def generate_datatype_pages(model_file, prefix, output_path):
         ##  Add the datatype relationships.                                          ##
         ###############################################################################
 
-        if links is not None:
+        if datatype.links is not None:
             data['relationships'] = []
 
-            for generalization in links.findall('./Generalization', ns):
+            for _, start, end in datatype.links_of_type('Generalization'):
                 relationship = {
-                    'start': id_to_name_map.get(generalization.get('start')),
-                    'end': id_to_name_map.get(generalization.get('end'))
+                    'start': id_to_name_map.get(start),
+                    'end': id_to_name_map.get(end)
                 }
                 data['relationships'].append(relationship)
 
@@ -560,13 +457,13 @@ def generate_datatype_pages(model_file, prefix, output_path):
     return
 
     # Find all PrimitiveType elements
-    for packaged_element in root.findall('.//packagedElement[@xmi:type="uml:PrimitiveType"]', ns):
+    for packaged_element in model.elements_of_type('uml:PrimitiveType'):
 
         data = {}
 
-        datatype_id = get_namespaced_attribute(packaged_element, "xmi:id", ns)
-        xmi_type = get_namespaced_attribute(packaged_element, "xmi:type", ns)
-        datatype_name = packaged_element.get('name')
+        datatype_id = packaged_element['id']
+        xmi_type = packaged_element['type']
+        datatype_name = packaged_element['name']
 
         data['details'] = {
             'id': datatype_id,
@@ -582,14 +479,14 @@ def generate_datatype_pages(model_file, prefix, output_path):
 
         data['generalized_elements'] = []
 
-        for generalization in packaged_element.findall('./generalization', ns):
-            data['generalized_elements'].append(get_namespaced_attribute(generalization, "xmi:id", ns))
+        for generalization in packaged_element['generalizations']:
+            data['generalized_elements'].append(generalization['id'])
 
         ###############################################################################
         ##  Add the properties elements of the datatype.                             ##
         ###############################################################################
 
-        data['properties'] = process_properties(packaged_element)
+        data['properties'] = process_properties(packaged_element['attrib'])
 
         data['properties'].append({ 'name': datatype_id })
 
@@ -606,51 +503,52 @@ def generate_index_page(output_path, index_data):
 
     pprint(index_data)
 
+    # The output directory does not exist yet if the rules skipped every element of the index.
+    os.makedirs(output_path, exist_ok=True)
     output_file = os.path.join(output_path, "index.md")
     render_template("generic_index.md.j2", index_data, output_file)
 
 
-def generate_diagram_pages(model_file, prefix, output_path):
+def generate_diagram_pages(model, prefix, output_path, images, optimiser=None):
     """
-    Generate diagram pages.
+    Generate diagram pages, recording the diagram images they reference in the ImageSync. With an
+    ImageOptimiser the pages reference the optimised image, and its thumbnail if there is one.
     """
-
-    tree = ET.parse(model_file)
-    root = tree.getroot()
-
-    id_to_name_map = generate_id_to_name_map(root, ns)
-
     os.makedirs(os.path.join(output_path, "images"), exist_ok=True)
 
     # Find all DataTypes
-    for diagram in root.findall('.//diagram', ns):
-        id = get_namespaced_attribute(diagram, 'xmi:id', ns)
-        properties = diagram.find('properties')
-
-        name = properties.get('name')
+    for diagram in model.diagrams:
+        id = diagram['id']
+        name = diagram['name']
 
         data = {
             'id': id,
             'name': name,
-            'model_prefix': prefix
+            'model_prefix': prefix,
+            'image': id + ".png",
+            'thumbnail': None
         }
 
-        shutil.copy(os.path.join("model", "Images", id + ".png"), os.path.join(output_path, "images"))
+        source_file = os.path.join("model", "Images", id + ".png")
+
+        if optimiser is not None:
+            image_file, thumbnail_file = optimiser.add(source_file)
+            data['image'] = id + optimiser.extension
+            images.reference(image_file, os.path.join(output_path, "images", data['image']))
+            if thumbnail_file is not None:
+                data['thumbnail'] = id + "-thumb" + optimiser.extension
+                images.reference(thumbnail_file, os.path.join(output_path, "images", data['thumbnail']))
+        else:
+            images.reference(source_file, os.path.join(output_path, "images", data['image']))
 
         output_file = os.path.join(output_path, name.lower() + "_diagram.md")
         render_template("diagram.md.j2", data, output_file)
 
 
-def generate_package_page(package, model_file, prefix, output_path):
+def generate_package_page(package, model, prefix, output_path):
     """
     Generate package pages.
     """
-
-    tree = ET.parse(model_file)
-    root = tree.getroot()
-
-    id_to_name_map = generate_id_to_name_map(root, ns)
-
     print("\nGenerating a package page for {}\n".format(package))
 
     os.makedirs(os.path.join(output_path, package.lower()), exist_ok=True)
@@ -663,13 +561,13 @@ def generate_package_page(package, model_file, prefix, output_path):
 
     # Find all Enumerations
     # for packaged_element in root.findall(f'.//packagedElement[@xmi:type="uml:Package"][name="{package}"]', ns):
-    for packaged_element in root.findall('.//packagedElement[@xmi:type="uml:Package"]', ns):
+    for model_package in model.domain_of_type('uml:Package'):
 
         data = {}
 
-        package_id = get_namespaced_attribute(packaged_element, 'xmi:id', ns)
-        xmi_type = get_namespaced_attribute(packaged_element, "xmi:type", ns)
-        package_name = packaged_element.get('name')
+        package_id = model_package.id
+        xmi_type = model_package.type
+        package_name = model_package.name
 
         print("Found package", package_name)
         print("{:30} {}".format(package_name, package))
@@ -677,12 +575,7 @@ def generate_package_page(package, model_file, prefix, output_path):
         if package_name == package:
             print("if package_name=package is true")
 
-            ###############################################################################
-            ##  Find the element and extract properties.                                 ##
-            ###############################################################################
-
-            element = root.find(f'.//element[@xmi:idref="{package_id}"]', ns)
-            properties = element.find('properties')
+            properties = model_package.properties
 
             # package_desc = properties.get('documentation')
 
@@ -721,11 +614,11 @@ def generate_package_page(package, model_file, prefix, output_path):
 
             data['owned_elements'] = []
 
-            for owned in packaged_element.findall('./packagedElement', ns):
-                if get_namespaced_attribute(owned, 'xmi:type', ns) != 'uml:Association':
+            for owned in [model.elements[owned_id] for owned_id in model_package.owned_elements]:
+                if owned['type'] != 'uml:Association':
                     data['owned_elements'].append({
-                        'name': owned.get('name', None),
-                        'type': get_namespaced_attribute(owned, 'xmi:type', ns)
+                        'name': owned['name'],
+                        'type': owned['type']
                     })
                     #data['owned_elements'].append(id_to_name_map.get(owned.get('name'), None))
 
@@ -736,17 +629,129 @@ def generate_package_page(package, model_file, prefix, output_path):
 
 
 def main():
+    parser = argparse.ArgumentParser(description="Generate markdown documentation pages from an XMI model.")
+    parser.add_argument("--format", choices=sorted(PAGE_FORMATS), default="markdown",
+                        help="render markdown pages, or Confluence storage format pages that are published "
+                             "without converting them (default: markdown)")
+    parser.add_argument("--stream", action="store_true",
+                        help="stream the XMI with iterparse instead of loading the whole tree, for very large exports")
+    parser.add_argument("--bytecode-cache", metavar="DIR",
+                        help="cache the compiled templates in DIR so later runs skip compiling them")
+    parser.add_argument("--force", action="store_true",
+                        help="render and write every page even if its inputs have not changed")
+    parser.add_argument("-j", "--jobs", type=int, default=1, metavar="N",
+                        help="render and write the pages across N worker processes, 0 for one per CPU")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="parse the XMI even if there is a snapshot of it in the model cache")
+    parser.add_argument("--cache-dir", default=".model_cache", metavar="DIR",
+                        help="directory of the model snapshot cache (default: .model_cache)")
+    parser.add_argument("--store", metavar="DB",
+                        help="generate from the SQLite model store built by model_store.py instead of the XMI")
+    parser.add_argument("--rules", default=RULES_FILE, metavar="FILE",
+                        help=f"JSON file of the package skip and include rules (default: {RULES_FILE})")
+    parser.add_argument("--mermaid", action="store_true",
+                        help="add a Mermaid class diagram built from the model links to the class pages")
+    parser.add_argument("--diagrams", action="store_true",
+                        help="write a page for each diagram with its image, and sync the images into the output")
+    parser.add_argument("--optimise-images", action="store_true",
+                        help="with --diagrams, recompress the diagram images, which needs Pillow")
+    parser.add_argument("--image-format", choices=["png", "webp"], default="png",
+                        help="format of the optimised images, both lossless (default: png)")
+    parser.add_argument("--max-image-size", type=int, metavar="PX",
+                        help="scale the optimised images down to fit PX by PX pixels")
+    parser.add_argument("--thumbnail-size", type=int, metavar="PX",
+                        help="show a thumbnail that fits PX by PX pixels, linking to the full image")
+    parser.add_argument("--image-cache-dir", default=".image_cache", metavar="DIR",
+                        help="directory of the optimised images (default: .image_cache)")
+    args = parser.parse_args()
+
+    # The diagram images are only used by the diagram pages.
+    if args.optimise_images and not args.diagrams:
+        parser.error("--optimise-images needs --diagrams")
+    for option, value in [("--image-format", args.image_format != "png"), ("--max-image-size", args.max_image_size),
+                          ("--thumbnail-size", args.thumbnail_size)]:
+        if value and not args.optimise_images:
+            parser.error(f"{option} needs --optimise-images")
+    if args.store and not os.path.isfile(args.store):
+        parser.error(f"model store '{args.store}' does not exist, build it with model_store.py")
+
+    configure_rules(args.rules)
+
     model_file = os.path.join("model", "TransportSafetyModel.xmi")
     output_dir = "output"
     prefix = "TSM"
 
-    generate_enumeration_pages(model_file, prefix, os.path.join(output_dir, "enumerations"))
-    generate_class_pages(model_file, prefix, os.path.join(output_dir, "classes"))
-    generate_datatype_pages(model_file, prefix, os.path.join(output_dir, "datatypes"))
-    #generate_diagram_pages(model_file, prefix, output_dir)
-    #generate_package_page("Enumerations", model_file, prefix, output_dir)
-    #generate_package_page("DataTypes", model_file, prefix, output_dir)
-    #generate_package_page("Classes", model_file, prefix, output_dir)
+    # Only pages whose template or data have changed since the last run are written.
+    manifest = PageManifest(output_dir, force=args.force)
+
+    # Only the images referenced by the diagram pages are synced, and unchanged ones are skipped.
+    # Without --diagrams nothing is referenced, so the images of an earlier run are removed along
+    # with its diagram pages.
+    images = ImageSync(output_dir)
+
+    # The optimised images are cached on the source image hash and the settings.
+    optimiser = None
+    if args.optimise_images:
+        optimiser = ImageOptimiser(args.image_cache_dir, format=args.image_format, max_size=args.max_image_size,
+                                   thumbnail_size=args.thumbnail_size, jobs=args.jobs)
+
+    # With more than one job the generators only build the page data, which is then rendered and
+    # written across a pool of worker processes.
+    template_dir, extension = PAGE_FORMATS[args.format]
+    renderer = configure_renderer(template_dir, bytecode_cache_dir=args.bytecode_cache, manifest=manifest,
+                                  jobs=args.jobs, extension=extension)
+
+    # Parse and index the model once and share it with all the generators, or load the snapshot
+    # saved by an earlier run if the XMI file has not changed since.
+    cache = ModelSnapshotCache(args.cache_dir)
+
+    if args.store:
+        try:
+            model = load_model_store(args.store)
+        except ValueError as e:
+            parser.error(str(e))
+    else:
+        model = None if args.no_cache else cache.load(model_file)
+
+    if model is None:
+        if args.stream:
+            model = stream_model(model_file)
+        else:
+            model = load_model(model_file)
+
+        build_domain(model)
+
+        cache.save(model)
+
+    start = time.perf_counter()
+
+    # The links between the classifiers are indexed once for all the class diagrams.
+    links = LinkIndex(model.domain.values()) if args.mermaid else None
+
+    generate_enumeration_pages(model, prefix, os.path.join(output_dir, "enumerations"))
+    generate_class_pages(model, prefix, os.path.join(output_dir, "classes"), links)
+    generate_datatype_pages(model, prefix, os.path.join(output_dir, "datatypes"))
+    if args.diagrams:
+        generate_diagram_pages(model, prefix, output_dir, images, optimiser)
+    #generate_package_page("Enumerations", model, prefix, output_dir)
+    #generate_package_page("DataTypes", model, prefix, output_dir)
+    #generate_package_page("Classes", model, prefix, output_dir)
+
+    renderer.render_queued()
+
+    manifest.save()
+    if optimiser is not None:
+        optimiser.run()
+    images.sync()
+
+    renderer.report()
+    manifest.report()
+    if optimiser is not None:
+        optimiser.report()
+    images.report()
+
+    print(f"\nModel loaded in {sum(model.timings.values()):.3f}s, "
+          f"pages generated in {time.perf_counter() - start:.3f}s")
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
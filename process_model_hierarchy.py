@@ -6,14 +6,22 @@ Through the traversal the parent -> child hierarchy is preserved and an appropri
 structure and markdown pages for each namespace, package, class, enumeration and data type.
 
 This code is currently a work in progress,
+
+Unlike process_model.py --stream, the whole XMI file is parsed into one tree, as the walk follows
+the packagedElement nodes of the tree. An element with no definition tag is documented with no
+description and a warning is printed, where it used to stop the run.
 """
 
+import argparse
 import os
-import shutil
+import time
 
+from concurrent.futures import ProcessPoolExecutor
 from lxml import etree as ET
 
-from jinja2 import Template, FileSystemLoader, Environment
+from common import ImageSync, ModelIndex, XMI_ID, XMI_TYPE, generate_id_to_name_map, render_template
+from domain import attribute_from_xml, literal_from_xml, element_from_xml
+from mermaid import CLASSIFIER_TYPES, LinkIndex, package_diagram
 from pprint import pprint
 
 
@@ -36,33 +44,16 @@ def get_namespaced_attribute(element, prefix_attr_name, ns_map):
     return element.attrib.get(prefix_attr_name)
 
 
-def render_template(template, data, output_file):
-    """
-    Render the Jinja2 template and generate and output file.
-    """
-    env = Environment(loader=FileSystemLoader("templates"), trim_blocks=True, lstrip_blocks=True)
-    template = env.get_template(template)
-
-    # Render the template with the data
-    rendered_content = template.render(data)
-
-    # Write the rendered content to a file
-    with open(output_file, "wb") as file:
-        file.write(rendered_content.encode('utf-8'))
-
-    print(f"File '{output_file}' has been created with the rendered content.")
-
-
-def process_properties(uml_element, id_to_name_map=None):
+def process_properties(attributes, id_to_name_map=None):
     """
-    Process all properties of an element.
+    Process all properties of an element from its dictionary of XML attributes.
 
     This will remove any with an "}" in the name which catches the xml:id and xml:type.
     """
     properties = []
     property = {}
 
-    for prop_name, prop_value in uml_element.attrib.items():
+    for prop_name, prop_value in attributes.items():
 
         if '}' not in prop_name:
 
@@ -81,25 +72,16 @@ def process_properties(uml_element, id_to_name_map=None):
     return properties
 
 
-def generate_id_to_name_map(root, ns):
+def get_description(model_element):
     """
-    Return a dictionary mapping data type ID to name.
+    Return the definition of a domain element, warning when it has no definition tag.
     """
-    name_map = {}
-
-    for packaged_element in root.findall('.//packagedElement', ns):
-        id = get_namespaced_attribute(packaged_element, "xmi:id", ns)
-        type = get_namespaced_attribute(packaged_element, "xmi:type", ns)
-        name = packaged_element.get('name')
-        if type in ['uml:Enumeration', 'uml:Package', 'uml:DataType', 'uml:Class']:
-            print ("{:44} {:20} {}".format(id, type, name))
-            name_map[id] = name
+    if model_element.definition is None:
+        print(f"Warning: no definition tag for {model_element.type} '{model_element.name}' {model_element.id}")
+    return model_element.definition
 
-    pprint(name_map)
 
-    return name_map
-
-def generate_enumeration_page(root, packaged_element, parent_package, parent_map: dict):
+def generate_enumeration_page(index, packaged_element, parent_id, paths):
 
     """
     Generate enumeration documentation. One page per enumeration.
@@ -107,32 +89,32 @@ def generate_enumeration_page(root, packaged_element, parent_package, parent_map
 
     data = {}
 
-    enum_id = get_namespaced_attribute(packaged_element, "xmi:id", NS)
-    xmi_type = get_namespaced_attribute(packaged_element, "xmi:type", NS)
-    enum_name = packaged_element.get('name')
-
-    print(enum_id)
-    print(xmi_type)
-    print(enum_name)
-
     ###############################################################################
-    ##  Find the element.                                                        ##
+    ##  Find the element and literals.                                           ##
     ###############################################################################
 
-    element = root.find(f'.//element[@xmi:idref="{enum_id}"]', NS)
-    properties = element.find('properties')
+    element = index.elements.get(packaged_element.get(XMI_ID))
 
-    # enum_desc = properties.get('documentation')
-    enum_desc = element.find('./tags/tag[@name="definition"]').get('value')
+    literals = [get_literal(owned_literal.get(XMI_ID), index)
+                for owned_literal in packaged_element.findall('./ownedLiteral', NS)]
+
+    enumeration = element_from_xml(packaged_element, element, literals=literals)
+
+    print(enumeration.id)
+    print(enumeration.type)
+    print(enumeration.name)
+
+    # enum_desc = enumeration.properties.get('documentation')
+    enum_desc = get_description(enumeration)
 
     ###############################################################################
     ##  Add the main details of the enumeration.                                 ##
     ###############################################################################
 
     data['details'] = {
-            'id': enum_id,
-            'name': enum_name,
-            'type': xmi_type,
+            'id': enumeration.id,
+            'name': enumeration.name,
+            'type': enumeration.type,
             'model_prefix': PREFIX,
             'description': enum_desc
     }
@@ -141,9 +123,7 @@ def generate_enumeration_page(root, packaged_element, parent_package, parent_map
     ##  Add the properties of the enumeration.                                   ##
     ###############################################################################
 
-    data['properties'] = process_properties(properties)
-
-    # data['properties'] = process_properties(packaged_element)
+    data['properties'] = process_properties(enumeration.properties)
 
     ###############################################################################
     ##  Loop through the ownedLiterals.                                          ##
@@ -152,33 +132,16 @@ def generate_enumeration_page(root, packaged_element, parent_package, parent_map
     data['literals'] = []
     literal = {}
 
-    for owned_literal in packaged_element.findall('./ownedLiteral', NS):
-
-        lit_id = get_namespaced_attribute(owned_literal, 'xmi:id', NS)
-        lit_name = owned_literal.get('name')
-        lit_type = owned_literal.get('type')
-
-        ###########################################################################
-        ##  Get the literal attributes.                                          ##
-        ###########################################################################
-
-        lit_data = get_literal_data(lit_id, root)
-
-        ###########################################################################
-        ##  End of get the literal attributes.                                   ##
-        ###########################################################################
+    for owned_literal in enumeration.literals:
 
         ###########################################################################
         ##  Add the literal attributes to the enumeration page.                  ##
         ###########################################################################
 
-        #lit_visibility = owned_literal.get('visibility')
-        #lit_description = owned_literal.get('description')
-
         literal = {
-            'visibility': return_property(lit_data['properties'], 'scope'),
-            'name': lit_name,
-            'description': lit_data['details']['description']
+            'visibility': owned_literal.scope,
+            'name': owned_literal.name,
+            'description': get_description(owned_literal)
         }
 
         data['literals'].append(literal)
@@ -186,154 +149,94 @@ def generate_enumeration_page(root, packaged_element, parent_package, parent_map
 
     # pprint(data)
 
-    output_path = os.path.join(*get_path_to_root(parent_package, parent_map))
-    output_file = os.path.join(output_path, enum_name + ".md")
+    output_path = os.path.join(*paths.path_for(parent_id))
+    output_file = os.path.join(output_path, enumeration.name + ".md")
 
     print(output_file)
     print(output_path)
-    print(enum_name)
+    print(enumeration.name)
     render_template("enumeration.md.j2", data, output_file)
 
+    return [output_file]
 
-def get_literal_data(lit_id, root):
+
+def get_literal(lit_id, index):
     """
-    Generate literal documentaiton. One page per literal.
+    Find the ownedLiteral and Extension attribute of a literal and return the ModelLiteral.
 
     This only gets the literal attributes currently. No page is generated.
     """
 
-    owned_literal = root.find(f'.//ownedLiteral[@xmi:id="{lit_id}"]', NS)
-    literal = root.find(f'.//attribute[@xmi:idref="{lit_id}"]', NS)
-    documentation = literal.find('documentation')
-    properties = literal.find('properties')
-    bounds = literal.find('bounds')
-
-    lit_data = {}
-
-    lit_name = literal.get('name')
-    xmi_type = get_namespaced_attribute(owned_literal, "xmi:type", NS)
-    # lit_desc = documentation.get('value')
-    lit_desc = literal.find('./tags/tag[@name="definition"]').get('value')
-
-    lit_data['details'] = {
-        'id': lit_id,
-        'name': lit_name,
-        'model_prefix': PREFIX,
-        'type': xmi_type,
-        'description': lit_desc
-    }
-
-    lit_data['properties'] = process_properties(properties)
+    owned_literal = index.owned_literals.get(lit_id)
+    literal = index.attributes.get(lit_id)
 
-    lit_data['properties'].append({ 'name': 'bounds', 'value': bounds.get('lower') + ".." + bounds.get('upper') })
-    lit_data['properties'].append({ 'name': 'idref', 'value': lit_id })
-    lit_data['properties'].append({ 'name': 'scope', 'value': literal.get('scope') })
+    return literal_from_xml(owned_literal, literal)
 
-    return lit_data
 
-
-def generate_attribute_page(attr_id, root, ns, prefix, output_path):
+def generate_attribute_page(attr_id, index, prefix, output_path):
     """
     Generate attribute documentation. One page per attribute.
     """
 
     print(">>>>>", attr_id)
 
-    owned_attribute = root.find(f'.//ownedAttribute[@xmi:id="{attr_id}"]', ns)
-    attribute = root.find(f'.//attribute[@xmi:idref="{attr_id}"]', ns)
-    documentation = attribute.find('documentation')
-    properties = attribute.find('properties')
-    bounds = attribute.find('bounds')
+    attribute = attribute_from_xml(index.owned_attributes.get(attr_id), index.attributes.get(attr_id))
 
     attr_data = {}
 
-    attr_name = attribute.get('name')
-    xmi_type = get_namespaced_attribute(owned_attribute, "xmi:type", ns)
-    attr_desc = documentation.get('value')
-
-    # attr_desc = root.find(f'.//attribute[@xmi:idref="{attr_id}"]/documentation', ns).attrib.get('value')
-
     attr_data['details'] = {
-        'id': attr_id,
-        'name': attr_name,
+        'id': attribute.id,
+        'name': attribute.name,
         'model_prefix': prefix,
-        'type': xmi_type,
-        'description': attr_desc
+        'type': attribute.type,
+        'description': attribute.documentation
     }
 
-    attr_data['properties'] = process_properties(properties)
+    attr_data['properties'] = process_properties(attribute.properties)
 
-    attr_data['properties'].append({ 'name': 'bounds', 'value': bounds.get('lower') + ".." + bounds.get('upper') })
-    attr_data['properties'].append({ 'name': 'idref', 'value': attr_id })
-    attr_data['properties'].append({ 'name': 'scope', 'value': attribute.get('scope') })
+    attr_data['properties'].append({ 'name': 'bounds', 'value': attribute.bounds })
+    attr_data['properties'].append({ 'name': 'idref', 'value': attribute.id })
+    attr_data['properties'].append({ 'name': 'scope', 'value': attribute.scope })
 
     pprint(attr_data)
     os.makedirs(output_path, exist_ok=True)
-    output_file = os.path.join(output_path, attr_name + ".md")
+    output_file = os.path.join(output_path, attribute.name + ".md")
     render_template("attribute.md.j2", attr_data, output_file)
 
     print("*****")
 
-    attr = root.find(f'.//attribute[@xmi:idref="{attr_id}"]', ns)
-
-    # for element in attr:
-    #     print(element)
-    #     for at in element.attrib.items():
-    #         print(at)
-
-    print("*****")
-
-    return attr_data
-
-
-def return_property(properties, property_name):
-    """
-    Helper function to return a property value from our constructed page data.
-    """
-
-    value = None
-
-    for prop in properties:
-        if prop.get("name") == property_name:
-            value = prop.get("value")
-            break
+    return attribute
 
-    return value
 
-def generate_class_page(root, packaged_element, parent_package, parent_map: dict):
+def generate_class_page(index, id_to_name_map, packaged_element, parent_id, paths):
     """
     Generate class documentation. One page per class.
     """
 
-    id_to_name_map = generate_id_to_name_map(root, NS)
-
     data = {}
-
-    class_id = get_namespaced_attribute(packaged_element, "xmi:id", NS)
-    xmi_type = get_namespaced_attribute(packaged_element, "xmi:type", NS)
-    class_name = packaged_element.get('name')
+    pages = []
 
     ###############################################################################
     ##  Find the element and extract properties.                                 ##
     ###############################################################################
 
-    element = root.find(f'.//element[@xmi:idref="{class_id}"]', NS)
-    properties = element.find('properties')
-    links = element.find('links')
+    element = index.elements.get(packaged_element.get(XMI_ID))
 
-    # class_desc = properties.get('documentation')
-    class_desc = element.find('./tags/tag[@name="definition"]').get('value')
+    model_class = element_from_xml(packaged_element, element)
 
-    print(">> Processing class: ", class_name)
+    # class_desc = model_class.properties.get('documentation')
+    class_desc = get_description(model_class)
+
+    print(">> Processing class: ", model_class.name)
 
     ###############################################################################
     ##  Add main details of the class.                                           ##
     ###############################################################################
 
     data['details'] = {
-        'id': class_id,
-        'name': class_name,
-        'type': xmi_type,
+        'id': model_class.id,
+        'name': model_class.name,
+        'type': model_class.type,
         'model_prefix': PREFIX,
         'description': class_desc
     }
@@ -342,9 +245,7 @@ def generate_class_page(root, packaged_element, parent_package, parent_map: dict
     ##  Add the class properties.                                                ##
     ###############################################################################
 
-    # data['properties'] = process_properties(packaged_element)
-
-    data['properties'] = process_properties(properties)
+    data['properties'] = process_properties(model_class.properties)
 
     ###############################################################################
     ##  Add the class operations.                                                ##
@@ -352,22 +253,22 @@ def generate_class_page(root, packaged_element, parent_package, parent_map: dict
 
     data['operations'] = []
 
-    for op in packaged_element.findall('./ownedOperation', NS):
-        data['operations'].append({'name': op.get('name')})
+    for op in model_class.operations:
+        data['operations'].append({'name': op})
 
     ###############################################################################
     ##  Add the class relationships.                                             ##
     ###############################################################################
 
-    print(links)
+    print(model_class.links)
 
-    if links is not None:
+    if model_class.links is not None:
         data['relationships'] = []
 
-        for association in links.findall('./Association', NS):
+        for _, start, end in model_class.links_of_type('Association'):
             relationship = {
-                'start': id_to_name_map.get(association.get('start')),
-                'end': id_to_name_map.get(association.get('end'))
+                'start': id_to_name_map.get(start),
+                'end': id_to_name_map.get(end)
             }
             data['relationships'].append(relationship)
 
@@ -388,19 +289,20 @@ def generate_class_page(root, packaged_element, parent_package, parent_map: dict
         if not owned_attibute.get('association'):
 
             attr_id = get_namespaced_attribute(owned_attibute, 'xmi:id', NS)
-            attr_name = owned_attibute.get('name')
 
             #######################################################################
             ##  Generate of the attribute page.                                  ##
             #######################################################################
 
-            output_path = os.path.join(*get_path_to_root(parent_package, parent_map))
+            output_path = os.path.join(*paths.path_for(parent_id))
+
+            model_attribute = generate_attribute_page(attr_id,
+                                                      index,
+                                                      PREFIX,
+                                                      os.path.join(output_path, model_class.name))
 
-            attr_data = generate_attribute_page(attr_id,
-                                                root,
-                                                NS,
-                                                PREFIX,
-                                                os.path.join(output_path, class_name))
+            model_class.attributes.append(model_attribute)
+            pages.append(os.path.join(output_path, model_class.name, model_attribute.name + ".md"))
 
             #######################################################################
             ##  End of attribute page generation.                                ##
@@ -411,10 +313,10 @@ def generate_class_page(root, packaged_element, parent_package, parent_map: dict
             #######################################################################
 
             attribute = {
-                'visibility': return_property(attr_data['properties'], 'scope'),
-                'name': attr_name,
-                'type': return_property(attr_data['properties'], 'type'),
-                'description': attr_data['details']['description'],
+                'visibility': model_attribute.scope,
+                'name': owned_attibute.get('name'),
+                'type': model_attribute.data_type,
+                'description': model_attribute.documentation,
             }
 
             data['attributes'].append(attribute)
@@ -423,140 +325,12 @@ def generate_class_page(root, packaged_element, parent_package, parent_map: dict
     ##  Back to handling the Class.                                              ##
     ###############################################################################
 
-    output_path = os.path.join(*get_path_to_root(parent_package, parent_map))
-    os.makedirs(os.path.join(output_path, class_name), exist_ok=True)
-    output_file = os.path.join(output_path, class_name, "index.md")
+    output_path = os.path.join(*paths.path_for(parent_id))
+    os.makedirs(os.path.join(output_path, model_class.name), exist_ok=True)
+    output_file = os.path.join(output_path, model_class.name, "index.md")
     render_template("class.md.j2", data, output_file)
 
-
-def generate_datatype_pages(model_file, prefix, output_path):
-    """
-    Generate data type documentation. One page per data type.
-    """
-    print("Processing DataTypes")
-
-    tree = ET.parse(model_file)
-    root = tree.getroot()
-
-    ns = { 'xmi': 'http://schema.omg.org/spec/XMI/2.1', 'uml': 'http://schema.omg.org/spec/UML/2.0' }
-
-    id_to_name_map = generate_id_to_name_map(root, ns)
-
-    os.makedirs(os.path.join(output_path, "classes"), exist_ok=True)
-
-    # Find all DataTypes
-    for packaged_element in root.findall('.//packagedElement[@xmi:type="uml:DataType"]', ns):
-
-        data = {}
-
-        datatype_id = get_namespaced_attribute(packaged_element, "xmi:id", ns)
-        xmi_type = get_namespaced_attribute(packaged_element, "xmi:type", ns)
-        datatype_name = packaged_element.get('name')
-
-        ###############################################################################
-        ##  Find the element and extract properties.                                 ##
-        ###############################################################################
-
-        element = root.find(f'.//element[@xmi:idref="{datatype_id}"]', ns)
-        properties = element.find('properties')
-        links = element.find('links')
-
-        datatype_desc = properties.get('documentation')
-
-        ###############################################################################
-        ##  Add the main details of the datatype.                                    ##
-        ###############################################################################
-
-        data['details'] = {
-            'id': datatype_id,
-            'name': datatype_name,
-            'model_prefix': prefix,
-            'type': xmi_type,
-            'description': datatype_desc
-        }
-
-        ###############################################################################
-        ##  Add the properties of the datatype.                                      ##
-        ###############################################################################
-
-        # data['properties'] = process_properties(packaged_element)
-
-        data['properties'] = process_properties(properties)
-
-        ###############################################################################
-        ##  Add the generalized elements of the datatype.                            ##
-        ###############################################################################
-
-        data['generalized_elements'] = []
-
-        for gen in packaged_element.findall('./generalization', ns):
-            data['generalized_elements'].append(id_to_name_map.get(gen.get('general'), None))
-
-        ###############################################################################
-        ##  Add the specialized elements of the datatype.                            ##
-        ###############################################################################
-
-        # TODO: complete this
-
-        ###############################################################################
-        ##  Add the datatype relationships.                                          ##
-        ###############################################################################
-
-        print(links)
-
-        if links is not None:
-            data['relationships'] = []
-
-            for generalization in links.findall('./Generalization', ns):
-                relationship = {
-                    'start': id_to_name_map.get(generalization.get('start')),
-                    'end': id_to_name_map.get(generalization.get('end'))
-                }
-                data['relationships'].append(relationship)
-
-        pprint(data)
-
-        output_file = os.path.join(output_path, datatype_name + ".md")
-        render_template("datatype.md.j2", data, output_file)
-
-    # Find all PrimitiveType elements
-    for packaged_element in root.findall('.//packagedElement[@xmi:type="uml:PrimitiveType"]', ns):
-
-        data = {}
-
-        datatype_id = get_namespaced_attribute(packaged_element, "xmi:id", ns)
-        xmi_type = get_namespaced_attribute(packaged_element, "xmi:type", ns)
-        datatype_name = packaged_element.get('name')
-
-        data['details'] = {
-            'id': datatype_id,
-            'name': datatype_name,
-            'type': xmi_type,
-            'model_prefix': prefix,
-            'description': None
-        }
-
-        ###############################################################################
-        ##  Add the generalization elements of the datatype.                         ##
-        ###############################################################################
-
-        data['generalized_elements'] = []
-
-        for generalization in packaged_element.findall('./generalization', ns):
-            data['generalized_elements'].append(get_namespaced_attribute(generalization, "xmi:id", ns))
-
-        ###############################################################################
-        ##  Add the properties elements of the datatype.                             ##
-        ###############################################################################
-
-        data['properties'] = process_properties(packaged_element)
-
-        data['properties'].append({ 'name': datatype_id })
-
-        pprint(data)
-
-        output_file = os.path.join(output_path, datatype_name + ".md")
-        render_template("datatype.md.j2", data, output_file)
+    return [output_file] + pages
 
 
 def generate_diagram_pages(model_file, prefix, output_path):
@@ -573,6 +347,8 @@ def generate_diagram_pages(model_file, prefix, output_path):
 
     os.makedirs(os.path.join(output_path, "images"), exist_ok=True)
 
+    images = ImageSync(output_path)
+
     # Find all DataTypes
     for diagram in root.findall('.//diagram', ns):
         id = get_namespaced_attribute(diagram, 'xmi:id', ns)
@@ -586,15 +362,18 @@ def generate_diagram_pages(model_file, prefix, output_path):
             'model_prefix': prefix
         }
 
-        shutil.copy(os.path.join("model", "Images", id + ".png"), os.path.join(output_path, "images"))
+        images.reference(os.path.join("model", "Images", id + ".png"), os.path.join(output_path, "images", id + ".png"))
 
         output_file = os.path.join(output_path, name.lower() + "_diagram.md")
         render_template("diagram.md.j2", data, output_file)
 
+    images.sync()
+    images.report()
+
 
-def generate_package_page(root, packaged_element, parent_map: dict):
+def generate_package_page(index, packaged_element, paths, links=None):
     """
-    Generate package pages.
+    Generate package pages, with a Mermaid class diagram of the package if there is a LinkIndex.
 
     Accepts the packagedElement of xmi:type uml:package.
     """
@@ -602,8 +381,17 @@ def generate_package_page(root, packaged_element, parent_map: dict):
     data = {}
 
     package_id = get_namespaced_attribute(packaged_element, 'xmi:id', NS)
-    xmi_type = get_namespaced_attribute(packaged_element, "xmi:type", NS)
-    package_name = packaged_element.get('name')
+
+    ###############################################################################
+    ##  Find the element and extract properties.                                 ##
+    ###############################################################################
+
+    element = index.elements.get(package_id)
+    model_package = element_from_xml(packaged_element, element)
+
+    xmi_type = model_package.type
+    package_name = model_package.name
+    properties = model_package.properties
 
     print("Generating package page for {}".format(package_name))
 
@@ -613,18 +401,11 @@ def generate_package_page(root, packaged_element, parent_map: dict):
     # else:
     #     output_path = os.path.join(OUTPUT_DIR, package_name)
 
-    output_path = os.path.join(*get_path_to_root(package_name, parent_map))
+    output_path = os.path.join(*paths.path_for(package_id))
 
     os.makedirs(output_path, exist_ok=True)
 
-    ###############################################################################
-    ##  Find the element and extract properties.                                 ##
-    ###############################################################################
-
-    element = root.find(f'.//element[@xmi:idref="{package_id}"]', NS)
-    properties = element.find('properties')
-
-    package_desc = element.find('./tags/tag[@name="definition"]').get('value')
+    package_desc = get_description(model_package)
     # package_desc = properties.get('documentation')
 
     ###############################################################################
@@ -671,71 +452,214 @@ def generate_package_page(root, packaged_element, parent_map: dict):
             })
             #data['owned_elements'].append(id_to_name_map.get(owned.get('name'), None))
 
+    ###############################################################################
+    ##  Add the class diagram of the package.                                    ##
+    ###############################################################################
+
+    if links is not None:
+        data['diagram'] = package_diagram(links, model_package)
+
     # pprint(data)
 
     output_file = os.path.join(output_path, "index.md")
     render_template("package.md.j2", data, output_file)
 
+    return [output_file]
 
-def get_path_to_root(start_node: str, parent_map: dict) -> list:
-    """
-    This takes a start node and a dictionary containing Child: Parent relationships and returns the 
-    a list of the path to the root.
+
+class OutputPaths:
     """
+    Output directories of the packages, keyed by xmi:id.
 
-    path = [start_node]
-    current_node = start_node
+    Each package is added with the xmi:id of its parent package and its directory is the path of
+    the parent directory and the package name, memoized so it is only built once per package. A
+    package with the same name as an earlier sibling gets a numbered directory, so two packages
+    never share a directory even when package names repeat.
+    """
 
-    while current_node in parent_map:
-        parent = parent_map[current_node]
-        path.append(parent)
-        current_node = parent
-    return path[::-1]
+    def __init__(self, root_dir='root'):
+        self.root_dir = root_dir
+        self.parents = {}       # xmi:id -> xmi:id of the parent package, None at the top.
+        self.dir_names = {}     # xmi:id -> directory name.
+        self.taken = set()      # (parent xmi:id, directory name) already used.
+        self.paths = {}         # xmi:id -> memoized path.
+
+    def add(self, element_id, name, parent_id=None):
+        dir_name = name or element_id
+        count = 1
+        while (parent_id, dir_name) in self.taken:
+            count += 1
+            dir_name = f"{name or element_id}-{count}"
+        self.taken.add((parent_id, dir_name))
+
+        self.parents[element_id] = parent_id
+        self.dir_names[element_id] = dir_name
+
+    def path_for(self, element_id) -> list:
+        """
+        Return the list of directories from the root to the directory of a package.
+        """
+        path = self.paths.get(element_id)
+        if path is None:
+            parent_id = self.parents[element_id]
+            parent_path = tuple(self.path_for(parent_id)) if parent_id is not None else (self.root_dir,)
+            path = self.paths[element_id] = parent_path + (self.dir_names[element_id],)
+        return list(path)
+
+
+def build_link_index(index):
+    """
+    Return the LinkIndex of the classifiers of a ModelIndex, for the package class diagrams.
+    """
+    return LinkIndex(element_from_xml(packaged_element, index.elements.get(element_id))
+                     for element_id, packaged_element in index.packaged_elements.items()
+                     if packaged_element.get(XMI_TYPE) in CLASSIFIER_TYPES)
 
 
-def loop_through_packages(model_file: str):
+def load_lookups(model_file: str, mermaid=False):
     """
-    Take a model XMI file and find the root at packagedElement of name PayloadPublication and
-    then start recursing through the uml:Packages.
+    Parse the model XMI file and return the ModelIndex, the id to name map, the packagedElement
+    named PayloadPublication and, with mermaid, the LinkIndex of the classifiers.
     """
 
     tree = ET.parse(model_file)
     root = tree.getroot()
 
-    # id_to_name_map = generate_id_to_name_map(root, ns)
+    # Build the lookup tables once for the whole model and pass them down to every page, rather
+    # than searching the whole document for each element.
+    index = ModelIndex(root, NS)
+    id_to_name_map = generate_id_to_name_map(root, NS)
 
     # element = root.find(f'.//uml:Model/', ns)
     element = root.find(f'.//uml:Model/*/packagedElement[@name="PayloadPublication"]', NS)
 
+    links = build_link_index(index) if mermaid else None
+
+    return index, id_to_name_map, element, links
+
+
+def add_child_packages(packaged_element, paths) -> list:
+    """
+    Add the child uml:Package of a package to the OutputPaths and return them in document order.
+    """
+
+    child_packages = packaged_element.findall('./packagedElement[@xmi:type="uml:Package"]', NS)
+    for child_package in child_packages:
+        paths.add(child_package.get(XMI_ID), child_package.get('name'), packaged_element.get(XMI_ID))
+    return child_packages
+
+
+def walk_packages(index, id_to_name_map, packaged_element, paths, level=0, links=None) -> list:
+    """
+    Generate the pages of a package and of every package below it and return the list of pages.
+
+    The packages are walked with an explicit stack rather than recursion, so deep namespaces do
+    not reach the recursion limit, and in document order, parent before children, the same as a
+    recursive walk. The package itself must already have been added to the OutputPaths.
+    """
+
+    pages = []
+    stack = [(packaged_element, level)]
+
+    while stack:
+        packaged_element, level = stack.pop()
+
+        pages += process_package(index, id_to_name_map, packaged_element, paths, level, links)
+
+        child_packages = add_child_packages(packaged_element, paths)
+        stack.extend((child_package, level + 1) for child_package in reversed(child_packages))
+
+    return pages
+
+
+###################################################################################################
+##  Walk the subtrees of the top-level packages across a pool of worker processes.               ##
+###################################################################################################
+
+_worker = None
+
+
+def init_worker(model_file: str, mermaid=False):
+    """
+    Parse the model and build the lookup tables once in each worker process.
+    """
+    global _worker
+    _worker = load_lookups(model_file, mermaid)
+
+
+def walk_subtree(package_id: str) -> list:
+    """
+    Generate the pages of a top-level package subtree in a worker process and return the pages.
+    """
+    index, id_to_name_map, element, links = _worker
+
+    # Add PayloadPublication and all its child packages the same way as the main process does, so
+    # the directories are the same as a serial run.
+    paths = OutputPaths()
+    paths.add(element.get(XMI_ID), element.get('name'))
+    add_child_packages(element, paths)
+
+    return walk_packages(index, id_to_name_map, index.packaged_elements[package_id], paths, level=1, links=links)
+
+
+def loop_through_packages(model_file: str, jobs=1, mermaid=False):
+    """
+    Take a model XMI file and find the root at packagedElement of name PayloadPublication and
+    then walk through the uml:Packages.
+
+    With more than one job the subtree of each top-level package under PayloadPublication is walked
+    in a worker process, and the page lists of the subtrees are merged in document order. With
+    mermaid the package pages get a Mermaid class diagram of the classifiers they own.
+    """
+
+    start = time.perf_counter()
+
+    index, id_to_name_map, element, links = load_lookups(model_file, mermaid)
+
     print(element)
 
-    recurse(root, element, None, None)
+    paths = OutputPaths()
+    paths.add(element.get(XMI_ID), element.get('name'))
+
+    if jobs == 1:
+        pages = walk_packages(index, id_to_name_map, element, paths, links=links)
+    else:
+        pages = process_package(index, id_to_name_map, element, paths, links=links)
+        package_ids = [child_package.get(XMI_ID) for child_package in add_child_packages(element, paths)]
+
+        with ProcessPoolExecutor(max_workers=jobs or None, initializer=init_worker,
+                                 initargs=(model_file, mermaid)) as executor:
+            for subtree_pages in executor.map(walk_subtree, package_ids):
+                pages += subtree_pages
+
+    print(f"\n{len(pages)} pages generated in {time.perf_counter() - start:.3f}s")
 
+    return pages
 
-def recurse(root, packaged_element, parent_element, parent_map: dict, level=0):
+
+def process_package(index, id_to_name_map, packaged_element, paths, level=0, links=None):
+    """
+    Generate the pages of a uml:Package and of the enumerations and classes directly under it, and
+    return the list of pages generated.
+    """
 
     indent = "  " * level
+    pages = []
 
     package_id = get_namespaced_attribute(packaged_element, "xmi:id", NS)
     package_name = packaged_element.get('name')
     package_type = get_namespaced_attribute(packaged_element, "xmi:type", NS)
 
-    if parent_element is not None:
-        parent_name = parent_element.get('name')
-        # parent_list = parent_list + 
-        parent_map[package_name] = parent_name
-    else:
-        parent_name = 'root'
-        parent_map = {package_name: 'root'}
+    parent_name = packaged_element.getparent().get('name') if level > 0 else 'root'
 
     print(f"{indent}Level: {level}, ID: {package_id}, Name: {package_name}, Type: {package_type}, Parent: {parent_name}")
-    print(f"{indent}Parent: {get_path_to_root(package_name, parent_map)}")
+    print(f"{indent}Parent: {paths.path_for(package_id)}")
 
     #####################################################################################
     ##   Generate a package page.                                                      ##
     #####################################################################################
 
-    generate_package_page(root, packaged_element, parent_map)
+    pages += generate_package_page(index, packaged_element, paths, links)
 
     #####################################################################################
     ##                                                                                 ##
@@ -761,7 +685,7 @@ def recurse(root, packaged_element, parent_element, parent_map: dict, level=0):
         #################################################################################
 
         if element_type == "uml:Enumeration":
-            generate_enumeration_page(root, child_element, package_name, parent_map)
+            pages += generate_enumeration_page(index, child_element, package_id, paths)
 
         #################################################################################
         ##   Generate a class page.                                                    ##
@@ -770,7 +694,7 @@ def recurse(root, packaged_element, parent_element, parent_map: dict, level=0):
         # List all properties of a class
         elif element_type == "uml:Class":
 
-            generate_class_page(root, child_element, package_name, parent_map)
+            pages += generate_class_page(index, id_to_name_map, child_element, package_id, paths)
 
             # print(f"{indent}Listing all child ownedAttributes of class {package_name}")
             for child_attribute in child_element.findall("./ownedAttribute"):
@@ -786,18 +710,23 @@ def recurse(root, packaged_element, parent_element, parent_map: dict, level=0):
 
     print(f"{indent}Done with child packagedElement")
 
-    # Now find all child packages
-    for child_package in packaged_element.findall('./packagedElement[@xmi:type="uml:Package"]', NS):
-        recurse(root, child_package, packaged_element, parent_map, level + 1)
+    return pages
 
 
 def main():
     """
     Main entry point.
     """
+    parser = argparse.ArgumentParser(description="Generate documentation pages from the model hierarchy.")
+    parser.add_argument("-j", "--jobs", type=int, default=1, metavar="N",
+                        help="walk the top-level package subtrees across N worker processes, 0 for one per CPU")
+    parser.add_argument("--mermaid", action="store_true",
+                        help="add a Mermaid class diagram of the classifiers each package owns to the package pages")
+    args = parser.parse_args()
+
     model_file = os.path.join("model", "TransportSafetyModel_current_2025-10-16.xmi")
 
-    loop_through_packages(model_file)
+    loop_through_packages(model_file, jobs=args.jobs, mermaid=args.mermaid)
 
 
 if __name__ == "__main__":
@@ -1,47 +1,36 @@
-import os
-import xml.etree.ElementTree as ET
-import docx
+"""
+Generate Word documents of the classes and enumerations of a Sparx Enterprise Architect model.
 
-from pprint import pprint
+The model is parsed and indexed once with the same loader as the markdown pages, or loaded from the
+SQLite model store with --store, and both documents are written from its domain objects.
+"""
 
-def get_namespaced_attribute(element, prefix_attr_name, ns_map):
-    """
-    Gets a namespaced attribute from an Element, expanding the namespace automatically.
-    """
-    parts = prefix_attr_name.split(':', 1)
-    if len(parts) == 2:
-        prefix, attr_name = parts
-        if prefix in ns_map:
-            expanded_attr_name = f"{{{ns_map[prefix]}}}{attr_name}"
-            return element.attrib.get(expanded_attr_name)
-    # If no prefix, or prefix not in map, try to get as a regular attribute
-    return element.attrib.get(prefix_attr_name)
-
-def return_property(properties, property_name):
-    """
-    Helper function to return a property value from our constructed page data.
-    """
+import argparse
+import copy
+import os
+import re
+import time
+import docx
 
-    value = None
+from concurrent.futures import ProcessPoolExecutor
 
-    for prop in properties:
-        if prop.get("name") == property_name:
-            value = prop.get("value")
-            break
+from docx.oxml.ns import qn
 
-    return value
+from common import configure_rules, load_model, stream_model
+from domain import build_domain
+from model_store import load_model_store
 
 
-def process_properties(uml_element, id_to_name_map=None):
+def process_properties(attributes, id_to_name_map=None):
     """
-    Process all properties of an element.
+    Process all properties of an element from its dictionary of XML attributes.
 
     This will remove any with an "}" in the name which catches the xml:id and xml:type.
     """
     properties = []
     property = {}
 
-    for prop_name, prop_value in uml_element.attrib.items():
+    for prop_name, prop_value in attributes.items():
 
         if '}' not in prop_name:
 
@@ -60,46 +49,70 @@ def process_properties(uml_element, id_to_name_map=None):
     return properties
 
 
-def generate_class_document(model_file, output_path):
+def add_table(document, header, rows, style="Table Grid"):
     """
-    Generate class documentation. One word doc for all classes.
-    """
-    tree = ET.parse(model_file)
-    root = tree.getroot()
-
-    ns = { 'xmi': 'http://schema.omg.org/spec/XMI/2.1', 'uml': 'http://schema.omg.org/spec/UML/2.0'}
+    Add a table with a header row and a row for each list of values, written as str().
 
-    # Create word document for class documentation
-    class_doc = docx.Document()
+    The rows are built straight into the table XML in one pass, as copies of an empty row built
+    once with the cell widths of the table. Adding them with add_row().cells rescans every cell of
+    the table for each row, which gets slower as the table grows. The XML of each cell is the same
+    as setting cell.text.
+    """
+    table = document.add_table(rows=1, cols=len(header), style=style)
+
+    for cell, text in zip(table.rows[0].cells, header):
+        cell.text = text
+
+    tbl = table._tbl
+
+    template = tbl.add_tr()
+    for grid_col in tbl.tblGrid.gridCol_lst:
+        tc = template.add_tc()
+        tc.width = grid_col.w
+        tc.clear_content()
+        tc.add_p().add_r()
+    tbl.remove(template)
+
+    for values in rows:
+        tr = copy.deepcopy(template)
+        for r, value in zip(tr.iter(qn('w:r')), values):
+            text = str(value)
+            if not text:
+                continue
+            if '\t' in text or '\n' in text or '\r' in text:
+                # Tabs and line breaks are separate elements, leave them to python-docx.
+                r.text = text
+            else:
+                t = r.makeelement(qn('w:t'), {})
+                t.text = text
+                r.append(t)
+                if len(text.strip()) < len(text):
+                    t.set(qn('xml:space'), 'preserve')
+        tbl.append(tr)
+
+    return table
+
+
+def add_class_sections(class_doc, classes):
+    """
+    Add a heading, the definition and the attribute table of each class to a word doc.
+    """
 
-    # Find all Classes
-    for packaged_element in root.findall('.//packagedElement[@xmi:type="uml:Class"]', ns):
+    for model_class in classes:
 
         data = {}
 
-
-        ###############################################################################
-        ##  Find the element and extract properties.                                 ##
-        ###############################################################################
-
-        class_id = get_namespaced_attribute(packaged_element, "xmi:id", ns)
-        xmi_type = get_namespaced_attribute(packaged_element, "xmi:type", ns)
-        class_name = packaged_element.get('name')
-        element = root.find(f'.//element[@xmi:idref="{class_id}"]', ns)
-
-        class_desc = element.find('tags').find('tag[@name="definition"]').attrib.get('value')
-
-        print(">> Processing class: ", class_name)
+        print(">> Processing class: ", model_class.name)
 
         ###############################################################################
         ##  Add main details of the class.                                           ##
         ###############################################################################
 
         data['details'] = {
-            'id': class_id,
-            'name': class_name,
-            'type': xmi_type,
-            'description': class_desc
+            'id': model_class.id,
+            'name': model_class.name,
+            'type': model_class.type,
+            'description': model_class.definition
         }
 
         ###############################################################################
@@ -109,34 +122,21 @@ def generate_class_document(model_file, output_path):
         data['attributes'] = []
         attribute = {}
 
-        for owned_attibute in packaged_element.findall('./ownedAttribute', ns):
-
-            print("ownedAttribute Name: ", owned_attibute.get('name'))
+        for model_attribute in model_class.attributes:
 
             # Sparx Enterprise Architect puts associations as ownedAttribute of type uml:Property as well
-            if not owned_attibute.get('association'):
-
-                attr_id = get_namespaced_attribute(owned_attibute, 'xmi:id', ns)
-                attr_name = owned_attibute.get('name')
-
-                #######################################################################
-                ##  Get the relevant attribute data.                                 ##
-                #######################################################################
-
-                attr_data = get_attribute_data(attr_id,
-                                                    root,
-                                                    ns)
+            if not model_attribute.association:
 
                 #######################################################################
                 ##  Add attributes for class table.                                  ##
                 #######################################################################
 
                 attribute = {
-                    'visibility': return_property(attr_data['properties'], 'scope'),
-                    'name': attr_name,
-                    'type': return_property(attr_data['properties'], 'type'),
-                    'description': attr_data['details']['description'],
-                    'optionality': [d for d in attr_data['properties'] if d.get("name") == "bounds"][0].get('value')
+                    'visibility': model_attribute.scope,
+                    'name': model_attribute.name,
+                    'type': model_attribute.data_type,
+                    'description': model_attribute.definition,
+                    'optionality': model_attribute.bounds
                 }
 
                 data['attributes'].append(attribute)
@@ -149,111 +149,49 @@ def generate_class_document(model_file, output_path):
         class_doc.add_paragraph(data['details']['description'])
 
         rows = [[attr["name"], attr["type"], attr["description"], attr["optionality"]] for attr in data['attributes']]
-        class_table = class_doc.add_table(rows=1, cols=4, style="Table Grid")
-
-        hdr_cells = class_table.rows[0].cells
-        hdr_cells[0].text = "Attribute Name"
-        hdr_cells[1].text = "Data Type"
-        hdr_cells[2].text = "Definition"
-        hdr_cells[3].text = "Optionality"
+        add_table(class_doc, ["Attribute Name", "Data Type", "Definition", "Optionality"], rows)
 
-        for name, type, description, optionality in rows:
-            row_cells = class_table.add_row().cells
-            row_cells[0].text = str(name)
-            row_cells[1].text = str(type)
-            row_cells[2].text = str(description)
-            row_cells[3].text = str(optionality)
-
-    # Save Documentation
-    os.makedirs(output_path, exist_ok=True)
-    class_doc.save(os.path.join(output_path, 'classes.docx'))
 
-def get_attribute_data(attr_id, root, ns):
+def generate_class_document(model, output_path):
     """
-    Generate attribute documentation. One page per attribute.
+    Generate class documentation. One word doc for all classes.
     """
 
-    print(">>>>>", attr_id)
-
-    owned_attribute = root.find(f'.//ownedAttribute[@xmi:id="{attr_id}"]', ns)
-    attribute = root.find(f'.//attribute[@xmi:idref="{attr_id}"]', ns)
-    properties = attribute.find('properties')
-    bounds = attribute.find('bounds')
-
-    attr_data = {}
-
-    attr_name = attribute.get('name')
-    xmi_type = get_namespaced_attribute(owned_attribute, "xmi:type", ns)
-    attr_desc = attribute.find('tags').find('tag[@name="definition"]').attrib.get('value')
-
-    attr_data['details'] = {
-        'id': attr_id,
-        'name': attr_name,
-        'type': xmi_type,
-        'description': attr_desc
-    }
-
-    attr_data['properties'] = process_properties(properties)
-
-    attr_data['properties'].append({ 'name': 'bounds', 'value': bounds.get('lower') + ".." + bounds.get('upper') })
-    attr_data['properties'].append({ 'name': 'idref', 'value': attr_id })
-    attr_data['properties'].append({ 'name': 'scope', 'value': attribute.get('scope') })
-
-    pprint(attr_data)
+    # Create word document for class documentation
+    class_doc = docx.Document()
 
-    print("*****")
+    add_class_sections(class_doc, model.domain_of_type('uml:Class'))
 
-    return attr_data
+    # Save Documentation
+    os.makedirs(output_path, exist_ok=True)
+    class_doc.save(os.path.join(output_path, 'classes.docx'))
 
 
-def generate_enumeration_document(model_file, output_path):
+def add_enumeration_sections(enum_doc, enumerations):
     """
-    Generate enumeration documentation. One page per enumeration.
+    Add a heading, the definition and the literal table of each enumeration to a word doc.
     """
-    tree = ET.parse(model_file)
-    root = tree.getroot()
-
-    ns = { 'xmi': 'http://schema.omg.org/spec/XMI/2.1', 'uml': 'http://schema.omg.org/spec/UML/2.0' }
-
-    # Create Word document for enumeration documentation
-    enum_doc = docx.Document()
-
 
-    # Find all Enumerations
-    for packaged_element in root.findall('.//packagedElement[@xmi:type="uml:Enumeration"]', ns):
+    for enumeration in enumerations:
 
         data = {}
 
-        enum_id = get_namespaced_attribute(packaged_element, "xmi:id", ns)
-        xmi_type = get_namespaced_attribute(packaged_element, "xmi:type", ns)
-        enum_name = packaged_element.get('name')
-
-        ###############################################################################
-        ##  Find the element.                                                        ##
-        ###############################################################################
-
-        element = root.find(f'.//element[@xmi:idref="{enum_id}"]', ns)
-        properties = element.find('properties')
-
-        # enum_desc = properties.get('documentation')
-        enum_desc = element.find('tags').find('tag[@name="definition"]').attrib.get('value')
-
         ###############################################################################
         ##  Add the main details of the enumeration.                                 ##
         ###############################################################################
 
         data['details'] = {
-             'id': enum_id,
-             'name': enum_name,
-             'type': xmi_type,
-             'description': enum_desc
+             'id': enumeration.id,
+             'name': enumeration.name,
+             'type': enumeration.type,
+             'description': enumeration.definition
         }
 
         ###############################################################################
         ##  Add the properties of the enumeration.                                   ##
         ###############################################################################
 
-        data['properties'] = process_properties(properties)
+        data['properties'] = process_properties(enumeration.properties)
 
         ###############################################################################
         ##  Loop through the ownedLiterals.                                          ##
@@ -262,29 +200,12 @@ def generate_enumeration_document(model_file, output_path):
         data['literals'] = []
         literal = {}
 
-        for owned_literal in packaged_element.findall('./ownedLiteral', ns):
-
-            lit_id = get_namespaced_attribute(owned_literal, 'xmi:id', ns)
-            lit_name = owned_literal.get('name')
-            lit_type = owned_literal.get('type')
-
-            ###########################################################################
-            ##  Get the literal attributes.                                          ##
-            ###########################################################################
-
-            lit_data = get_literal_data(lit_id,
-                                             root,
-                                             ns,
-                                             os.path.join(output_path, enum_name))
-
-            ###########################################################################
-            ##  End of get the literal attributes.                                   ##
-            ###########################################################################
+        for model_literal in enumeration.literals:
 
             literal = {
-                'visibility': return_property(lit_data['properties'], 'scope'),
-                'name': lit_name,
-                'description': lit_data['details']['description']
+                'visibility': model_literal.scope,
+                'name': model_literal.name,
+                'description': model_literal.definition
             }
 
             data['literals'].append(literal)
@@ -297,65 +218,163 @@ def generate_enumeration_document(model_file, output_path):
         enum_doc.add_paragraph(data['details']['description'])
 
         rows = [[lit["name"], lit["description"]] for lit in data['literals']]
-        enum_table = enum_doc.add_table(rows=1, cols=2, style="Table Grid")
+        add_table(enum_doc, ["Value", "Definition"], rows)
 
-        hdr_cells = enum_table.rows[0].cells
-        hdr_cells[0].text = "Value"
-        hdr_cells[1].text = "Definition"
 
-        for value, description in rows:
-            row_cells = enum_table.add_row().cells
-            row_cells[0].text = str(value)
-            row_cells[1].text = str(description)
+def generate_enumeration_document(model, output_path):
+    """
+    Generate enumeration documentation. One page per enumeration.
+    """
+
+    # Create Word document for enumeration documentation
+    enum_doc = docx.Document()
+
+    add_enumeration_sections(enum_doc, model.domain_of_type('uml:Enumeration'))
 
     os.makedirs(output_path, exist_ok=True)
     enum_doc.save(os.path.join(output_path, 'enumerations.docx'))
 
 
+###################################################################################################
+##  One word doc per top-level package, built across a pool of worker processes.                 ##
+###################################################################################################
 
-def get_literal_data(lit_id, root, ns, output_path):
+def package_shards(model):
     """
-    Generate literal documentaiton. One page per literal.
+    Group the classes and enumerations by top-level package and return a shard for each package,
+    in document order, with the file name of its word doc.
 
-    This only get the literal attributes currently. No page is generated.
+    The top-level packages are the packages where the package hierarchy first branches, below the
+    chain of single packages that wrap the whole model in an Enterprise Architect export. Elements
+    directly in the last package of that chain get a shard of their own.
+    """
+    elements = model.domain_of_type('uml:Class') + model.domain_of_type('uml:Enumeration')
+
+    prefix = elements[0].package_path if elements else ()
+    for element in elements:
+        common_length = 0
+        for a, b in zip(prefix, element.package_path):
+            if a != b:
+                break
+            common_length += 1
+        prefix = prefix[:common_length]
+
+    shards = {}
+    for element in elements:
+        package_path = element.package_path[:len(prefix) + 1]
+        if package_path not in shards:
+            shards[package_path] = {'package_path': package_path, 'classes': [], 'enumerations': []}
+        if element.type == 'uml:Class':
+            shards[package_path]['classes'].append(element)
+        else:
+            shards[package_path]['enumerations'].append(element)
+
+    # Order the shards by the first class or enumeration in them and give each a unique file name.
+    first = {id(element): position for position, element in enumerate(model.domain.values())}
+    shards = sorted(shards.values(), key=lambda shard: min(first[id(element)] for element in
+                                                           shard['classes'] + shard['enumerations']))
+    names = set()
+    for shard in shards:
+        name = base = re.sub(r'[^\w.-]', '_', shard['package_path'][-1] if shard['package_path'] else 'Model')
+        count = 1
+        while name.lower() in names:
+            count += 1
+            name = f"{base}-{count}"
+        names.add(name.lower())
+        shard['file_name'] = name + ".docx"
+
+    return shards
+
+
+def generate_package_document(shard, output_path):
     """
+    Generate the word doc of a shard, with its classes then its enumerations, and return its file
+    name and counts. Runs in a worker process.
+    """
+
+    package_doc = docx.Document()
+    package_doc.add_heading("/".join(shard['package_path']), 0)
 
-    owned_literal = root.find(f'.//ownedLiteral[@xmi:id="{lit_id}"]', ns)
-    literal = root.find(f'.//attribute[@xmi:idref="{lit_id}"]', ns)
-    documentation = literal.find('documentation')
-    properties = literal.find('properties')
-    bounds = literal.find('bounds')
+    add_class_sections(package_doc, shard['classes'])
+    add_enumeration_sections(package_doc, shard['enumerations'])
 
-    lit_data = {}
+    package_doc.save(os.path.join(output_path, shard['file_name']))
 
-    lit_name = literal.get('name')
-    xmi_type = get_namespaced_attribute(owned_literal, "xmi:type", ns)
-    
-    lit_desc = literal.find('tags').find('tag[@name="definition"]').attrib.get('value')
+    return shard['file_name'], len(shard['classes']), len(shard['enumerations'])
 
-    lit_data['details'] = {
-        'id': lit_id,
-        'name': lit_name,
-        'type': xmi_type,
-        'description': lit_desc
-    }
 
-    lit_data['properties'] = process_properties(properties)
+def generate_package_documents(model, output_path, jobs=1, index=False):
+    """
+    Generate one word doc per top-level package, across a pool of jobs worker processes, and an
+    index doc listing them if index is True.
+    """
+
+    start = time.perf_counter()
+
+    shards = package_shards(model)
+    os.makedirs(output_path, exist_ok=True)
 
-    lit_data['properties'].append({ 'name': 'bounds', 'value': bounds.get('lower') + ".." + bounds.get('upper') })
-    lit_data['properties'].append({ 'name': 'idref', 'value': lit_id })
-    lit_data['properties'].append({ 'name': 'scope', 'value': literal.get('scope') })
+    jobs = jobs if jobs > 0 else os.cpu_count()
+    if jobs > 1 and len(shards) > 1:
+        # Each worker only gets the domain objects of its own shards.
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            documents = list(executor.map(generate_package_document, shards, [output_path] * len(shards)))
+    else:
+        documents = [generate_package_document(shard, output_path) for shard in shards]
 
-    return lit_data
+    if index:
+        index_doc = docx.Document()
+        index_doc.add_heading("Model documents", 0)
+        rows = [[file_name, "/".join(shard['package_path']), classes, enumerations]
+                for shard, (file_name, classes, enumerations) in zip(shards, documents)]
+        add_table(index_doc, ["Document", "Package", "Classes", "Enumerations"], rows)
+        index_doc.save(os.path.join(output_path, 'index.docx'))
+
+    print(f"\n{len(documents)} package documents generated in {time.perf_counter() - start:.3f}s")
+
+    return documents
 
 
 def main():
+    parser = argparse.ArgumentParser(description="Generate Word documents of the classes and enumerations of an XMI model.")
+    parser.add_argument("--stream", action="store_true",
+                        help="stream the XMI with iterparse instead of loading the whole tree, for very large exports")
+    parser.add_argument("--store", metavar="DB",
+                        help="generate from the SQLite model store built by model_store.py instead of the XMI")
+    parser.add_argument("--rules", metavar="FILE",
+                        help="JSON file of package skip and include rules, by default every package is documented")
+    parser.add_argument("--by-package", action="store_true",
+                        help="write one word doc per top-level package instead of classes.docx and enumerations.docx")
+    parser.add_argument("-j", "--jobs", type=int, default=1, metavar="N",
+                        help="with --by-package, build the word docs across N worker processes, 0 for one per CPU")
+    parser.add_argument("--index", action="store_true",
+                        help="with --by-package, also write index.docx listing the package word docs")
+    args = parser.parse_args()
+
+    if args.store and not os.path.isfile(args.store):
+        parser.error(f"model store '{args.store}' does not exist, build it with model_store.py")
+
     model_file = os.path.join("model", "TransportSafetyModel.xmi")
     output_dir = "output_word"
 
-    generate_class_document(model_file, os.path.join(output_dir))
+    # Parse and index the model once for both documents.
+    configure_rules(args.rules)
+    if args.store:
+        try:
+            model = load_model_store(args.store)
+        except ValueError as e:
+            parser.error(str(e))
+    else:
+        model = stream_model(model_file) if args.stream else load_model(model_file)
+        build_domain(model)
+
+    if args.by_package:
+        generate_package_documents(model, output_dir, jobs=args.jobs, index=args.index)
+        return
+
+    generate_class_document(model, os.path.join(output_dir))
 
-    generate_enumeration_document(model_file, os.path.join(output_dir))
+    generate_enumeration_document(model, os.path.join(output_dir))
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
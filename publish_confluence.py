@@ -0,0 +1,797 @@
+"""
+Publish the pages generated by process_model.py to Confluence.
+
+The page manifest written by process_model.py is compared with a local sync state kept in the output
+directory so only the pages and attachments that are new or have changed since the last publish are
+sent. Pages that are no longer generated are deleted, or archived by moving them under another page.
+
+The markdown is converted to Confluence storage format with md2conf, the same as running md2conf on
+the whole output directory, and the connection settings are read from the same CONFLUENCE_*
+environment variables. Pages generated with --format confluence are already in storage format and
+are uploaded as they are, with the title, labels and attachments given in their leading comments.
+
+The pages are published concurrently: asyncio schedules the blocking requests and conversions on a
+pool of threads sharing the pooled connections of one session, and a page is only created once its
+parent page exists. The number of requests in flight adapts to how fast Confluence responds and how
+often it throttles the requests, which are retried after the Retry-After time it gives. The index
+and class pages are sent before the attribute pages, and the sync state is saved as the publish
+goes so an interrupted publish carries on where it stopped.
+"""
+
+import argparse
+import asyncio
+import email.utils
+import hashlib
+import heapq
+import html
+import itertools
+import json
+import os
+import posixpath
+import random
+import re
+import sys
+import threading
+import time
+
+import requests
+
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from dotenv import load_dotenv
+from pathlib import Path
+
+from md2conf.collection import ConfluencePageCollection
+from md2conf.converter import (ConfluenceDocument, ConfluenceDocumentOptions, ConversionError, DocumentError,
+                               ParseError, attachment_name)
+from md2conf.extra import path_relative_to
+from md2conf.metadata import ConfluencePageMetadata, ConfluenceSiteMetadata
+from md2conf.properties import ArgumentError, ConfluenceConnectionProperties
+from md2conf.scanner import Scanner
+
+from common import PageManifest
+
+
+SYNC_STATE_FILE = ".confluence_sync.json"
+
+# Pages generated in Confluence storage format, and the comments at their start with the page title,
+# labels and attachments.
+STORAGE_EXTENSION = ".xhtml"
+STORAGE_FIELD = re.compile(r"<!--\s*(title|labels|attachments):(.*?)-->")
+STORAGE_HEADER_SIZE = 4096
+
+DEFAULT_CONCURRENCY = 16
+INITIAL_CONCURRENCY = 4
+MIN_CONCURRENCY = 1
+
+# How the scheduler adapts the concurrency to the response times and throttling.
+DECREASE_FACTOR = 0.5
+LATENCY_TOLERANCE = 2.0
+LATENCY_SMOOTHING = 0.2
+BASELINE_SMOOTHING = 0.01
+
+# Seconds between saves of the sync state during a publish.
+CHECKPOINT_INTERVAL = 10.0
+
+# Responses which mean Confluence is throttling the requests, and the retry limits.
+RETRY_STATUS = (429, 503)
+MAX_RETRIES = 6
+BACKOFF = 1.0
+MAX_BACKOFF = 60.0
+
+
+class ConfluenceClient:
+    """
+    Client for the Confluence REST API content endpoints used to publish pages and attachments.
+
+    The client is shared by the publishing threads, which reuse the pooled connections of one session
+    instead of opening a new connection for each request.
+    """
+
+    def __init__(self, properties: ConfluenceConnectionProperties, concurrency=DEFAULT_CONCURRENCY,
+                 max_retries=MAX_RETRIES):
+        self.space_key = properties.space_key
+        self.api_url = properties.api_url or f"https://{properties.domain}{properties.base_path}"
+        if not self.api_url.endswith("/"):
+            self.api_url += "/"
+
+        self.session = requests.Session()
+        if properties.user_name:
+            self.session.auth = (properties.user_name, properties.api_key)
+        else:
+            self.session.headers.update({"Authorization": f"Bearer {properties.api_key}"})
+        if properties.headers:
+            self.session.headers.update(properties.headers)
+
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=concurrency)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+        self.max_retries = max_retries
+        self.observer = None
+        self.requests = 0
+        self.retries = 0
+        self.lock = threading.Lock()
+
+    def _request(self, method, path, **kwargs):
+        for attempt in itertools.count():
+            with self.lock:
+                self.requests += 1
+            start = time.perf_counter()
+            response = self.session.request(method, f"{self.api_url}rest/api/{path}", **kwargs)
+            if self.observer is not None:
+                self.observer(time.perf_counter() - start, response.status_code in RETRY_STATUS)
+            if response.status_code not in RETRY_STATUS or attempt >= self.max_retries:
+                break
+
+            delay = retry_delay(response, attempt)
+            print(f"Throttled with {response.status_code}, retrying {method} {path} in {delay:.1f}s")
+            with self.lock:
+                self.retries += 1
+            time.sleep(delay)
+
+        response.raise_for_status()
+        return response.json() if response.content else None
+
+    def get_page(self, page_id, expand="version"):
+        return self._request("GET", f"content/{page_id}", params={"expand": expand})
+
+    def find_page(self, title):
+        """
+        Return the page in the space with the title, or None.
+        """
+        data = self._request("GET", "content", params={"title": title,
+                                                       "spaceKey": self.space_key,
+                                                       "expand": "version"})
+        results = data.get("results", [])
+        return results[0] if len(results) == 1 else None
+
+    def create_page(self, parent_id, title, content):
+        request = {
+            "type": "page",
+            "title": title,
+            "space": {"key": self.space_key},
+            "ancestors": [{"id": parent_id}],
+            "body": {"storage": {"value": content, "representation": "storage"}},
+        }
+        return self._request("POST", "content", json=request)
+
+    def update_page(self, page_id, title, content, version, parent_id=None):
+        request = {
+            "id": page_id,
+            "type": "page",
+            "title": title,
+            "space": {"key": self.space_key},
+            "body": {"storage": {"value": content, "representation": "storage"}},
+            "version": {"number": version, "minorEdit": True},
+        }
+        if parent_id is not None:
+            request["ancestors"] = [{"id": parent_id}]
+        return self._request("PUT", f"content/{page_id}", json=request)
+
+    def delete_page(self, page_id):
+        return self._request("DELETE", f"content/{page_id}")
+
+    def add_labels(self, page_id, labels):
+        return self._request("POST", f"content/{page_id}/label",
+                             json=[{"prefix": "global", "name": label} for label in labels])
+
+    def find_attachment(self, page_id, name):
+        data = self._request("GET", f"content/{page_id}/child/attachment", params={"filename": name})
+        results = data.get("results", [])
+        return results[0] if results else None
+
+    def upload_attachment(self, page_id, name, path, attachment_id=None):
+        """
+        Upload a file as a new attachment, or as a new version of an existing attachment.
+        """
+        if attachment_id is None:
+            url = f"content/{page_id}/child/attachment"
+        else:
+            url = f"content/{page_id}/child/attachment/{attachment_id}/data"
+
+        # The file is read up front so a retried request sends it again.
+        with open(path, "rb") as file:
+            content = file.read()
+
+        data = self._request("POST", url,
+                             files={"file": (name, content, "application/octet-stream")},
+                             headers={"X-Atlassian-Token": "no-check"})
+
+        return data["results"][0] if "results" in data else data
+
+
+def is_status(err, *status_codes):
+    """
+    Return whether an HTTP error is a response with one of the status codes.
+    """
+    return err.response is not None and err.response.status_code in status_codes
+
+
+def retry_delay(response, attempt):
+    """
+    Return the seconds to wait before retrying a throttled request, from its Retry-After header or
+    else an exponential backoff with jitter. The wait is never longer than MAX_BACKOFF, whatever the
+    header asks for.
+    """
+    retry_after = response.headers.get("Retry-After")
+    if retry_after:
+        try:
+            return min(MAX_BACKOFF, max(0.0, float(retry_after)))
+        except ValueError:
+            pass
+        try:
+            retry_at = email.utils.parsedate_to_datetime(retry_after)
+            return min(MAX_BACKOFF, max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds()))
+        except (TypeError, ValueError, OverflowError):
+            pass
+
+    return min(MAX_BACKOFF, BACKOFF * 2 ** attempt) * random.uniform(0.5, 1.0)
+
+
+class SyncState:
+    """
+    The Confluence page id, version and content hash of every page published from an output
+    directory, along with the attachments uploaded to each page.
+
+    This is the map from the output paths to the Confluence pages that publishing trusts, so a page
+    in it is updated without first looking up the page or its current version.
+    """
+
+    def __init__(self, output_dir):
+        self.path = os.path.join(output_dir, SYNC_STATE_FILE)
+        self.pages = {}
+
+        if os.path.isfile(self.path):
+            with open(self.path, encoding="utf-8") as file:
+                self.pages = json.load(file).get("pages", {})
+
+    def save(self):
+        # Written to a new file first so a publish stopped while saving leaves the last state.
+        with open(self.path + ".tmp", "w", encoding="utf-8") as file:
+            json.dump({"version": 1, "pages": self.pages}, file, indent=1, sort_keys=True)
+        os.replace(self.path + ".tmp", self.path)
+
+
+def file_hash(path):
+    """
+    Return the SHA-256 hash of a file.
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def read_storage_page(path):
+    """
+    Return the title, labels, attachments and content of a page written in Confluence storage format.
+
+    The title, labels and the paths of the files to attach, relative to the page, are given in
+    comments at the start of the page, the same as the front matter of a markdown page, and the
+    comments are left in the content. The page refers to each attachment by its file name.
+    """
+    content = Path(path).read_text(encoding="utf-8")
+    fields = dict(STORAGE_FIELD.findall(content[:STORAGE_HEADER_SIZE]))
+    title = html.unescape(fields.get("title", "").strip()) or Path(path).stem
+    labels = sorted(set(split_field(fields.get("labels", ""))))
+    attachments = split_field(fields.get("attachments", ""))
+    return title, labels, attachments, content
+
+
+def split_field(value):
+    return [item.strip() for item in html.unescape(value).split(",") if item.strip()]
+
+
+def is_storage_page(page):
+    return posixpath.splitext(page)[1] == STORAGE_EXTENSION
+
+
+def is_index_page(page):
+    return posixpath.splitext(posixpath.basename(page))[0] == "index"
+
+
+def get_parent_page(page, pages):
+    """
+    Return the page that is the parent of a page in Confluence, or None for the root page.
+
+    The same as md2conf, the index page of a directory is the parent of the other pages in the
+    directory and of the index pages of its sub-directories.
+    """
+    directory = posixpath.dirname(page)
+    index = "index" + posixpath.splitext(page)[1]
+    if is_index_page(page):
+        if not directory:
+            return None
+        directory = posixpath.dirname(directory)
+
+    while True:
+        candidate = posixpath.join(directory, index) if directory else index
+        if candidate in pages and candidate != page:
+            return candidate
+        if not directory:
+            return None
+        directory = posixpath.dirname(directory)
+
+
+def page_order(page):
+    """
+    Sort key which puts parent pages before their children.
+    """
+    depth = page.count("/")
+    is_index = is_index_page(page)
+    return (depth - 1 if is_index else depth, not is_index, page)
+
+
+class Scheduler:
+    """
+    Run the blocking publishing jobs on a thread pool, in order of priority, with a limit on the
+    jobs running at once which adapts to the responses from Confluence.
+
+    The limit is adjusted by additive increase and multiplicative decrease (AIMD), the same as TCP
+    congestion control. It grows by about one job per round trip while the responses come back at
+    their usual speed, and is halved, at most once per round trip, when a request is throttled or
+    the response times go above LATENCY_TOLERANCE times their long-run average.
+    """
+
+    def __init__(self, loop, executor, maximum, initial=INITIAL_CONCURRENCY):
+        self.loop = loop
+        self.executor = executor
+        self.maximum = maximum
+        self.limit = float(max(MIN_CONCURRENCY, min(initial, maximum)))
+        self.running = 0
+        self.waiting = []
+        self.sequence = itertools.count()
+
+        self.latency = None
+        self.baseline = None
+        self.decreased_at = 0.0
+        self.decreases = 0
+        self.lowest = self.highest = int(self.limit)
+
+    async def call(self, priority, function, *args):
+        """
+        Run a blocking function on the thread pool once it is the most urgent job waiting and fewer
+        jobs than the limit are running. Lower priorities run first.
+        """
+        if self.waiting or self.running >= int(self.limit):
+            ready = self.loop.create_future()
+            heapq.heappush(self.waiting, (priority, next(self.sequence), ready))
+            try:
+                await ready
+            except asyncio.CancelledError:
+                # Hand the slot on if it was given to this job just before it was cancelled.
+                if ready.done() and not ready.cancelled():
+                    self.running -= 1
+                    self.start_waiting()
+                raise
+        else:
+            self.running += 1
+
+        try:
+            return await self.loop.run_in_executor(self.executor, function, *args)
+        finally:
+            self.running -= 1
+            self.start_waiting()
+
+    def start_waiting(self):
+        while self.waiting and self.running < int(self.limit):
+            _, _, ready = heapq.heappop(self.waiting)
+            if not ready.cancelled():
+                self.running += 1
+                ready.set_result(None)
+
+    def observe(self, latency, throttled):
+        """
+        Record the response time of a request and whether it was throttled, from any thread.
+        """
+        self.loop.call_soon_threadsafe(self.adjust, latency, throttled)
+
+    def adjust(self, latency, throttled):
+        now = time.monotonic()
+
+        if not throttled:
+            if self.latency is None:
+                self.latency = self.baseline = latency
+            self.latency += LATENCY_SMOOTHING * (latency - self.latency)
+            self.baseline += BASELINE_SMOOTHING * (latency - self.baseline)
+
+        if throttled or self.latency > LATENCY_TOLERANCE * self.baseline:
+            # Back off once for the responses to the requests sent before the last decrease.
+            if now - self.decreased_at > (self.latency or latency):
+                self.limit = max(MIN_CONCURRENCY, self.limit * DECREASE_FACTOR)
+                self.decreased_at = now
+                self.decreases += 1
+                self.lowest = min(self.lowest, int(self.limit))
+        else:
+            self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            self.highest = max(self.highest, int(self.limit))
+            self.start_waiting()
+
+
+def page_priority(page):
+    """
+    Return the priority of a page, lower first: the class and package index pages, then the
+    enumeration and data type pages, then the attribute pages of the classes.
+    """
+    if is_index_page(page):
+        return 0
+    if page.count("/") <= 1:
+        return 1
+    return 2
+
+
+class Publisher:
+    """
+    Publish the pages of an output directory with up to concurrency requests in flight.
+
+    The page requests and conversions are blocking, so they run on a pool of threads and the
+    Scheduler runs them: a page is created once its parent page exists, every page is then converted
+    and uploaded by priority, and removed pages are deleted children first. The sync state records
+    are only changed while holding the lock, so they can be saved while the publish goes on.
+    """
+
+    def __init__(self, output_dir, client, site, root_page_id, options, archive_page_id=None,
+                 concurrency=DEFAULT_CONCURRENCY):
+        if not os.path.isdir(output_dir):
+            raise ArgumentError(f"no output directory '{output_dir}', run process_model.py first")
+        self.root_dir = Path(output_dir).resolve(True)
+        self.client = client
+        self.site = site
+        self.root_page_id = root_page_id
+        self.options = options
+        self.archive_page_id = archive_page_id
+        self.concurrency = concurrency
+
+        manifest = PageManifest(output_dir)
+        if not manifest.previous:
+            raise ArgumentError(f"no page manifest in '{output_dir}', run process_model.py first")
+        self.pages = manifest.previous
+
+        self.state = SyncState(output_dir)
+        self.page_metadata = None
+
+        self.summary = {"created": 0, "updated": 0, "unchanged": 0, "removed": 0,
+                        "attachments_uploaded": 0, "attachments_unchanged": 0}
+        self.lock = threading.Lock()
+        self.locks = {}
+        self.scheduler = None
+        self.checkpointed = time.monotonic()
+
+    def count(self, key):
+        with self.lock:
+            self.summary[key] += 1
+
+    def lock_for(self, key):
+        """
+        Return the lock which makes the threads work on a page title or page id one at a time.
+        """
+        with self.lock:
+            return self.locks.setdefault(key, threading.Lock())
+
+    async def call(self, priority, function, *args):
+        """
+        Run a blocking function with the scheduler, and save the sync state every
+        CHECKPOINT_INTERVAL seconds.
+        """
+        result = await self.scheduler.call(priority, function, *args)
+        if time.monotonic() - self.checkpointed > CHECKPOINT_INTERVAL:
+            self.checkpoint()
+        return result
+
+    def checkpoint(self):
+        with self.lock:
+            self.state.save()
+        self.checkpointed = time.monotonic()
+
+    async def run(self):
+        with ThreadPoolExecutor(self.concurrency) as executor:
+            self.scheduler = Scheduler(asyncio.get_running_loop(), executor, self.concurrency)
+            self.client.observer = self.scheduler.observe
+
+            ###############################################################################
+            ##  Make sure every page exists, parents before children.                    ##
+            ###############################################################################
+
+            created = {}
+            for page in sorted(self.pages, key=page_order):
+                created[page] = asyncio.ensure_future(self.ensure_page(page, created))
+            await asyncio.gather(*created.values())
+
+            ###############################################################################
+            ##  Convert and upload the new and changed pages and attachments.            ##
+            ###############################################################################
+
+            self.page_metadata = ConfluencePageCollection()
+            for page, record in self.state.pages.items():
+                if page in self.pages:
+                    self.page_metadata.add(self.root_dir / page, ConfluencePageMetadata(
+                        page_id=record["page_id"], space_key=self.site.space_key, title=record["title"]))
+
+            await asyncio.gather(*(self.call(page_priority(page), self.update_page, page)
+                                   for page in sorted(self.pages, key=page_order)))
+
+            ###############################################################################
+            ##  Delete or archive the pages no longer generated, children first.         ##
+            ###############################################################################
+
+            # A page found by its title for a current page, e.g. after changing the --format of
+            # the output, is kept and only its old record is dropped.
+            current_ids = {self.state.pages[page]["page_id"] for page in self.pages}
+            levels = {}
+            for page in set(self.state.pages) - set(self.pages):
+                if self.state.pages[page]["page_id"] in current_ids:
+                    print(f"Page '{self.state.pages[page]['title']}' is now published from another file, "
+                          f"forgetting '{page}'")
+                    with self.lock:
+                        del self.state.pages[page]
+                    continue
+                levels.setdefault(page_order(page)[0], []).append(page)
+
+            for level in sorted(levels, reverse=True):
+                await asyncio.gather(*(self.call(page_priority(page), self.remove_page, page)
+                                       for page in sorted(levels[level])))
+
+    async def ensure_page(self, page, created):
+        """
+        Wait for the parent of a page to exist, then find or create the page.
+        """
+        parent = get_parent_page(page, self.pages)
+        if parent is not None:
+            await created[parent]
+
+        if page not in self.state.pages:
+            await self.call(page_priority(page), self.create_page, page, parent)
+
+    def create_page(self, page, parent):
+        if is_storage_page(page):
+            title, _, _, _ = read_storage_page(self.root_dir / page)
+        else:
+            title = Scanner().read(self.root_dir / page).title or Path(page).stem
+
+        # Pages with the same title are looked up one at a time, so the second finds the page
+        # created for the first instead of both trying to create it.
+        # The page is created straight away, and only looked up by its title when Confluence
+        # already has a page with the title.
+        with self.lock_for(("title", title)):
+            parent_id = self.state.pages[parent]["page_id"] if parent else self.root_page_id
+            try:
+                created = self.client.create_page(parent_id, title, "")
+            except requests.exceptions.HTTPError as err:
+                existing = self.client.find_page(title) if is_status(err, 400) else None
+                if existing is None:
+                    raise
+                print(f"Found page '{title}' {existing['id']} for '{page}'")
+                record = {"page_id": existing["id"], "version": existing["version"]["number"]}
+            else:
+                print(f"Created page '{title}' {created['id']} for '{page}'")
+                record = {"page_id": created["id"], "version": created["version"]["number"]}
+                self.count("created")
+
+        record.update({"hash": None, "title": title, "labels": [], "attachments": {}})
+        with self.lock:
+            self.state.pages[page] = record
+
+    def update_page(self, page):
+        # Pages which were found by the same title share a Confluence page and its version.
+        with self.lock_for(("page", self.state.pages[page]["page_id"])):
+            try:
+                self._update_page(page)
+            except requests.exceptions.HTTPError as err:
+                if not is_status(err, 404):
+                    raise
+                # The page was deleted in Confluence since the sync state was saved, so its record is
+                # dropped and the page is created again.
+                record = self.state.pages[page]
+                print(f"Page '{record['title']}' {record['page_id']} was deleted in Confluence, creating it again")
+                with self.lock:
+                    del self.state.pages[page]
+                self.create_page(page, get_parent_page(page, self.pages))
+                self._update_page(page)
+
+    def _update_page(self, page):
+        record = self.state.pages[page]
+        page_path = self.root_dir / page
+
+        if record["hash"] == self.pages[page]:
+            # The page is unchanged but the images it shows may have been re-exported.
+            for name, attachment in record["attachments"].items():
+                self.sync_attachment(record, name, self.root_dir / attachment["path"])
+            self.count("unchanged")
+            return
+
+        if is_storage_page(page):
+            # Already in storage format, with the links to other pages by title, so there is
+            # nothing to convert.
+            title, labels, attachments, content = read_storage_page(page_path)
+
+            for attachment in attachments:
+                image_path = Path(os.path.normpath(page_path.parent / attachment))
+                self.sync_attachment(record, posixpath.basename(attachment), image_path)
+        else:
+            try:
+                _, document = ConfluenceDocument.create(page_path, self.options, self.root_dir, self.site,
+                                                        self.page_metadata)
+            except (ConversionError, DocumentError, ParseError) as err:
+                raise ConversionError(f"cannot convert '{page}': {err.__cause__ or err}") from err
+
+            for image_path in document.images:
+                name = attachment_name(path_relative_to(image_path, page_path.parent))
+                self.sync_attachment(record, name, image_path)
+
+            title = document.title or record["title"]
+            labels = sorted(document.labels or [])
+            content = document.xhtml()
+
+        version = self.put_page(record, title, content)
+        print(f"Updated page '{title}' {record['page_id']} version {version} from '{page}'")
+
+        if labels and labels != record["labels"]:
+            self.client.add_labels(record["page_id"], labels)
+
+        with self.lock:
+            record.update({"hash": self.pages[page], "title": title, "labels": labels})
+        self.count("updated")
+
+    def put_page(self, record, title, content):
+        """
+        Update a page as the version after the one in the sync state, and return the new version.
+
+        The current version is only looked up when Confluence rejects the update because the page
+        was changed outside of the publish since the sync state was saved.
+        """
+        version = record["version"] + 1
+        try:
+            self.client.update_page(record["page_id"], title, content, version)
+        except requests.exceptions.HTTPError as err:
+            if not is_status(err, 409):
+                raise
+            version = self.client.get_page(record["page_id"])["version"]["number"] + 1
+            print(f"Page '{title}' {record['page_id']} was changed in Confluence, updating version {version}")
+            self.client.update_page(record["page_id"], title, content, version)
+
+        with self.lock:
+            record["version"] = version
+        return version
+
+    def remove_page(self, page):
+        record = self.state.pages[page]
+
+        try:
+            if self.archive_page_id:
+                current = self.client.get_page(record["page_id"], expand="version,body.storage")
+                self.client.update_page(record["page_id"], current["title"], current["body"]["storage"]["value"],
+                                        current["version"]["number"] + 1, parent_id=self.archive_page_id)
+                print(f"Archived page '{record['title']}' {record['page_id']} for '{page}'")
+            else:
+                self.client.delete_page(record["page_id"])
+                print(f"Deleted page '{record['title']}' {record['page_id']} for '{page}'")
+        except requests.exceptions.HTTPError as err:
+            if not is_status(err, 404):
+                raise
+            print(f"Page '{record['title']}' {record['page_id']} for '{page}' was already deleted in Confluence")
+
+        with self.lock:
+            del self.state.pages[page]
+        self.count("removed")
+
+    def sync_attachment(self, record, name, path):
+        """
+        Upload an attachment of a page if the file has changed since it was last uploaded.
+        """
+        attachment = record["attachments"].get(name, {})
+
+        if not path.is_file():
+            print(f"Attachment '{path}' not found")
+            return
+
+        digest = file_hash(path)
+        if attachment.get("hash") == digest:
+            self.count("attachments_unchanged")
+            return
+
+        # A new attachment is uploaded straight away, and only looked up when the page already has
+        # an attachment with the name.
+        try:
+            uploaded = self.client.upload_attachment(record["page_id"], name, path, attachment.get("id"))
+        except requests.exceptions.HTTPError as err:
+            existing = None
+            if is_status(err, 400) and attachment.get("id") is None:
+                existing = self.client.find_attachment(record["page_id"], name)
+            if existing is None:
+                raise
+            uploaded = self.client.upload_attachment(record["page_id"], name, path, existing["id"])
+        print(f"Uploaded attachment '{name}' to page {record['page_id']}")
+
+        with self.lock:
+            record["attachments"][name] = {
+                "path": path.relative_to(self.root_dir).as_posix(),
+                "hash": digest,
+                "id": uploaded["id"],
+            }
+        self.count("attachments_uploaded")
+
+
+def publish(output_dir, client, site, root_page_id, options, archive_page_id=None, concurrency=DEFAULT_CONCURRENCY):
+    """
+    Publish the new and changed pages of an output directory and remove the pages no longer generated.
+    """
+    publisher = Publisher(output_dir, client, site, root_page_id, options, archive_page_id, concurrency)
+
+    start = time.perf_counter()
+    try:
+        asyncio.run(publisher.run())
+    finally:
+        publisher.state.save()
+    elapsed = time.perf_counter() - start
+
+    summary = publisher.summary
+
+    print("\nPages created: {created}, updated: {updated}, unchanged: {unchanged}, removed: {removed}".format(**summary))
+    print("Attachments uploaded: {attachments_uploaded}, unchanged: {attachments_unchanged}".format(**summary))
+    print(f"Requests sent: {client.requests}, retried after throttling: {client.retries}")
+    scheduler = publisher.scheduler
+    print(f"Requests at once: {scheduler.lowest} to {scheduler.highest} of {concurrency}, "
+          f"reduced {scheduler.decreases} times")
+    print(f"Published in {elapsed:.1f}s, {summary['updated'] / elapsed if elapsed else 0:.1f} pages updated per second")
+
+    return summary
+
+
+def main():
+    """
+    Main entry point.
+    """
+    load_dotenv()
+
+    parser = argparse.ArgumentParser(description="Publish the new and changed generated pages to Confluence.")
+    parser.add_argument("output_dir", nargs="?", default="output", help="directory of generated pages")
+    parser.add_argument("-r", "--root-page", required=True, help="id of the Confluence page to publish under")
+    parser.add_argument("-d", "--domain", help="Confluence domain, or CONFLUENCE_DOMAIN")
+    parser.add_argument("-p", "--path", help="Confluence base path, or CONFLUENCE_PATH")
+    parser.add_argument("-u", "--username", help="Confluence user name, or CONFLUENCE_USER_NAME")
+    parser.add_argument("-a", "--api-key", help="Confluence API key, or CONFLUENCE_API_KEY")
+    parser.add_argument("-s", "--space", help="Confluence space key, or CONFLUENCE_SPACE_KEY")
+    parser.add_argument("--api-url", help="Confluence API URL, or CONFLUENCE_API_URL")
+    parser.add_argument("--archive-page", help="move removed pages under this page instead of deleting them")
+    parser.add_argument("-c", "--concurrency", type=int, default=DEFAULT_CONCURRENCY,
+                        help=f"most requests to send to Confluence at once (default {DEFAULT_CONCURRENCY})")
+    parser.add_argument("--ignore-invalid-url", action="store_true",
+                        help="warn about links to pages that do not exist instead of failing")
+    args = parser.parse_args()
+
+    try:
+        properties = ConfluenceConnectionProperties(api_url=args.api_url,
+                                                    domain=args.domain,
+                                                    base_path=args.path,
+                                                    user_name=args.username,
+                                                    api_key=args.api_key,
+                                                    space_key=args.space)
+    except ArgumentError as e:
+        parser.error(str(e))
+
+    site = ConfluenceSiteMetadata(domain=properties.domain,
+                                  base_path=properties.base_path or "/wiki/",
+                                  space_key=properties.space_key)
+    options = ConfluenceDocumentOptions(ignore_invalid_url=args.ignore_invalid_url)
+    concurrency = max(1, args.concurrency)
+
+    try:
+        publish(args.output_dir, ConfluenceClient(properties, concurrency), site, args.root_page, options,
+                args.archive_page, concurrency)
+    except requests.exceptions.HTTPError as err:
+        print(err)
+        if err.response is not None:
+            print(err.response.text)
+        sys.exit(1)
+    except requests.exceptions.RequestException as err:
+        print(f"Cannot reach Confluence: {err}")
+        sys.exit(1)
+    except (ArgumentError, ConversionError) as err:
+        print(f"Error: {err}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,22 @@
+"""
+The scripts are run from the top of the repository, so the tests import them from there.
+"""
+
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from mock_confluence import MockConfluence
+
+
+@pytest.fixture
+def confluence():
+    """
+    A local stand-in Confluence server, stopped after the test.
+    """
+    server = MockConfluence().start()
+    yield server
+    server.stop()
@@ -0,0 +1,232 @@
+"""
+Local stand-in for the Confluence REST API, serving the v1 content and attachment endpoints used by
+publish_confluence.py.
+
+The server keeps its pages and attachments in memory and records what the publishing did to them:
+the requests in the order they arrived, the most requests that were in flight at once, and any page
+created before its parent page existed. It can throttle requests with 429 and a Retry-After header,
+either a set number of requests or every request beyond a number in flight, to test the retries and
+the adaptive concurrency, and fail every request after a number of them to interrupt a publish.
+"""
+
+import json
+import re
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+
+ROOT_PAGE_ID = "1"
+ARCHIVE_PAGE_ID = "2"
+
+
+class MockConfluence:
+    """
+    In-memory Confluence space served over HTTP on a free local port.
+    """
+
+    def __init__(self, latency=0.0):
+        self.latency = latency      # Seconds each request takes.
+        self.throttle = 0           # Number of the next requests answered with 429.
+        self.capacity = 0           # If set, requests beyond this many in flight are answered with 429.
+        self.retry_after = "0"      # Retry-After header of the throttled responses.
+        self.fail_after = None      # If set, every request after this many fails with 500.
+
+        self.pages = {}
+        self.attachments = {}
+        self.requests = []          # (method, path) of every request.
+        self.throttled = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.orphans = []           # Titles of pages created under a parent page that did not exist.
+
+        self.lock = threading.Lock()
+        self.ids = iter(range(1000, 10 ** 9))
+
+        self.add_page(ROOT_PAGE_ID, "Root", None)
+        self.add_page(ARCHIVE_PAGE_ID, "Archive", None)
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), self.handler())
+        self.server.daemon_threads = True
+        self.api_url = f"http://127.0.0.1:{self.server.server_address[1]}/"
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def add_page(self, page_id, title, parent_id, body=""):
+        self.pages[page_id] = {"id": page_id, "title": title, "parent": parent_id, "body": body,
+                               "version": 1, "labels": []}
+        return self.pages[page_id]
+
+    def page_by_title(self, title):
+        return next((page for page in self.pages.values() if page["title"] == title), None)
+
+    def children(self, page_id):
+        return sorted(page["title"] for page in self.pages.values() if page["parent"] == page_id)
+
+    def count(self, method, pattern=""):
+        """
+        Return the number of requests with the method and a path matching the regular expression.
+        """
+        return sum(1 for request_method, path in self.requests
+                   if request_method == method and re.search(pattern, path))
+
+    def handler(self):
+        confluence = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                confluence.handle(self, "GET")
+
+            def do_POST(self):
+                confluence.handle(self, "POST")
+
+            def do_PUT(self):
+                confluence.handle(self, "PUT")
+
+            def do_DELETE(self):
+                confluence.handle(self, "DELETE")
+
+        return Handler
+
+    ###############################################################################
+    ##  Requests.                                                                ##
+    ###############################################################################
+
+    def handle(self, request, method):
+        length = int(request.headers.get("Content-Length") or 0)
+        body = request.rfile.read(length)
+        url = urlparse(request.path)
+        params = {key: values[0] for key, values in parse_qs(url.query).items()}
+
+        with self.lock:
+            self.requests.append((method, url.path))
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+            failed = self.fail_after is not None and len(self.requests) > self.fail_after
+            throttled = not failed and (self.throttle > 0 or (self.capacity and self.in_flight > self.capacity))
+            if throttled:
+                self.throttle = max(0, self.throttle - 1)
+                self.throttled += 1
+
+        try:
+            if self.latency:
+                time.sleep(self.latency)
+            if failed:
+                status, data, headers = 500, {"message": "Internal server error"}, {}
+            elif throttled:
+                status, data, headers = 429, {"message": "Rate limited"}, {"Retry-After": self.retry_after}
+            else:
+                status, data = self.route(method, url.path.removeprefix("/rest/api/"), params, body)
+                headers = {}
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+
+        content = json.dumps(data).encode("utf-8") if data is not None else b""
+        request.send_response(status)
+        request.send_header("Content-Type", "application/json")
+        request.send_header("Content-Length", str(len(content)))
+        for name, value in headers.items():
+            request.send_header(name, value)
+        request.end_headers()
+        request.wfile.write(content)
+
+    def route(self, method, path, params, body):
+        with self.lock:
+            if path == "content":
+                if method == "GET":
+                    return self.find_page(params)
+                if method == "POST":
+                    return self.create_page(json.loads(body))
+
+            match = re.fullmatch(r"content/(\w+)", path)
+            if match:
+                page = self.pages.get(match.group(1))
+                if page is None:
+                    return 404, {"message": "No content found"}
+                if method == "GET":
+                    return 200, self.page_json(page, params.get("expand", ""))
+                if method == "PUT":
+                    return self.update_page(page, json.loads(body))
+                if method == "DELETE":
+                    del self.pages[page["id"]]
+                    return 204, None
+
+            match = re.fullmatch(r"content/(\w+)/label", path)
+            if match and method == "POST" and match.group(1) in self.pages:
+                labels = self.pages[match.group(1)]["labels"]
+                labels.extend(label["name"] for label in json.loads(body) if label["name"] not in labels)
+                return 200, {"results": []}
+
+            match = re.fullmatch(r"content/(\w+)/child/attachment(?:/(\w+)/data)?", path)
+            if match and match.group(1) in self.pages:
+                if method == "GET":
+                    results = [attachment for attachment in self.attachments.values()
+                               if attachment["page"] == match.group(1) and attachment["title"] == params.get("filename")]
+                    return 200, {"results": results}
+                if method == "POST":
+                    return self.upload_attachment(match.group(1), match.group(2), body)
+
+        return 404, {"message": f"No route for {method} {path}"}
+
+    def page_json(self, page, expand=""):
+        data = {"id": page["id"], "type": "page", "status": "current", "title": page["title"],
+                "version": {"number": page["version"]},
+                "ancestors": [{"id": page["parent"]}] if page["parent"] else []}
+        if "body.storage" in expand:
+            data["body"] = {"storage": {"value": page["body"], "representation": "storage"}}
+        return data
+
+    def find_page(self, params):
+        results = [self.page_json(page) for page in self.pages.values() if page["title"] == params.get("title")]
+        return 200, {"results": results, "size": len(results)}
+
+    def create_page(self, request):
+        if self.page_by_title(request["title"]) is not None:
+            return 400, {"message": "A page with this title already exists"}
+
+        parent_id = request["ancestors"][0]["id"]
+        if parent_id not in self.pages:
+            self.orphans.append(request["title"])
+
+        page = self.add_page(str(next(self.ids)), request["title"], parent_id, request["body"]["storage"]["value"])
+        return 200, self.page_json(page)
+
+    def update_page(self, page, request):
+        if request["version"]["number"] != page["version"] + 1:
+            return 409, {"message": f"Version must be incremented on update. Current version is: {page['version']}"}
+
+        page.update({"title": request["title"], "body": request["body"]["storage"]["value"],
+                     "version": page["version"] + 1})
+        if request.get("ancestors"):
+            page["parent"] = request["ancestors"][0]["id"]
+        return 200, self.page_json(page)
+
+    def upload_attachment(self, page_id, attachment_id, body):
+        if attachment_id is None:
+            name = re.search(rb'filename="([^"]+)"', body).group(1).decode("utf-8")
+            if any(attachment["page"] == page_id and attachment["title"] == name
+                   for attachment in self.attachments.values()):
+                return 400, {"message": "Cannot add a new attachment with same file name as an existing attachment"}
+            attachment = {"id": f"att{next(self.ids)}", "title": name, "page": page_id, "version": {"number": 1}}
+            self.attachments[attachment["id"]] = attachment
+            return 200, {"results": [attachment]}
+
+        attachment = self.attachments.get(attachment_id)
+        if attachment is None:
+            return 404, {"message": "No attachment found"}
+        attachment["version"]["number"] += 1
+        return 200, attachment
@@ -0,0 +1,108 @@
+"""
+Tests of the package skip rules shared by the generators.
+"""
+
+import pytest
+
+import common
+
+from common import PackageRules, check_for_skip
+from domain import ModelClass
+
+
+@pytest.fixture
+def default_rules(monkeypatch):
+    monkeypatch.setattr(common, "_rules", PackageRules())
+
+
+@pytest.mark.parametrize("package_path", [
+    ('D2Payload', 'LocationReferencing'),
+    ('D2Payload', 'LocationReferencing', 'Classes'),
+    ('D2Payload', 'Common', 'Classes'),
+])
+def test_skips_the_default_packages(default_rules, package_path):
+    assert check_for_skip(package_path)
+    assert check_for_skip(list(package_path))
+
+
+@pytest.mark.parametrize("package_path", [
+    (),
+    ('D2Payload',),
+    ('D2Payload', 'Common'),
+    ('D2Payload', 'Common', 'DataTypes'),
+])
+def test_keeps_the_other_packages(default_rules, package_path):
+    assert not check_for_skip(package_path)
+
+
+def test_skips_by_the_package_path_of_a_domain_element(default_rules):
+    # The domain model keeps the package path as a tuple.
+    model_class = ModelClass("EAID_1", "Location", "uml:Class",
+                             package_path=['D2Payload', 'LocationReferencing'])
+
+    assert model_class.package_path == ('D2Payload', 'LocationReferencing')
+    assert check_for_skip(model_class.package_path)
+
+
+def test_stereotype_rules():
+    rules = PackageRules({"skip": [{"stereotype": "deprecated"}], "include": [{"stereotype": "keep"}]})
+
+    assert rules.skips(('Model',), "deprecated")
+    assert not rules.skips(('Model',), "keep")
+    assert not rules.skips(('Model',))
+
+
+def test_star_matches_one_package():
+    rules = PackageRules({"skip": ["Model/*/Classes"]})
+
+    assert rules.skips(('Model', 'Core', 'Classes'))
+    assert rules.skips(('Model', 'Core', 'Classes', 'Details'))
+    assert not rules.skips(('Model', 'Classes'))
+    assert not rules.skips(('Model', 'Core', 'Extra', 'Classes'))
+
+
+def test_globstar_matches_any_number_of_packages():
+    rules = PackageRules({"skip": ["Model/**/Internal"]})
+
+    assert rules.skips(('Model', 'Internal'))
+    assert rules.skips(('Model', 'Core', 'Internal'))
+    assert rules.skips(('Model', 'Core', 'Extra', 'Internal', 'Details'))
+    assert not rules.skips(('Model', 'Core'))
+    assert not rules.skips(('Other', 'Internal'))
+
+
+@pytest.mark.parametrize("skip", ["A", "A/**", "**"])
+def test_include_under_a_skip_applies_below_its_own_level(skip):
+    rules = PackageRules({"skip": [skip], "include": ["A/B"]})
+
+    assert rules.skips(('A',))
+    assert rules.skips(('A', 'X'))
+    assert not rules.skips(('A', 'B'))
+    assert not rules.skips(('A', 'B', 'C'))
+    assert not rules.skips(('A', 'B', 'C', 'D'))
+
+
+def test_more_specific_globstar_skip_under_an_include():
+    rules = PackageRules({"skip": ["A/B/**/Internal"], "include": ["A/B"]})
+
+    assert not rules.skips(('A', 'B', 'C'))
+    assert rules.skips(('A', 'B', 'C', 'Internal'))
+    assert rules.skips(('A', 'B', 'C', 'Internal', 'D'))
+
+
+def test_prunes_only_packages_with_nothing_included_below():
+    rules = PackageRules({"skip": ["A/**"], "include": ["A/B/C"]})
+
+    assert not rules.prunes(('A',))
+    assert not rules.prunes(('A', 'B'))
+    assert not rules.prunes(('A', 'B', 'C'))
+    assert rules.prunes(('A', 'X'))
+    assert rules.prunes(('A', 'B', 'X'))
+    assert rules.pruned == {('A', 'X'), ('A', 'B', 'X')}
+
+
+def test_prunes_nothing_with_a_stereotype_include():
+    rules = PackageRules({"skip": ["A"], "include": [{"stereotype": "keep"}]})
+
+    assert rules.skips(('A', 'X'))
+    assert not rules.prunes(('A', 'X'))
@@ -0,0 +1,55 @@
+"""
+Tests of loading the generators' model back from the SQLite model store.
+"""
+
+import os
+import sqlite3
+
+import pytest
+
+import common
+
+from common import PackageRules, load_model
+from domain import build_domain
+from model_store import load_model_store, save_model_store
+
+
+MODEL_FILE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                          "model", "model_uml2.2_xmi_2.1_EA.xmi")
+
+
+@pytest.fixture
+def store(monkeypatch, tmp_path):
+    """
+    A model store of the sample model, built with the default rules.
+    """
+    monkeypatch.setattr(common, "_rules", PackageRules())
+    model = load_model(MODEL_FILE)
+    build_domain(model)
+    save_model_store(model, str(tmp_path / "model.db"))
+    return model, str(tmp_path / "model.db")
+
+
+def test_loads_the_store_with_the_rules_it_was_built_with(store):
+    model, db_path = store
+
+    loaded = load_model_store(db_path)
+
+    assert sorted(loaded.domain) == sorted(model.domain)
+
+
+def test_rejects_the_store_with_other_rules(monkeypatch, store):
+    _, db_path = store
+    monkeypatch.setattr(common, "_rules", PackageRules({}))
+
+    with pytest.raises(ValueError, match="other skip and include rules"):
+        load_model_store(db_path)
+
+
+def test_does_not_create_a_missing_store(tmp_path):
+    db_path = tmp_path / "missing.db"
+
+    with pytest.raises(sqlite3.OperationalError):
+        load_model_store(str(db_path))
+
+    assert not db_path.exists()
@@ -0,0 +1,461 @@
+"""
+Integration tests of publish_confluence.py against the local stand-in Confluence server.
+"""
+
+import asyncio
+import hashlib
+import os
+import sys
+import threading
+import time
+
+import pytest
+import requests
+
+from concurrent.futures import ThreadPoolExecutor
+
+from md2conf.converter import ConfluenceDocumentOptions
+from md2conf.metadata import ConfluenceSiteMetadata
+from md2conf.properties import ConfluenceConnectionProperties
+
+from common import PageManifest
+from mock_confluence import ARCHIVE_PAGE_ID, ROOT_PAGE_ID
+import publish_confluence
+
+from publish_confluence import (MAX_BACKOFF, ConfluenceClient, Publisher, Scheduler, SyncState, main, publish,
+                                retry_delay)
+
+
+def model_pages(classes=4, attributes=3):
+    """
+    Return the markdown pages of a small generated model, keyed by their path in the output.
+    """
+    pages = {"index.md": "Model", "classes/index.md": "Classes"}
+    for number in range(classes):
+        pages[f"classes/Class{number}/index.md"] = f"Class{number} Class"
+        for attribute in range(attributes):
+            pages[f"classes/Class{number}/attribute{attribute}.md"] = f"Class{number} attribute{attribute} Property"
+    return pages
+
+
+def write_output(output_dir, pages, text="Generated page.", texts=None):
+    """
+    Write markdown pages and their page manifest to an output directory, as process_model.py does.
+    The pages of an earlier call that are not in pages are removed.
+    """
+    manifest = PageManifest(str(output_dir))
+    for page, title in pages.items():
+        content = f"---\ntitle: {title}\n---\n\n{(texts or {}).get(page, text)}\n"
+        output_file = os.path.join(output_dir, *page.split("/"))
+        os.makedirs(os.path.dirname(output_file), exist_ok=True)
+        with open(output_file, "w", encoding="utf-8") as file:
+            file.write(content)
+        manifest.update(output_file, hashlib.sha256(content.encode("utf-8")).hexdigest())
+    manifest.save()
+    return output_dir
+
+
+SITE = ConfluenceSiteMetadata(domain="confluence.example.com", base_path="/wiki/", space_key="SCS")
+
+
+def connect(confluence, concurrency):
+    properties = ConfluenceConnectionProperties(api_url=confluence.api_url, domain=SITE.domain,
+                                                base_path=SITE.base_path, api_key="token", space_key=SITE.space_key)
+    return ConfluenceClient(properties, concurrency)
+
+
+def publish_output(confluence, output_dir, concurrency=4, archive_page_id=None):
+    """
+    Publish an output directory to the stand-in server and return the summary and the client.
+    """
+    client = connect(confluence, concurrency)
+    summary = publish(str(output_dir), client, SITE, ROOT_PAGE_ID, ConfluenceDocumentOptions(),
+                      archive_page_id, concurrency)
+    return summary, client
+
+
+###################################################################################################
+##  Concurrent publishing.                                                                       ##
+###################################################################################################
+
+def test_creates_parents_before_children(confluence, tmp_path):
+    pages = model_pages()
+    summary, _ = publish_output(confluence, write_output(tmp_path, pages), concurrency=8)
+
+    assert summary["created"] == len(pages)
+    assert confluence.orphans == []
+
+    model = confluence.page_by_title("Model")
+    classes = confluence.page_by_title("Classes")
+    assert model["parent"] == ROOT_PAGE_ID
+    assert classes["parent"] == model["id"]
+    assert confluence.children(classes["id"]) == [f"Class{number} Class" for number in range(4)]
+    class_page = confluence.page_by_title("Class0 Class")
+    assert confluence.children(class_page["id"]) == [f"Class0 attribute{number} Property" for number in range(3)]
+
+
+def test_keeps_to_the_concurrency_limit(confluence, tmp_path):
+    confluence.latency = 0.02
+
+    pages = model_pages(classes=6)
+    summary, _ = publish_output(confluence, write_output(tmp_path, pages), concurrency=3)
+
+    assert summary["updated"] == len(pages)
+    assert 1 < confluence.max_in_flight <= 3
+
+
+def test_retries_throttled_requests(confluence, tmp_path):
+    confluence.throttle = 5
+    confluence.retry_after = "0"
+
+    pages = model_pages()
+    summary, client = publish_output(confluence, write_output(tmp_path, pages))
+
+    assert summary["created"] == summary["updated"] == len(pages)
+    assert confluence.throttled == 5
+    assert client.retries == 5
+    assert all(page["version"] == 2 for page in confluence.pages.values() if page["parent"] is not None)
+
+
+@pytest.mark.parametrize("retry_after, delay", [
+    ("2", 2.0),
+    ("-5", 0.0),
+    ("86400", MAX_BACKOFF),
+    ("1e300", MAX_BACKOFF),
+    ("Fri, 31 Dec 2100 23:59:59 GMT", MAX_BACKOFF),
+])
+def test_retry_after_is_capped(retry_after, delay):
+    response = requests.Response()
+    response.headers["Retry-After"] = retry_after
+
+    assert retry_delay(response, 0) == delay
+
+
+###################################################################################################
+##  Incremental publishing.                                                                      ##
+###################################################################################################
+
+def test_uploads_only_the_changed_pages(confluence, tmp_path):
+    pages = model_pages()
+    publish_output(confluence, write_output(tmp_path, pages))
+    requests_before = len(confluence.requests)
+
+    write_output(tmp_path, pages, texts={"classes/Class1/attribute2.md": "Changed page."})
+    summary, client = publish_output(confluence, tmp_path)
+
+    assert summary["created"] == 0
+    assert summary["updated"] == 1
+    assert summary["unchanged"] == len(pages) - 1
+    # Only the update of the changed page, trusting the page id and version in the sync state.
+    changed = confluence.page_by_title("Class1 attribute2 Property")
+    assert confluence.requests[requests_before:] == [("PUT", f"/rest/api/content/{changed['id']}")]
+    assert "Changed page." in changed["body"]
+
+
+def test_uploads_only_the_changed_images(confluence, tmp_path):
+    pages = {"index.md": "Model", "classes/index.md": "Classes"}
+    texts = {"index.md": "![Model](images/model.png)", "classes/index.md": "![Classes](../images/classes.png)"}
+    os.makedirs(tmp_path / "images")
+    (tmp_path / "images" / "model.png").write_bytes(b"model image")
+    (tmp_path / "images" / "classes.png").write_bytes(b"classes image")
+
+    summary, _ = publish_output(confluence, write_output(tmp_path, pages, texts=texts))
+    assert summary["attachments_uploaded"] == 2
+
+    (tmp_path / "images" / "classes.png").write_bytes(b"new classes image")
+    summary, _ = publish_output(confluence, tmp_path)
+
+    assert summary["updated"] == 0
+    assert summary["attachments_uploaded"] == 1
+    assert summary["attachments_unchanged"] == 1
+    versions = {attachment["title"]: attachment["version"]["number"] for attachment in confluence.attachments.values()}
+    assert versions == {"images_model.png": 1, "PAR_images_classes.png": 2}
+
+
+def test_deletes_the_removed_pages(confluence, tmp_path):
+    pages = model_pages()
+    publish_output(confluence, write_output(tmp_path, pages))
+    removed = {page: title for page, title in pages.items() if page.startswith("classes/Class3/")}
+
+    write_output(tmp_path, {page: title for page, title in pages.items() if page not in removed})
+    summary, _ = publish_output(confluence, tmp_path)
+
+    assert summary["removed"] == len(removed)
+    assert summary["unchanged"] == len(pages) - len(removed)
+    assert confluence.count("DELETE") == len(removed)
+    assert all(confluence.page_by_title(title) is None for title in removed.values())
+
+
+def test_archives_the_removed_pages(confluence, tmp_path):
+    pages = model_pages()
+    publish_output(confluence, write_output(tmp_path, pages))
+    removed = {page: title for page, title in pages.items() if page.startswith("classes/Class3/")}
+
+    write_output(tmp_path, {page: title for page, title in pages.items() if page not in removed})
+    summary, _ = publish_output(confluence, tmp_path, archive_page_id=ARCHIVE_PAGE_ID)
+
+    assert summary["removed"] == len(removed)
+    assert confluence.count("DELETE") == 0
+    # The attribute pages are archived before the class page, so they are moved out from under it.
+    assert confluence.children(ARCHIVE_PAGE_ID) == sorted(removed.values())
+
+    # The pages are no longer in the sync state, so the next publish leaves them alone.
+    summary, _ = publish_output(confluence, tmp_path, archive_page_id=ARCHIVE_PAGE_ID)
+    assert summary["removed"] == 0
+    assert summary["unchanged"] == len(pages) - len(removed)
+
+
+def test_creates_a_page_deleted_in_confluence_again(confluence, tmp_path):
+    pages = model_pages()
+    publish_output(confluence, write_output(tmp_path, pages))
+    deleted = confluence.page_by_title("Class2 Class")
+    del confluence.pages[deleted["id"]]
+
+    write_output(tmp_path, pages, texts={"classes/Class2/index.md": "Changed page."})
+    summary, _ = publish_output(confluence, tmp_path)
+
+    created = confluence.page_by_title("Class2 Class")
+    assert summary["created"] == summary["updated"] == 1
+    assert created["id"] != deleted["id"]
+    assert created["parent"] == confluence.page_by_title("Classes")["id"]
+    assert "Changed page." in created["body"]
+
+    # The sync state has the new page, so the next publish has nothing to do.
+    summary, _ = publish_output(confluence, tmp_path)
+    assert summary["unchanged"] == len(pages)
+
+
+def test_removes_a_page_already_deleted_in_confluence(confluence, tmp_path):
+    pages = model_pages()
+    publish_output(confluence, write_output(tmp_path, pages))
+    del confluence.pages[confluence.page_by_title("Class0 attribute0 Property")["id"]]
+
+    write_output(tmp_path, {page: title for page, title in pages.items() if page != "classes/Class0/attribute0.md"})
+    summary, _ = publish_output(confluence, tmp_path)
+
+    assert summary["removed"] == 1
+
+
+###################################################################################################
+##  Adaptive concurrency and checkpoints.                                                       ##
+###################################################################################################
+
+def test_halves_the_limit_when_throttled():
+    scheduler = Scheduler(None, None, maximum=16, initial=8)
+
+    scheduler.adjust(0.05, throttled=True)
+    assert scheduler.limit == 4
+
+    # The responses to the requests sent before the decrease do not decrease it again.
+    scheduler.adjust(0.05, throttled=True)
+    assert scheduler.limit == 4
+
+    time.sleep(0.06)
+    scheduler.adjust(0.05, throttled=True)
+    assert scheduler.limit == 2
+    assert scheduler.decreases == 2
+    assert scheduler.lowest == 2
+
+
+def test_halves_the_limit_when_responses_slow_down():
+    scheduler = Scheduler(None, None, maximum=16, initial=8)
+    for _ in range(4):
+        scheduler.adjust(0.05, throttled=False)
+    limit = scheduler.limit
+
+    scheduler.adjust(0.5, throttled=False)
+
+    assert scheduler.limit == limit / 2
+
+
+def test_grows_the_limit_by_one_per_round_trip():
+    scheduler = Scheduler(None, None, maximum=6, initial=4)
+
+    scheduler.adjust(0.05, throttled=False)
+    assert scheduler.limit == 4.25
+
+    # About one more for each response to the requests in flight.
+    for _ in range(4):
+        scheduler.adjust(0.05, throttled=False)
+    assert int(scheduler.limit) == 5
+
+    for _ in range(100):
+        scheduler.adjust(0.05, throttled=False)
+    assert scheduler.limit == 6
+    assert scheduler.highest == 6
+
+
+def test_runs_the_most_urgent_jobs_first():
+    order = []
+    started = threading.Event()
+    release = threading.Event()
+
+    def job(name):
+        order.append(name)
+        if name == "running":
+            started.set()
+            release.wait()
+
+    async def run():
+        loop = asyncio.get_running_loop()
+        with ThreadPoolExecutor(1) as executor:
+            scheduler = Scheduler(loop, executor, maximum=1, initial=1)
+            running = asyncio.ensure_future(scheduler.call(0, job, "running"))
+            await asyncio.to_thread(started.wait)
+
+            # Queued while the only job slot is taken.
+            waiting = [asyncio.ensure_future(scheduler.call(priority, job, name))
+                       for priority, name in [(2, "attribute"), (0, "index"), (1, "enumeration"), (0, "package")]]
+            await asyncio.sleep(0)
+            release.set()
+            await asyncio.gather(running, *waiting)
+
+    asyncio.run(run())
+
+    assert order == ["running", "index", "package", "enumeration", "attribute"]
+
+
+def test_a_job_cancelled_when_given_a_slot_hands_it_on():
+    order = []
+
+    async def run():
+        loop = asyncio.get_running_loop()
+        with ThreadPoolExecutor(1) as executor:
+            scheduler = Scheduler(loop, executor, maximum=1, initial=1)
+            scheduler.running = 1
+            waiting = asyncio.ensure_future(scheduler.call(0, order.append, "cancelled"))
+            await asyncio.sleep(0)
+
+            # The slot is freed and given to the waiting job, which is cancelled before it resumes.
+            scheduler.running -= 1
+            scheduler.start_waiting()
+            waiting.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await waiting
+
+            assert scheduler.running == 0
+            await asyncio.wait_for(scheduler.call(0, order.append, "next"), 5)
+
+    asyncio.run(run())
+
+    assert order == ["next"]
+
+
+def test_publishes_through_a_throttling_server(confluence, tmp_path):
+    # More requests in flight than the server takes are throttled, so the limit has to come down.
+    confluence.capacity = 2
+    confluence.latency = 0.01
+
+    pages = model_pages()
+    publisher = Publisher(str(write_output(tmp_path, pages)), connect(confluence, 16), SITE, ROOT_PAGE_ID,
+                          ConfluenceDocumentOptions(), concurrency=16)
+    asyncio.run(publisher.run())
+
+    assert publisher.summary["created"] == publisher.summary["updated"] == len(pages)
+    assert confluence.throttled > 0
+    assert publisher.scheduler.decreases > 0
+    assert publisher.scheduler.lowest <= 2
+
+
+def test_resumes_from_the_last_checkpoint(confluence, tmp_path, monkeypatch):
+    monkeypatch.setattr(publish_confluence, "CHECKPOINT_INTERVAL", 0.0)
+    pages = model_pages(classes=6)
+    write_output(tmp_path, pages)
+
+    # The server fails part way through and the publish stops without saving the sync state at the
+    # end, as if it was killed, so only the checkpoints are saved.
+    confluence.fail_after = 50
+    publisher = Publisher(str(tmp_path), connect(confluence, 4), SITE, ROOT_PAGE_ID, ConfluenceDocumentOptions(),
+                          concurrency=4)
+    with pytest.raises(requests.exceptions.HTTPError):
+        asyncio.run(publisher.run())
+
+    checkpoint = SyncState(str(tmp_path)).pages
+    published = [page for page, record in checkpoint.items() if record["hash"] is not None]
+    assert 0 < len(published) < len(pages)
+
+    confluence.fail_after = None
+    summary, _ = publish_output(confluence, tmp_path)
+
+    assert summary["unchanged"] == len(published)
+    assert summary["updated"] == len(pages) - len(published)
+    assert all(page["version"] == 2 for page in confluence.pages.values() if page["parent"] is not None)
+
+
+###################################################################################################
+##  Confluence storage format pages.                                                             ##
+###################################################################################################
+
+def test_uploads_storage_format_pages_as_they_are(confluence, tmp_path):
+    pages = {
+        "index.xhtml": "<!-- title: TSM Model &amp; Views Package -->\n"
+                       "<!-- labels: transport_safety_model, model -->\n"
+                       "<p>The model.</p>\n",
+        "event_diagram.xhtml": "<!-- title: TSM Event Diagram -->\n"
+                               "<!-- labels: transport_safety_model -->\n"
+                               "<!-- attachments: images/event.png, images/event-thumb.png -->\n"
+                               '<p><ac:image><ri:attachment ri:filename="event-thumb.png" /></ac:image></p>\n',
+    }
+    manifest = PageManifest(str(tmp_path))
+    for page, content in pages.items():
+        (tmp_path / page).write_text(content, encoding="utf-8")
+        manifest.update(str(tmp_path / page), hashlib.sha256(content.encode("utf-8")).hexdigest())
+    manifest.save()
+    os.makedirs(tmp_path / "images")
+    (tmp_path / "images" / "event.png").write_bytes(b"event image")
+    (tmp_path / "images" / "event-thumb.png").write_bytes(b"event thumbnail")
+
+    summary, _ = publish_output(confluence, tmp_path)
+
+    model = confluence.page_by_title("TSM Model & Views Package")
+    diagram = confluence.page_by_title("TSM Event Diagram")
+    assert summary["updated"] == 2
+    assert model["body"] == pages["index.xhtml"]
+    assert sorted(model["labels"]) == ["model", "transport_safety_model"]
+    assert diagram["parent"] == model["id"]
+    assert sorted(attachment["title"] for attachment in confluence.attachments.values()
+                  if attachment["page"] == diagram["id"]) == ["event-thumb.png", "event.png"]
+
+    (tmp_path / "images" / "event.png").write_bytes(b"new event image")
+    summary, _ = publish_output(confluence, tmp_path)
+
+    assert summary["unchanged"] == 2
+    assert summary["attachments_uploaded"] == 1
+
+
+def run_main(monkeypatch, capsys, api_url, output_dir):
+    """
+    Run the publish_confluence.py command and return its exit status and last line of output.
+    """
+    monkeypatch.setattr(sys, "argv", ["publish_confluence.py", "--api-url", api_url, "-a", "token", "-s", "SCS",
+                                      "-d", "confluence.example.com", "-r", ROOT_PAGE_ID, str(output_dir)])
+    with pytest.raises(SystemExit) as exit_info:
+        main()
+    return exit_info.value.code, capsys.readouterr().out.splitlines()[-1]
+
+
+def test_reports_a_page_that_cannot_be_converted(confluence, tmp_path, monkeypatch, capsys):
+    write_output(tmp_path, {"index.md": "Model"}, text="See [the missing page](missing.md).")
+
+    status, error = run_main(monkeypatch, capsys, confluence.api_url, tmp_path)
+
+    assert status == 1
+    assert error.startswith("Error: cannot convert 'index.md'")
+
+
+def test_reports_a_connection_error(confluence, tmp_path, monkeypatch, capsys):
+    api_url = confluence.api_url
+    confluence.stop()
+    write_output(tmp_path, {"index.md": "Model"})
+
+    status, error = run_main(monkeypatch, capsys, api_url, tmp_path)
+
+    assert status == 1
+    assert error.startswith("Cannot reach Confluence:")
+
+
+def test_reports_a_missing_output_directory(confluence, tmp_path, monkeypatch, capsys):
+    status, error = run_main(monkeypatch, capsys, confluence.api_url, tmp_path / "output")
+
+    assert status == 1
+    assert error.startswith("Error: no output directory")